@@ -7,9 +7,10 @@ import numpy as np
 from pyaavs.station import Station
 from pyaavs import station
 import datetime
-from skalab_utils import MyDaq, get_if_name, closest, calcolaspettro, linear2dB
+from skalab_utils import MyDaq, get_if_name, BandPower
 import pydaq.daq_receiver as daq
 from skalab_preadu import *
+from skalab_pdl import PdlRunner, parse_pairs, fibre_pairs
 
 def bound(value, low=0, high=31):
     '''
@@ -30,32 +31,16 @@ def read_routing_table(map_file):
 
 
 def raw2pow(raw_data, tile=0, chan=0, res=1000, startfreq=160, stopfreq=160):
-    resolutions = 2 ** np.array(range(16)) * (800000.0 / 2 ** 15)
-    rbw = int(closest(resolutions, res))
-    avg = 2 ** rbw
-    nsamples = int(2 ** 15 / avg)
-    RBW = (avg * (400000.0 / 16384.0))
-    asse_x = np.arange(nsamples / 2 + 1) * RBW * 0.001
+    # Pol-X and Pol-Y band power (dB) of an input fibre
+    band_power = BandPower(res, [(startfreq, stopfreq)])
+    return band_power.power_db(raw_data[tile][chan, :2, :])[:, 0].tolist()
 
-    # Compute X Pol
-    spettro, rms = calcolaspettro(raw_data[tile][chan, 0, :], nsamples, log=False)
-    bandpower = np.sum(spettro[closest(asse_x, float(startfreq)): closest(asse_x, float(stopfreq))])
-    pwr = [linear2dB(bandpower)]
 
-    # Compute Y Pol
-    spettro, rms = calcolaspettro(raw_data[tile][chan, 1, :], nsamples, log=False)
-    bandpower = np.sum(spettro[closest(asse_x, float(startfreq)): closest(asse_x, float(stopfreq))])
-    pwr += [linear2dB(bandpower)]
-
-    return pwr
-
-
-def runDAQ(directory="/storage/daq/tmp/", chan=0, tpm=0, duration=10, interval=0.01, resolution=1000, band=None):
-    mydaq = None
+def runDAQ(directory="/storage/daq/tmp/", pairs=None, duration=10, resolution=1000, band=None, hdf5_file="",
+           plot=None):
     if band is None:
         band = [160, 160]
-    power = {'tstamp': [], 'Pol-X': [], 'Pol-Y': []}
-    pol = ['Pol-X', 'Pol-Y']
+    runner = None
     tpm_nic_name = get_if_name(station_configuration['network']['lmc']['lmc_ip'])
     if tpm_nic_name == "":
         print("Connection Error! (ETH Card name ERROR)")
@@ -64,109 +49,84 @@ def runDAQ(directory="/storage/daq/tmp/", chan=0, tpm=0, duration=10, interval=0
             mydaq = MyDaq(daq, tpm_nic_name, tpm_station, len(station_configuration['tiles']), directory=directory)
             print("DAQ Initialized, NIC: %s, NofTiles: %d, Data Directory: %s" %
                   (tpm_nic_name, len(station_configuration['tiles']), directory))
-            data = mydaq.execute()
-            t_start = datetime.datetime.utcnow().timestamp()
-            t_stamp = 0.0
-            while t_stamp < duration:
-                power['tstamp'] += [t_stamp]
-                pw = raw2pow(data, tile=tpm, chan=chan, res=resolution, startfreq=band[0], stopfreq=band[1])
-                for n, p in enumerate(pol):
-                    power[p] += [pw[n]]
-                #time.sleep(interval)
-                t_stamp = datetime.datetime.utcnow().timestamp() - t_start
-                data = mydaq.execute()
+            runner = PdlRunner(tpm_station.tiles, pairs, version=opts.version, mode="daq", mydaq=mydaq,
+                               resolution=resolution, band=band, history=max(int(duration * 10), 1024),
+                               hdf5_file=hdf5_file)
+            if plot is not None:
+                plot.attach(runner)
+            runner.run(duration)
             mydaq.close()
-    else:
-        print("DAQ Error: a valid data directory is required.")
-    return power
-
-
-def runRms(chan=0, tpm=0, duration=10, interval=0.01, ylim="", autoy=False, version=2):
-    power = {'tstamp': [], 'Pol-X': np.array([]), 'Pol-Y': np.array([])}
-    pol = ['Pol-X', 'Pol-Y']
-
-    plt.ion()
-    gs = gridspec.GridSpec(2, 1, height_ratios=[6, 1])
-    fig = plt.figure(figsize=(14, 9), facecolor='w')
-    plt.pause(0.1)
-    ax1 = fig.add_subplot(gs[0])
-    ax2 = fig.add_subplot(gs[1])
-    pol_x_line, = ax1.plot([], [], color='b', lw=2)
-    pol_y_line, = ax1.plot([], [], color='g', lw=2)
-    ax1.set_xlim(0, duration)
-    ax1.set_xlabel("time (s)", fontsize=20)
-    if not autoy:
-        ax1.set_ylim(float(ylim.split(",")[0]), float(ylim.split(",")[1]))
-    ax1.set_ylabel("normalized dB", fontsize=20)
-    ax1.grid(True)
-    ax1.autoscale(enable=True, axis='y')
-    ax1.set_title("PDL Measure of TPM-%02d Input Fibre %02d" % (tpm + 1, chan + 1), fontsize=26)
-    ax2.plot(range(100), color='w')
-    ax2.set_xlim(0, 100)
-    pdl_x_ann = ax2.annotate("Pol-X:", (2, 80), fontsize=38, color='b')
-    pdl_y_ann = ax2.annotate("Pol-Y:", (64, 80), fontsize=38, color='g')
-    for n in range(2):
-        id = fibre_remap[chan * 2 + n]
-        fw_map = preadu.get_spi_conf(nrx=id)
-        #print(fw_map)
-        if fw_map['pol'].upper() == "RF-2":
-            dsa_x_ann = ax2.annotate("DSA: %02d dB" % (preadu.get_rx_attenuation(nrx=id)), (3, 20), fontsize=16, color='b')
-            level_x_ann = ax2.annotate("LEVEL: - dBm", (18, 20), fontsize=16, color='b')
         else:
-            dsa_y_ann = ax2.annotate("DSA: %02d dB" % (preadu.get_rx_attenuation(nrx=id)), (65, 20), fontsize=16, color='g')
-            level_y_ann = ax2.annotate("LEVEL: - dBm", (80, 20), fontsize=16, color='g')
-    ax2.set_axis_off()
-    fig.tight_layout()
-    fig.canvas.draw()
-    fig.canvas.flush_events()
-
-    rms = get_rms(tile=tpm_station.tiles[tpm], version=board_version)
-    # for i in range(32):
-    #     print(i, 10 * np.log10(np.power((rms[i] * (1.7 / 256.)), 2) / 400.) + 30 + 12)
-    #exit()
-    t_start = datetime.datetime.utcnow().timestamp()
-    t_stamp = 0.0
-    # pbar = tqdm(total=duration, desc="TPM-%02d - Input Fibre #%02d" % (tpm, chan),
-    #             bar_format="{desc}: {percentage:3.0f}%|{bar}| {n:.1f}/{total_fmt} [{elapsed}<{remaining}")
-    while t_stamp <= duration:
-        # pbar.update(t_stamp - pbar.last_print_n)
-        power['tstamp'] += [t_stamp]
-
-        for n in range(2):
-            id = fibre_remap[chan * 2 + n]
-            fw_map = preadu.get_spi_conf(nrx=id)
-            with np.errstate(divide='ignore', invalid='ignore'):
-                pw = 10 * np.log10(np.power((rms[id] * (1.7 / 256.)), 2) / 400.) + 30 + 12
-            if pw == -np.inf:
-                pw = -60
-            if fw_map['pol'].upper() == "RF-2":
-                pol = 'Pol-X'
-            else:
-                pol = 'Pol-Y'
-            #print(int(fw_map['adu_in']), pol, pw)
-            power[pol] = np.append(power[pol], pw)
-        pol_x_line.set_data(power['tstamp'], (power['Pol-X'] - power['Pol-X'][0]))
-        pol_y_line.set_data(power['tstamp'], (power['Pol-Y'] - power['Pol-Y'][0]))
-        level_x_ann.set_text("LEVEL: %3.3f dBm" % power['Pol-X'][-1])
-        level_y_ann.set_text("LEVEL: %3.3f dBm" % power['Pol-Y'][-1])
-        pdl_x = max(power['Pol-X']) - min(power['Pol-X'])
-        pdl_y = max(power['Pol-Y']) - min(power['Pol-Y'])
-        pdl_x_ann.set_text("Pol-X:   %.3f dB" % pdl_x)
-        pdl_y_ann.set_text("Pol-Y:   %.3f dB" % pdl_y)
-        if autoy:
-            ax1.relim()
-            ax1.autoscale_view(True, True, True)
-        fig.canvas.draw()
-        fig.canvas.flush_events()
-        time.sleep(interval)
-
-        t_stamp = datetime.datetime.utcnow().timestamp() - t_start
-        rms = get_rms(tile=tpm_station.tiles[tpm], version=board_version)
-
-    # pbar.update(duration - pbar.last_print_n)
-    # pbar.close()
-    plt.ioff()
-    return power
+            print("DAQ Error: a valid data directory is required.")
+    return runner
+
+
+def runRms(pairs=None, duration=10, interval=0.01, hdf5_file="", plot=None):
+    runner = PdlRunner(tpm_station.tiles, pairs, version=opts.version, mode="rms", interval=interval,
+                       history=max(int(duration / max(interval, 0.001)) + 16, 1024), hdf5_file=hdf5_file)
+    if plot is not None:
+        plot.attach(runner)
+    runner.run(duration)
+    return runner
+
+
+class PdlPlot(object):
+    """ Interactive plot of one fibre of a PdlRunner, it is a runner subscriber """
+    def __init__(self, pair, duration=10, ylim="", autoy=False, dsa=(0, 0), title=""):
+        self.pair = pair
+        self.autoy = autoy
+        self.runner = None
+        tpm, chan = pair
+        plt.ion()
+        gs = gridspec.GridSpec(2, 1, height_ratios=[6, 1])
+        self.fig = plt.figure(figsize=(14, 9), facecolor='w')
+        plt.pause(0.1)
+        self.ax1 = self.fig.add_subplot(gs[0])
+        ax2 = self.fig.add_subplot(gs[1])
+        self.pol_x_line, = self.ax1.plot([], [], color='b', lw=2)
+        self.pol_y_line, = self.ax1.plot([], [], color='g', lw=2)
+        self.ax1.set_xlim(0, duration)
+        self.ax1.set_xlabel("time (s)", fontsize=20)
+        if not autoy:
+            self.ax1.set_ylim(float(ylim.split(",")[0]), float(ylim.split(",")[1]))
+        self.ax1.set_ylabel("normalized dB", fontsize=20)
+        self.ax1.grid(True)
+        self.ax1.autoscale(enable=True, axis='y')
+        if title == "":
+            self.ax1.set_title("PDL Measure of TPM-%02d Input Fibre %02d" % (tpm + 1, chan + 1), fontsize=26)
+        else:
+            self.ax1.set_title(title, fontsize=26)
+        ax2.plot(range(100), color='w')
+        ax2.set_xlim(0, 100)
+        self.pdl_x_ann = ax2.annotate("Pol-X:", (2, 80), fontsize=38, color='b')
+        self.pdl_y_ann = ax2.annotate("Pol-Y:", (64, 80), fontsize=38, color='g')
+        ax2.annotate("DSA: %02d dB" % dsa[0], (3, 20), fontsize=16, color='b')
+        self.level_x_ann = ax2.annotate("LEVEL: - dBm", (18, 20), fontsize=16, color='b')
+        ax2.annotate("DSA: %02d dB" % dsa[1], (65, 20), fontsize=16, color='g')
+        self.level_y_ann = ax2.annotate("LEVEL: - dBm", (80, 20), fontsize=16, color='g')
+        ax2.set_axis_off()
+        self.fig.tight_layout()
+        self.fig.canvas.draw()
+        self.fig.canvas.flush_events()
+
+    def attach(self, runner):
+        self.runner = runner
+        self.column = 2 * runner.pairs.index(self.pair)
+        runner.subscribe(self)
+
+    def __call__(self, tstamp, values, stats):
+        t, pol_x, pol_y = self.runner.series(self.pair)
+        self.pol_x_line.set_data(t, pol_x - stats.first[self.column])
+        self.pol_y_line.set_data(t, pol_y - stats.first[self.column + 1])
+        self.level_x_ann.set_text("LEVEL: %3.3f dBm" % values[self.column])
+        self.level_y_ann.set_text("LEVEL: %3.3f dBm" % values[self.column + 1])
+        self.pdl_x_ann.set_text("Pol-X:   %.3f dB" % stats.pdl()[self.column])
+        self.pdl_y_ann.set_text("Pol-Y:   %.3f dB" % stats.pdl()[self.column + 1])
+        if self.autoy:
+            self.ax1.relim()
+            self.ax1.autoscale_view(True, True, True)
+        self.fig.canvas.draw()
+        self.fig.canvas.flush_events()
 
 
 def get_rms(tile, version):
@@ -180,6 +140,16 @@ def get_rms(tile, version):
     return [adc_rms[x] for x in rms_remap]
 
 
+def read_preadu(tile):
+    """ Load the PreADU register values of a tile in the preadu object """
+    tile.tpm.tpm_preadu[0].read_configuration()  # TOP
+    tile.tpm.tpm_preadu[1].read_configuration()  # BOTTOM
+    for i in range(32):
+        fw_map = preadu.get_spi_conf(nrx=i)
+        value = tile.tpm.tpm_preadu[int(fw_map['preadu_id'])].channel_filters[int(fw_map['channel_filter'])]
+        preadu.set_register_value(nrx=i, value=value)
+
+
 if __name__ == "__main__":
     from optparse import OptionParser
     from sys import argv
@@ -217,6 +187,15 @@ if __name__ == "__main__":
                       default="-0.5,0.5", help="Y Plot Limits (def. '-0.5,0.5'). ")
     parser.add_option("--autoscale", action="store_true", dest="autoscale",
                       default=False, help="Set Plot Y Autoscale")
+    parser.add_option("--pairs", action="store", dest="pairs", type=str,
+                      default="", help="Measure many fibres at once, TPM:Fibre list (e.g. '1:1,1:2,2:1-16'). "
+                                       "It overrides --tpm and --channel")
+    parser.add_option("--all", action="store_true", dest="all",
+                      default=False, help="Measure all the fibres of the station at once")
+    parser.add_option("--hdf5", action="store_true", dest="hdf5",
+                      default=False, help="Stream the measurement into an HDF5 file in the DATA folder")
+    parser.add_option("--headless", action="store_true", dest="headless",
+                      default=False, help="Do not plot (multi fibre measurements are never plotted)")
     (opts, args) = parser.parse_args(argv[1:])
 
     if opts.conf == "":
@@ -284,109 +263,89 @@ if __name__ == "__main__":
                             pol=spimap[1], adu_in=spimap[0], tpm_in=spimap[2])
         #print(spimap)
 
-    # Read DSA
-    preaduConf = []
-    tpm_station.tiles[opts.tpm - 1].tpm.tpm_preadu[0].read_configuration()  # TOP
-    tpm_station.tiles[opts.tpm - 1].tpm.tpm_preadu[1].read_configuration()  # BOTTOM
-    for i in range(32):
-        fw_map = preadu.get_spi_conf(nrx=i)
-        #preadu_id, channel_filter, pol = preadu.get_spi_conf(nrx=i)
-        value = tpm_station.tiles[0].tpm.tpm_preadu[int(fw_map['preadu_id'])].channel_filters[int(fw_map['channel_filter'])]
-        preadu.set_register_value(nrx=i, value=value)
-        preaduConf += [{'id': i,
-                        'sn': "n/a",
-                        'code': value,
-                        'preadu_id': int(fw_map['preadu_id']),
-                        'channel_filter': int(fw_map['channel_filter']),
-                        'pol': fw_map['pol'],
-                        'adu_in': int(fw_map['adu_in']),
-                        'tpm_in': int(fw_map['tpm_in'][1:]),
-                        'dsa': preadu.get_rx_attenuation(i),
-                        'version': preadu.rx[i].version}]
-        #print(i, preaduConf[i])
-
-    # # Check RF Power and DSA
-    # rms = 10 * np.log10(np.power((np.array(tpm_station.tiles[0].get_adc_rms()) * (1.7 / 256.)), 2) / 400.) + 30 + 12
-    # for i in range(32):
-    #     preadu_id = int(rf_map[remap[i]][3])
-    #     channel_filter = int(rf_map[remap[i]][4])
-    #     print(preadu_id, channel_filter,
-    #           tpm_station.tiles[opts.tpm - 1].tpm.tpm_preadu[preadu_id].channel_filters[channel_filter] >> 3,
-    #           rms[remap[i]])
-
-    #pol = [['Pol-X', 'RF-2'], ['Pol-Y', 'RF-1']]
-    pol = ['Pol-X', 'Pol-Y']
-    dsa = []
-    # for p in [0,1]:
-    #     for c in range(16):
-    #         print(p, c, tpm_station.tiles[opts.tpm - 1].tpm.tpm_preadu[p].channel_filters[c] >> 3)
-    #print()
-
-    for n, pol in enumerate(pol):
-        rx_id = fibre_remap[(opts.channel - 1) * 2 + n]
-        fw_map = preadu.get_spi_conf(nrx=rx_id)
-        #preadu_id, channel_filter, rfpol = preadu.get_spi_conf(nrx=rx_id)
-        preadu_id = int(fw_map['preadu_id'])
-        channel_filter = int(fw_map['channel_filter'])
-        dsa = preadu.get_rx_attenuation(nrx=rx_id)
-        if fw_map['pol'].upper() == "RF-2":
-            dsa_x = dsa
-        else:
-            dsa_y = dsa
-        # print("RX # %d" % rx_id, "PreADU Id: %d" % preadu_id,
-        #       " Channel Filter: %d" % channel_filter, "  -->  ",
-        #       fw_map['pol'], " DSA: %02d dB" % dsa)
-        # Equalization
-        if not opts.eqvalue == "":
-            print("Equalization of TPM-%02d Input Channel Fibre %02d to RF Power %3.1f dBm" %
-                  (opts.tpm, opts.channel, float(opts.eqvalue)))
-            for k in range(3):
-                rms = get_rms(tile=tpm_station.tiles[opts.tpm - 1], version=board_version)
-                with np.errstate(divide='ignore', invalid='ignore'):
-                    power = 10 * np.log10(np.power((rms[rx_id] * (1.7 / 256.)), 2) / 400.) + 30 + 12
-                if power == (-np.inf):
-                    power = -30
-                dsa = bound(int(round(dsa + (power - float(opts.eqvalue)))))
-                preadu.set_rx_attenuation(nrx=rx_id, att=dsa)
-                tpm_station.tiles[opts.tpm - 1].tpm.tpm_preadu[preadu_id].channel_filters[channel_filter] = \
-                    preadu.get_register_value(nrx=rx_id)
-                tpm_station.tiles[opts.tpm - 1].tpm.tpm_preadu[preadu_id].write_configuration()
-                time.sleep(1)
-                # print("PreADU Id: %d" % preadu_id, " Channel Filter: %d" % channel_filter, "  -->  ", pol,
-                #       " DSA: %02d dB\n" % preadu.get_rx_attenuation(nrx=rx_id))
-        rms = get_rms(tile=tpm_station.tiles[opts.tpm - 1], version=board_version)
-    #print()
+    pairs = [(opts.tpm - 1, opts.channel - 1)]
+    if not opts.pairs == "":
+        pairs = parse_pairs(opts.pairs)
+    elif opts.all:
+        pairs = fibre_pairs(len(tpm_station.tiles))
+
+    # Read DSA (and equalize) of the measured fibres, one tile at a time
+    pair_dsa = {}
+    for tpm in sorted(set([t for t, c in pairs])):
+        read_preadu(tpm_station.tiles[tpm])
+        for chan in [c for t, c in pairs if t == tpm]:
+            for n in range(2):
+                rx_id = fibre_remap[chan * 2 + n]
+                fw_map = preadu.get_spi_conf(nrx=rx_id)
+                preadu_id = int(fw_map['preadu_id'])
+                channel_filter = int(fw_map['channel_filter'])
+                dsa = preadu.get_rx_attenuation(nrx=rx_id)
+                # Equalization
+                if not opts.eqvalue == "":
+                    print("Equalization of TPM-%02d Input Channel Fibre %02d to RF Power %3.1f dBm" %
+                          (tpm + 1, chan + 1, float(opts.eqvalue)))
+                    for k in range(3):
+                        rms = get_rms(tile=tpm_station.tiles[tpm], version=board_version)
+                        power = adu_power(rms[rx_id])
+                        if power == (-np.inf):
+                            power = -30
+                        dsa = bound(int(round(dsa + (power - float(opts.eqvalue)))))
+                        preadu.set_rx_attenuation(nrx=rx_id, att=dsa)
+                        tpm_station.tiles[tpm].tpm.tpm_preadu[preadu_id].channel_filters[channel_filter] = \
+                            preadu.get_register_value(nrx=rx_id)
+                        tpm_station.tiles[tpm].tpm.tpm_preadu[preadu_id].write_configuration()
+                        time.sleep(1)
+                if fw_map['pol'].upper() == "RF-2":
+                    pair_dsa.setdefault((tpm, chan), [0, 0])[0] = dsa
+                else:
+                    pair_dsa.setdefault((tpm, chan), [0, 0])[1] = dsa
+
+    path = opts.dir
+    if not path[-1] == "/":
+        path += "/"
+    data_ora = datetime.datetime.strftime(datetime.datetime.utcnow(), "%Y-%m-%d_%H%M%S")
+    hdf5_file = ""
+    if opts.hdf5:
+        if not os.path.exists(path + "DATA"):
+            os.mkdir(path + "DATA")
+        hdf5_file = path + "DATA/%s_PDL_%s.hdf5" % (data_ora, opts.title if opts.title else "%d_FIBRES" % len(pairs))
+    # Only a single fibre is plotted, full station sweeps run unattended
+    plot = None
+    if not opts.headless and len(pairs) == 1:
+        plot = PdlPlot(pairs[0], duration=opts.duration, ylim=opts.ylim, autoy=opts.autoscale,
+                       dsa=pair_dsa[pairs[0]], title=opts.title)
 
     if opts.daq:
-        data = runDAQ(opts.dir, chan=(opts.channel - 1), tpm=(opts.tpm - 1), duration=opts.duration,
-                      interval=opts.interval, resolution=opts.resolution, band=band)
+        runner = runDAQ(opts.dir, pairs=pairs, duration=opts.duration, resolution=opts.resolution, band=band,
+                        hdf5_file=hdf5_file, plot=plot)
     else:
-        data = runRms(chan=(opts.channel - 1), tpm=(opts.tpm - 1), duration=opts.duration, interval=opts.interval,
-                      ylim=opts.ylim, autoy=opts.autoscale, version=board_version)
-    if len(data['Pol-X']):
-        path = opts.dir
-        if not path[-1] == "/":
-            path += "/"
+        runner = runRms(pairs=pairs, duration=opts.duration, interval=opts.interval, hdf5_file=hdf5_file, plot=plot)
+    if plot is not None:
+        plt.ioff()
+    if runner is not None and runner.stats.count:
         if not os.path.exists(path + "DATA"):
             os.mkdir(path + "DATA")
-        data_ora = datetime.datetime.strftime(datetime.datetime.utcnow(), "%Y-%m-%d_%H%M%S")
-        if opts.title == "":
-            fname = path + "DATA/%s_PDL_TPM-%02d_INPUT-%02d.txt" % (data_ora, opts.tpm, opts.channel)
-        else:
-            fname = path + "DATA/%s_PDL_%s.txt" % (data_ora, opts.title)
-        with open(fname, "w") as f:
-            f.write("Timestamp\tPol-Y\tPol-X\tDSA (Y-X)\t%d\t%d\n" % (dsa_y, dsa_x))
-            for i in range(len(data['tstamp'])):
-                f.write("%f\t%6.3f\t%6.3f\n" % (data['tstamp'][i], data['Pol-Y'][i], data['Pol-X'][i]))
-        if not os.path.exists(path + "PICTURES"):
-            os.mkdir(path + "PICTURES")
-        #plt.title("PDL of Fibre #%d are --> Pol-X %3.2f dB,  Pol-Y %3.2f dB" % (opts.channel, pdl_x, pdl_y))
-        if opts.title == "":
-            fname = path + "PICTURES/%s_PDL_TPM-%02d_INPUT-%02d.png" % (data_ora, opts.tpm, opts.channel)
-        else:
-            fname = path + "PICTURES/%s_PDL_%s.png" % (data_ora, opts.title)
-        plt.savefig(fname)
-        plt.show()
+        pdl = runner.stats.pdl()
+        for k, (tpm, chan) in enumerate(runner.pairs):
+            if len(pairs) == 1 and not opts.title == "":
+                name = opts.title
+            elif not opts.title == "":
+                name = "%s_TPM-%02d_INPUT-%02d" % (opts.title, tpm + 1, chan + 1)
+            else:
+                name = "TPM-%02d_INPUT-%02d" % (tpm + 1, chan + 1)
+            fname = path + "DATA/%s_PDL_%s.txt" % (data_ora, name)
+            t, pol_x, pol_y = runner.series((tpm, chan))
+            with open(fname, "w") as f:
+                f.write("Timestamp\tPol-Y\tPol-X\tDSA (Y-X)\t%d\t%d\n" % (pair_dsa[(tpm, chan)][1],
+                                                                       pair_dsa[(tpm, chan)][0]))
+                for i in range(len(t)):
+                    f.write("%f\t%6.3f\t%6.3f\n" % (t[i], pol_y[i], pol_x[i]))
+            print("TPM-%02d Input Fibre %02d  PDL  Pol-X: %.3f dB,  Pol-Y: %.3f dB" %
+                  (tpm + 1, chan + 1, pdl[2 * k], pdl[2 * k + 1]))
+        if plot is not None:
+            if not os.path.exists(path + "PICTURES"):
+                os.mkdir(path + "PICTURES")
+            plt.savefig(path + "PICTURES/%s_PDL_%s.png" % (data_ora, name))
+            plt.show()
     else:
         print("\nReturned data length zero. Something went wrong!\n")
-
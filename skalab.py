@@ -20,23 +20,22 @@ __version__ = "1.3.1"
 __release__ = "2023-03-22"
 __maintainer__ = "Andrea Mattana"
 
+import time
+# Startup reference for the startup report
+T_START = time.time()
 import shutil
 import sys
 import os
+import importlib
 import threading
-import time
 from threading import Thread
 
 import numpy as np
 import configparser
 from PyQt5 import QtCore, QtGui, QtWidgets, uic
 
-from skalab_live import Live
-from skalab_playback import Playback
-from skalab_subrack import Subrack
-from skalab_monitor import Monitor
-from skalab_station import SkalabStation
-from skalab_utils import parse_profile, getTextFromFile
+# The modules of the tabs (numpy, matplotlib, pyaavs, pydaq...) are imported when a tab is shown the first time
+from skalab_base import parse_profile, getTextFromFile, load_ui
 from pathlib import Path
 import logging
 logger = logging.getLogger()
@@ -49,6 +48,24 @@ profile_filename = "skalab.ini"
 
 COLORI = ["b", "g"]
 
+# Time spent importing the tab modules and building the tabs, for the startup report
+STARTUP_TIMES = []
+
+
+def timed(what, func, *args, **kwargs):
+    t_start = time.time()
+    result = func(*args, **kwargs)
+    STARTUP_TIMES.append((what, time.time() - t_start))
+    return result
+
+
+def startup_report():
+    """ Text report of the startup times, the first paint is measured from the start of the process """
+    report = "\nSKALAB Startup Report\n"
+    for what, t in STARTUP_TIMES:
+        report += "%-40s %7.3f s\n" % (what, t)
+    return report
+
 configuration = {'tiles': None,
                  'time_delays': None,
                  'station': {
@@ -95,12 +112,13 @@ configuration = {'tiles': None,
 class SkaLab(QtWidgets.QMainWindow):
     """ Main UI Window class """
 
-    def __init__(self, uiFile, profile="Default"):
+    def __init__(self, uiFile, profile="Default", report=False):
         """ Initialise main window """
         super(SkaLab, self).__init__()
         #super(SkalabBase, self).__init__(App="", Profile="", Path="")
         # Load window file
-        self.wg = uic.loadUi(uiFile)
+        self.report = report
+        self.wg = timed("load " + uiFile, load_ui, uiFile)
         self.setCentralWidget(self.wg)
         self.resize(1210, 970)
         self.setWindowTitle("The SKA in LAB Project")
@@ -130,45 +148,19 @@ class SkaLab(QtWidgets.QMainWindow):
         self.wg.qlabel_sw_release.setText("Released on: " + __release__)
         self.wg.qlabel_sw_author.setText("Author: " + __author__)
 
-        # Instantiating Station Tab. This must be always done as first
-        QtWidgets.QTabWidget.setTabVisible(self.wg.qtabMain, self.tabStationIndex, True)
-        self.wgStationLayout = QtWidgets.QVBoxLayout()
-        self.wgStation = SkalabStation(uiFile="Gui/skalab_station.ui", size=[1190, 936],
-                           profile=self.profile['Base']['station'],
-                           swpath=default_app_dir)
-        self.wgStationLayout.addWidget(self.wgStation)
-        self.wg.qwStation.setLayout(self.wgStationLayout)
-        self.config_file = self.wgStation.profile['Station']['station_file']
-
-        QtWidgets.QTabWidget.setTabVisible(self.wg.qtabMain, self.tabLiveIndex, True)
-        self.wgLiveLayout = QtWidgets.QVBoxLayout()
-        self.wgLive = Live(self.config_file, "Gui/skalab_live.ui", size=[1190, 936],
-                           profile=self.profile['Base']['live'],
-                           swpath=default_app_dir)
-        self.wgLive.signalTemp.connect(self.wgLive.updateTempPlot)
-        self.wgLive.signalRms.connect(self.wgLive.updateRms)
-
-        self.wgLiveLayout.addWidget(self.wgLive)
-        self.wg.qwLive.setLayout(self.wgLiveLayout)
-
-        QtWidgets.QTabWidget.setTabVisible(self.wg.qtabMain, self.tabPlayIndex, True)
-        self.wgPlayLayout = QtWidgets.QVBoxLayout()
-        self.wgPlay = Playback(self.config_file, "Gui/skalab_playback.ui", size=[1190, 936],
-                               profile=self.profile['Base']['playback'],
-                               swpath=default_app_dir)
-        self.wgPlayLayout.addWidget(self.wgPlay)
-        self.wg.qwPlay.setLayout(self.wgPlayLayout)
-
-        QtWidgets.QTabWidget.setTabVisible(self.wg.qtabMain, self.tabSubrackIndex, True)
-        self.wgSubrackLayout = QtWidgets.QVBoxLayout()
-        self.wgSubrack = Subrack(uiFile="Gui/skalab_subrack.ui", size=[1190, 936],
-                                 profile=self.profile['Base']['subrack'],
-                                 swpath=default_app_dir)
-        self.wgSubrackLayout.addWidget(self.wgSubrack)
-        self.wg.qwSubrack.setLayout(self.wgSubrackLayout)
-        self.wgSubrack.signalTlm.connect(self.wgSubrack.updateTlm)
-        # self.wgSubrack.signal_to_monitor.connect(self.wgMonitor.read_subrack_attribute)
-        # self.wgSubrack.signal_to_monitor_for_tpm.connect(self.wgMonitor.tpm_status_changed)
+        # The tabs are built the first time they are shown, the Station always first
+        self.wgStation = None
+        self.wgLive = None
+        self.wgPlay = None
+        self.wgSubrack = None
+        self.tpm_ips = []
+        self.tabs = {self.tabStationIndex: self.buildStation,
+                     self.tabSubrackIndex: self.buildSubrack,
+                     self.tabLiveIndex: self.buildLive,
+                     self.tabPlayIndex: self.buildPlay}
+        for index in self.tabs.keys():
+            QtWidgets.QTabWidget.setTabVisible(self.wg.qtabMain, index, True)
+        self.wg.qtabMain.currentChanged.connect(self.tabChanged)
 
         self.show()
         self.load_events()
@@ -200,6 +192,104 @@ class SkaLab(QtWidgets.QMainWindow):
         self.procUpdate = Thread(target=self.procUpdateChildren)
         self.procUpdate.start()
         # print("Start Thread Skalab procUpdateChildren")
+        self.tabChanged(self.wg.qtabMain.currentIndex())
+        if self.report:
+            QtCore.QTimer.singleShot(0, self.firstPaint)
+
+    def firstPaint(self):
+        STARTUP_TIMES.append(("first paint (from process start)", time.time() - T_START))
+        print(startup_report())
+
+    def importTab(self, name):
+        """ Import the module of a tab, the number of modules it pulls in goes to the startup report """
+        nof_modules = len(sys.modules)
+        t_start = time.time()
+        module = importlib.import_module(name)
+        if len(sys.modules) > nof_modules:
+            STARTUP_TIMES.append(("import %s (+%d modules)" % (name, len(sys.modules) - nof_modules),
+                                  time.time() - t_start))
+        return module
+
+    def tabChanged(self, index):
+        if index in self.tabs.keys():
+            QtWidgets.QApplication.setOverrideCursor(QtCore.Qt.WaitCursor)
+            try:
+                self.tabs[index]()
+            finally:
+                QtWidgets.QApplication.restoreOverrideCursor()
+
+    def buildStation(self):
+        if self.wgStation is None:
+            t_start = time.time()
+            SkalabStation = self.importTab("skalab_station").SkalabStation
+            self.wgStationLayout = QtWidgets.QVBoxLayout()
+            self.wgStation = SkalabStation(uiFile="Gui/skalab_station.ui", size=[1190, 936],
+                                           profile=self.profile['Base']['station'],
+                                           swpath=default_app_dir)
+            self.wgStation.tpm_ips_from_subrack = self.tpm_ips.copy()
+            self.wgStationLayout.addWidget(self.wgStation)
+            self.wg.qwStation.setLayout(self.wgStationLayout)
+            self.config_file = self.wgStation.profile['Station']['station_file']
+            self.tabBuilt("Station", t_start)
+        return self.wgStation
+
+    def buildLive(self):
+        if self.wgLive is None:
+            # Live needs the station file and sends the levels to the Station map
+            station = self.buildStation()
+            t_start = time.time()
+            Live = self.importTab("skalab_live").Live
+            self.wgLiveLayout = QtWidgets.QVBoxLayout()
+            self.wgLive = Live(self.config_file, "Gui/skalab_live.ui", size=[1190, 936],
+                               profile=self.profile['Base']['live'],
+                               swpath=default_app_dir)
+            self.wgLive.signalTemp.connect(self.wgLive.updateTempPlot)
+            self.wgLive.signalRms.connect(self.wgLive.updateRms)
+            self.wgLive.signalLevels.connect(station.updateMapLevels)
+            # The levels come in the ADU order of the preADU version used by Live
+            station.setupMapLevels(version=self.wgLive.preadu_version)
+            station.signalInitDone.connect(self.wgLive.invalidatePreadu)
+            if self.tpm_ips:
+                self.wgLive.setupNewTilesIPs(self.tpm_ips)
+            self.wgLiveLayout.addWidget(self.wgLive)
+            self.wg.qwLive.setLayout(self.wgLiveLayout)
+            self.tabBuilt("Live", t_start)
+        return self.wgLive
+
+    def buildPlay(self):
+        if self.wgPlay is None:
+            self.buildStation()
+            t_start = time.time()
+            Playback = self.importTab("skalab_playback").Playback
+            self.wgPlayLayout = QtWidgets.QVBoxLayout()
+            self.wgPlay = Playback(self.config_file, "Gui/skalab_playback.ui", size=[1190, 936],
+                                   profile=self.profile['Base']['playback'],
+                                   swpath=default_app_dir)
+            self.wgPlayLayout.addWidget(self.wgPlay)
+            self.wg.qwPlay.setLayout(self.wgPlayLayout)
+            self.tabBuilt("Playback", t_start)
+        return self.wgPlay
+
+    def buildSubrack(self):
+        if self.wgSubrack is None:
+            t_start = time.time()
+            Subrack = self.importTab("skalab_subrack").Subrack
+            self.wgSubrackLayout = QtWidgets.QVBoxLayout()
+            self.wgSubrack = Subrack(uiFile="Gui/skalab_subrack.ui", size=[1190, 936],
+                                     profile=self.profile['Base']['subrack'],
+                                     swpath=default_app_dir)
+            self.wgSubrackLayout.addWidget(self.wgSubrack)
+            self.wg.qwSubrack.setLayout(self.wgSubrackLayout)
+            self.wgSubrack.signalTlm.connect(self.wgSubrack.updateTlm)
+            # self.wgSubrack.signal_to_monitor.connect(self.wgMonitor.read_subrack_attribute)
+            # self.wgSubrack.signal_to_monitor_for_tpm.connect(self.wgMonitor.tpm_status_changed)
+            self.tabBuilt("Subrack", t_start)
+        return self.wgSubrack
+
+    def tabBuilt(self, name, t_start):
+        STARTUP_TIMES.append(("build %s tab" % name, time.time() - t_start))
+        if self.report:
+            print("%s tab built in %3.3f s" % (name, time.time() - t_start))
 
     def load_events(self):
         self.wg.qbutton_profile_save.clicked.connect(lambda: self.save_profile(self.wg.qcombo_profiles.currentText()))
@@ -210,16 +300,16 @@ class SkaLab(QtWidgets.QMainWindow):
     def procUpdateChildren(self):
         while True:
             # If a connection to the Subrack has been estabilished update the list of TPM IPs
-            if self.wgSubrack.updateRequest:
+            if self.wgSubrack is not None and self.wgSubrack.updateRequest:
                 self.wgSubrack.updateRequest = False
                 #print("RECEIVED TPM IPs: ", self.wgSubrack.tpm_ips)
-                self.wgStation.tpm_ips_from_subrack = self.wgSubrack.tpm_ips.copy()
-                self.wgLive.setupNewTilesIPs(self.wgSubrack.tpm_ips)
+                # Kept for the tabs not built yet
+                self.tpm_ips = self.wgSubrack.tpm_ips.copy()
+                if self.wgStation is not None:
+                    self.wgStation.tpm_ips_from_subrack = self.wgSubrack.tpm_ips.copy()
+                if self.wgLive is not None:
+                    self.wgLive.setupNewTilesIPs(self.wgSubrack.tpm_ips)
 
-            if self.wgLive.updateRequest:
-                pass
-            if self.wgStation.updateRequest:
-                pass
             if self.stopThreads:
                 #print("Stopping Thread SKALAB Update children")
                 break
@@ -256,13 +346,12 @@ class SkaLab(QtWidgets.QMainWindow):
     def reload_profile(self, profile):
         self.load_profile(profile=profile)
         if self.profile.sections():
-            if self.profile['Base']['subrack']:
+            # The tabs not built yet will read the new profile when they are shown
+            if self.profile['Base']['subrack'] and self.wgSubrack is not None:
                 self.wgSubrack.load_profile(App="subrack", Profile=self.profile['Base']['subrack'], Path=default_app_dir)
-            if self.profile['Base']['monitor']:
-                self.wgMonitor.load_profile(App="monitor", Profile=self.profile['Base']['monitor'], Path=default_app_dir)
-            if self.profile['Base']['live']:
+            if self.profile['Base']['live'] and self.wgLive is not None:
                 self.wgLive.load_profile(App="live", Profile=self.profile['Base']['live'], Path=default_app_dir)
-            if self.profile['Base']['playback']:
+            if self.profile['Base']['playback'] and self.wgPlay is not None:
                 self.wgPlay.load_profile(App="playback", Profile=self.profile['Base']['playback'], Path=default_app_dir)
 
     def delete_profile(self, profile):
@@ -374,12 +463,18 @@ class SkaLab(QtWidgets.QMainWindow):
         with open(conf_path, 'w') as configfile:
             conf.write(configfile)
 
+    def tabProfile(self, wg, app):
+        """ Profile in use by a tab, the one of the SKALAB profile if the tab is not built yet """
+        if wg is None:
+            return self.profile['Base'][app]
+        return wg.profile['Base']['profile']
+
     def save_profile(self, this_profile, reload=True):
         self.make_profile(profile=this_profile,
-                          subrack=self.wgSubrack.profile['Base']['profile'],
-                          live=self.wgLive.profile['Base']['profile'],
-                          playback=self.wgPlay.profile['Base']['profile'],
-                          station=self.wgStation.profile['Base']['profile'],
+                          subrack=self.tabProfile(self.wgSubrack, 'subrack'),
+                          live=self.tabProfile(self.wgLive, 'live'),
+                          playback=self.tabProfile(self.wgPlay, 'playback'),
+                          station=self.tabProfile(self.wgStation, 'station'),
                           config=self.config_file)
         if reload:
             self.load_profile(profile=this_profile)
@@ -400,10 +495,9 @@ class SkaLab(QtWidgets.QMainWindow):
             event.accept()
             # print("Total Threads to close: ", threading.activeCount())
             self.stopThreads = True
-            self.wgLive.cmdClose()
-            self.wgStation.cmdClose()
-            self.wgSubrack.cmdClose()
-            self.wgPlay.cmdClose()
+            for wg in [self.wgLive, self.wgStation, self.wgSubrack, self.wgPlay]:
+                if wg is not None:
+                    wg.cmdClose()
             time.sleep(1)
             # print("Still active Threads: ", threading.activeCount())
             if self.wg.qradio_autosave.isChecked():
@@ -422,6 +516,9 @@ if __name__ == "__main__":
     parser = OptionParser(usage="usage: %station_subrack [options]")
     parser.add_option("--profile", action="store", dest="profile",
                       type="str", default="Default", help="Skalab Profile to load")
+    parser.add_option("--startup-report", action="store_true", dest="startup_report",
+                      default=False, help="Print the time spent loading each module and tab "
+                                          "(use python -X importtime for a per module breakdown)")
     (opt, args) = parser.parse_args(argv[1:])
 
     app = QtWidgets.QApplication(sys.argv)
@@ -432,5 +529,5 @@ if __name__ == "__main__":
     else:
         profile = opt.profile
 
-    window = SkaLab("Gui/skalab_main.ui", profile=profile)
+    window = SkaLab("Gui/skalab_main.ui", profile=profile, report=opt.startup_report)
     sys.exit(app.exec_())
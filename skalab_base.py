@@ -1,15 +1,93 @@
 import os
+import zlib
+import types
 import configparser
 import shutil
+import importlib.util
+from pathlib import Path
+from xml.etree import ElementTree
 from PyQt5 import QtCore, QtGui, QtWidgets, uic
 
+# Where the .ui files compiled to Python are kept
+UI_CACHE_DIR = str(Path.home()) + "/.skalab/cache/ui/"
+
+# Form classes of the .ui files compiled so far, by cached module name
+UI_FORMS = {}
+
+
+def parse_profile(config=""):
+    confparser = configparser.ConfigParser()
+    confparser.read(config)
+    return confparser
+
+
+def getTextFromFile(fname):
+    if os.path.exists(fname):
+        with open(fname) as f:
+            text = f.read()
+        return text
+
+
+def compile_ui(ui_file, cache_dir=UI_CACHE_DIR):
+    """
+    Form class and top level widget class of a .ui file compiled to Python.
+
+    The file is compiled once into the cache directory, the cached module carries the modification time of
+    the .ui file in its name so it is used only while the .ui file is unchanged. Returns None for the files
+    the compiled code can't reproduce (images and custom widgets are found relative to the .ui file).
+    """
+    src = os.path.abspath(ui_file)
+    tag = "%s_%x_%d" % (os.path.basename(src).replace(".", "_"), zlib.crc32(src.encode()),
+                        os.stat(src).st_mtime_ns)
+    fname = os.path.join(cache_dir, tag + ".py")
+    if fname not in UI_FORMS.keys():
+        if not os.path.exists(fname):
+            with open(src) as f:
+                text = f.read()
+            if ("<pixmap>" in text) or ("<iconset" in text) or ("<customwidgets>" in text):
+                return None
+            top_level = ElementTree.fromstring(text).find("widget").get("class")
+            os.makedirs(cache_dir, exist_ok=True)
+            # Modules compiled from older versions of the same file are dropped
+            prefix = tag.rsplit("_", 1)[0] + "_"
+            for f in os.listdir(cache_dir):
+                if f.startswith(prefix) and f.endswith(".py"):
+                    os.remove(os.path.join(cache_dir, f))
+            with open(fname + ".tmp", "w") as f:
+                uic.compileUi(src, f)
+                f.write("\nTOP_LEVEL_CLASS = %r\n" % top_level)
+            os.replace(fname + ".tmp", fname)
+        spec = importlib.util.spec_from_file_location(tag, fname)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        form = [v for k, v in vars(module).items() if k.startswith("Ui_")][0]
+        UI_FORMS[fname] = (form, module.TOP_LEVEL_CLASS)
+    return UI_FORMS[fname]
+
+
+def load_ui(ui_file, baseinstance=None):
+    """ Same as uic.loadUi, but from the compiled .ui file when possible (no XML parsing at every start) """
+    try:
+        compiled = compile_ui(ui_file)
+    except Exception:
+        # A read only home is not a reason to fail, the .ui file is just parsed as before
+        compiled = None
+    if compiled is None:
+        return uic.loadUi(ui_file, baseinstance)
+    form, top_level = compiled
+    widget = baseinstance if baseinstance is not None else getattr(QtWidgets, top_level)()
+    # The children are stored on the 'self' of setupUi, here the widget itself as uic.loadUi does
+    widget.retranslateUi = types.MethodType(form.retranslateUi, widget)
+    form.setupUi(widget, widget)
+    return widget
+
 
 class SkalabBase(QtWidgets.QMainWindow):
     def __init__(self, App="", Profile="", Path="", parent=None):
         super().__init__()
         self.connected = False
         self.profile = {}
-        self.wgProfile = uic.loadUi("Gui/skalab_profile.ui", parent)
+        self.wgProfile = load_ui("Gui/skalab_profile.ui", parent)
         self.wgProfile.qbutton_load.clicked.connect(lambda: self.load())
         self.wgProfile.qbutton_saveas.clicked.connect(lambda: self.save_as_profile())
         self.wgProfile.qbutton_save.clicked.connect(lambda: self.save_profile())
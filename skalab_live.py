@@ -1,6 +1,6 @@
 #!/usr/bin/env python
 import copy
-from skalab_base import SkalabBase
+from skalab_base import SkalabBase, load_ui
 from skalab_log import SkalabLog
 import datetime
 import glob
@@ -21,11 +21,13 @@ from PyQt5.QtCore import Qt
 import pydaq.daq_receiver as daq
 from skalab_utils import MiniPlots, calcolaspettro, closest, MyDaq, get_if_name, BarPlot, ChartPlots, getTextFromFile
 from skalab_utils import parse_profile, ts_to_datestring, dt_to_timestamp, Archive, COLORI, decodeChannelList
-from skalab_preadu import Preadu, PreaduGui, bound
+from skalab_utils import chart_history_from_profile, IntegratedSpectraReader, spectra_db, SpectraWaterfall
+from skalab_utils import RawDataCatalogue, CHANNEL_INTEG_RE
+from skalab_preadu import Preadu, PreaduGui, PreaduEqualizer, bound
+from skalab_preadu import station_snapshot, save_snapshot, load_snapshot, restore_snapshot
 from pyaavs.station import Station
 from pyaavs import station
 from threading import Thread
-from pydaq.persisters import ChannelFormatFileManager, FileDAQModes
 
 default_app_dir = str(Path.home()) + "/.skalab/"
 default_profile = "Default"
@@ -83,10 +85,12 @@ class Live(SkalabBase):
     # Signal for Slots
     signalRms = QtCore.pyqtSignal()
     signalTemp = QtCore.pyqtSignal()
+    # ADU RMS of all the tiles (tiles x 32), for the station map
+    signalLevels = QtCore.pyqtSignal(object)
 
     def __init__(self, config="", uiFile="", profile="Default", size=[1190, 936], swpath=default_app_dir):
         """ Initialise main window """
-        self.wg = uic.loadUi(uiFile)
+        self.wg = load_ui(uiFile)
 
         self.wgProBox = QtWidgets.QWidget(self.wg.qtab_conf)
         self.wgProBox.setGeometry(QtCore.QRect(1, 1, 800, 860))
@@ -136,7 +140,6 @@ class Live(SkalabBase):
             self.wg.qcombo_preadu_version.setCurrentIndex(0)
         self.preadu = []
         self.preaduConfUpdated = False
-        self.eq_armed = False
 
         self.writing_preadu = False
         self.wg.ctrl_preadu.hide()
@@ -161,6 +164,19 @@ class Live(SkalabBase):
         self.rms = []
         self.dsa = []
         self.preaduConf = []
+        # Every how many cycles the PreADU registers are read again from the TPMs (0: only when invalidated)
+        self.preadu_refresh = 10
+        if 'preadu_refresh' in self.profile['Live'].keys():
+            self.preadu_refresh = int(self.profile['Live']['preadu_refresh'])
+        self.preadu_cycle = 0
+        self.equalizer = None
+        self.eq_tolerance = 0.5
+        self.eq_max_iter = 5
+        try:
+            self.eq_tolerance = float(self.profile['Live']['eq_tolerance'])
+            self.eq_max_iter = int(self.profile['Live']['eq_max_iter'])
+        except:
+            pass
 
         self.stopThreads = False
         self.skipThreadPause = False
@@ -179,8 +195,19 @@ class Live(SkalabBase):
         self.monitor_daq = None
         self.initMonitor = True
         self.monitor_tstart = 0
-        self.monitor_file_manager = None
+        self.monitor_readers = {}
+        # Files of the integrated spectra directory, shared by the readers of all the tiles
+        self.monitor_catalogue = RawDataCatalogue(pattern=CHANNEL_INTEG_RE)
         self.monitorPrecTstamp = 0
+        # Integrated spectra history, all the tiles or only the one selected
+        self.waterfall = None
+        self.waterfall_depth = 256
+        self.waterfall_all_tiles = False
+        try:
+            self.waterfall_depth = int(self.profile['Live']['waterfall_depth'])
+            self.waterfall_all_tiles = self.profile['Live']['waterfall_all_tiles'].lower() in ["true", "1", "yes"]
+        except:
+            pass
         self.monitor_asse_x = np.arange(512) * 400/512.
         #self.procMonitor = Thread(target=self.procRunMonitor)
         #self.procMonitor.start()
@@ -229,6 +256,8 @@ class Live(SkalabBase):
 
         self.wg.qbutton_preadu_setup.clicked.connect(lambda: self.setupPreadu(self.wg.qcombo_preadu_version.currentIndex()))
         self.wg.qbutton_equalize.clicked.connect(lambda: self.equalization())
+        self.wpreadu.button_snapshot.clicked.connect(lambda: self.savePreaduSnapshot())
+        self.wpreadu.button_restore.clicked.connect(lambda: self.restorePreaduSnapshot())
         self.wg.qline_channels.textChanged.connect(lambda: self.channelsListModified())
 
         self.wg.qradio_rms_adu.toggled.connect(lambda: self.customizeRms())
@@ -244,6 +273,11 @@ class Live(SkalabBase):
         self.wg.qradio_preadu.toggled.connect(lambda: self.check_preadu())
         self.wg.qcombo_chart.currentIndexChanged.connect(lambda: self.switchChart())
         self.wg.qcombo_tpm.currentIndexChanged.connect(lambda: self.updatePreadu())
+        self.wg.qcombo_int_view.currentIndexChanged.connect(lambda: self.monitorViewChanged())
+        self.wg.qcombo_int_pol.currentIndexChanged.connect(lambda: self.plotMonitor(forcePlot=True))
+        self.wg.qline_int_level_min.editingFinished.connect(lambda: self.plotMonitor(forcePlot=True))
+        self.wg.qline_int_level_max.editingFinished.connect(lambda: self.plotMonitor(forcePlot=True))
+        self.wg.qline_int_freq.editingFinished.connect(lambda: self.plotMonitor(forcePlot=True))
 
     def populate_help(self, uifile="Gui/skalab_live.ui"):
         with open(uifile) as f:
@@ -289,6 +323,7 @@ class Live(SkalabBase):
             self.wg.ctrl_spectra.show()
             self.wg.ctrl_preadu.hide()
             self.wg.ctrl_temperature.hide()
+            self.wg.ctrl_int_spectra.hide()
             self.wg.ctrl_rms.hide()
             # Show only spectra tstamp
             self.wg.qlabel_tstamp_spectra.show()
@@ -318,6 +353,7 @@ class Live(SkalabBase):
             self.wg.ctrl_preadu.hide()
             self.wg.ctrl_temperature.hide()
             self.wg.ctrl_rms.hide()
+            self.wg.ctrl_int_spectra.show()
             # Show only int spectra tstamp
             self.wg.qlabel_tstamp_int_spectra.show()
             self.wg.qlabel_tstamp_spectra.hide()
@@ -345,6 +381,7 @@ class Live(SkalabBase):
             self.wg.ctrl_spectra.hide()
             self.wg.ctrl_preadu.hide()
             self.wg.ctrl_temperature.hide()
+            self.wg.ctrl_int_spectra.hide()
             self.wg.ctrl_rms.show()
             # Show only spectra tstamp
             self.wg.qlabel_tstamp_spectra.hide()
@@ -373,6 +410,7 @@ class Live(SkalabBase):
             # Show only spectra ctrl
             #self.wg.ctrl_rms.hide()
             self.wg.ctrl_temperature.show()
+            self.wg.ctrl_int_spectra.hide()
             self.wg.ctrl_spectra.hide()
             self.wg.ctrl_preadu.hide()
             self.wg.ctrl_rms.hide()
@@ -401,6 +439,7 @@ class Live(SkalabBase):
         # Show only spectra ctrl
         #self.wg.ctrl_rms.hide()
         self.wg.ctrl_temperature.hide()
+        self.wg.ctrl_int_spectra.hide()
         self.wg.ctrl_spectra.hide()
         self.wg.ctrl_rms.hide()
         self.wg.ctrl_preadu.show()
@@ -462,6 +501,7 @@ class Live(SkalabBase):
                 for t in self.tpm_station.tiles:
                     status = status * t.is_programmed()
                     self.preadu += [Preadu(tpm=t, preadu_version=self.preadu_version)]
+                self.equalizer = PreaduEqualizer(self.preadu, self.readEqualizationRms, logger=self.logger.logger)
                 self.wpreadu.setConfiguration(conf=self.preadu[self.wg.qcombo_tpm.currentIndex()].readConfiguration())
                 if status:
                     self.tpm_station.tiles[0].get_temperature()
@@ -537,6 +577,8 @@ class Live(SkalabBase):
         self.wg.qbutton_connect.setText("OFFLINE")
         self.connected = False
         self.initMonitor = True
+        self.closeMonitorReaders()
+        self.waterfall = None
 
     def procRunDaq(self):
         while True:
@@ -592,8 +634,9 @@ class Live(SkalabBase):
                             self.logger.logger.info("Integrated Data Conf %s:%s on NIC %s" % (int_data_ip, int_data_port, int_data_if))
                             self.monitor_daq.initialise_daq()
                             self.monitor_daq.start_integrated_channel_data_consumer()
-                            self.monitor_file_manager = ChannelFormatFileManager(root_path=self.profile['Data']['integrated_spectra_path'],
-                                                                                 daq_mode=FileDAQModes.Integrated)
+                            self.closeMonitorReaders()
+                            self.waterfall = SpectraWaterfall(depth=self.waterfall_depth,
+                                                              nof_tiles=nof_tiles if self.waterfall_all_tiles else 1)
                             self.monitor_tstart = dt_to_timestamp(datetime.datetime.utcnow())
                             self.wg.qlabel_tstamp_int_spectra.setText("Started at " +
                                                                       ts_to_datestring(self.monitor_tstart) +
@@ -610,11 +653,13 @@ class Live(SkalabBase):
                         self.readTemperatures()
                         sleep(0.1)
                         self.tmpPreaduConf = []
+                        self.preadu_cycle = self.preadu_cycle + 1
+                        refresh = bool(self.preadu_refresh) and (self.preadu_cycle % self.preadu_refresh == 0)
                         for t in range(len(self.tpm_station.tiles)):
-                            time.sleep(0.05)
                             while self.preadu[t].Busy:
                                 time.sleep(0.1)
-                            self.tmpPreaduConf += [self.preadu[t].readConfiguration()]
+                            # Registers are read from the TPM only if not cached yet or at the refresh cycle
+                            self.tmpPreaduConf += [self.preadu[t].readConfiguration(force=refresh)]
                         if not self.preaduConf == self.tmpPreaduConf:
                             self.preaduConfUpdated = True
                         self.preaduConf = copy.deepcopy(self.tmpPreaduConf)
@@ -626,6 +671,8 @@ class Live(SkalabBase):
                         self.commBusy = False
                         self.signalTemp.emit()
                         self.signalRms.emit()
+                        if self.rms:
+                            self.signalLevels.emit(np.array(self.rms, dtype=float))
                 # except:
                 #     self.logger.logger.warning("Failed to get RMS and/or Temperature data!")
                 #     self.commBusy = False
@@ -643,77 +690,118 @@ class Live(SkalabBase):
                             #     self.preadu[self.wg.qcombo_tpm.currentIndex()].preadu.set_register_value(nrx=i, value=int("0x" + self.wpreadu.records[i]['value'].text(), 16))
                             # logging.debug(self.wpreadu.tpmConf, self.wpreadu.guiConf)
                             self.preadu[self.wg.qcombo_tpm.currentIndex()].write_configuration(self.wpreadu.guiConf)
+                            self.checkPreaduWrites(tiles=[self.wg.qcombo_tpm.currentIndex()])
                             self.wpreadu.write_armed = False
                             self.wpreadu.setConfiguration(self.wpreadu.guiConf)
                             time.sleep(0.2)
                             self.writing_preadu = False
-                        # Apply Equalization from Live Gui
-                        if self.eq_armed and self.connected:
-                            self.logger.logger.info("Applying Equalization")
-                            if self.wg.qradio_eq_this.isChecked():
-                                tiles = [self.wg.qcombo_tpm.currentIndex()]
-                            else:
-                                tiles = range(len(self.tpm_station.tiles))
-                            for t in tiles:
-                                #logging.debug("TILE-%02d" % (t+1))
-                                self.preadu[t].write_configuration(self.preaduConf[t])
-                                time.sleep(0.1)
-                            self.tmpPreaduConf = []
-                            for t in range(len(self.tpm_station.tiles)):
-                                time.sleep(0.05)
-                                while self.preadu[t].Busy:
-                                    time.sleep(0.1)
-                                self.tmpPreaduConf += [self.preadu[t].readConfiguration()]
-                            if not self.preaduConf == self.tmpPreaduConf:
-                                self.preaduConf = copy.deepcopy(self.tmpPreaduConf)
-                            self.updatePreadu()
-                                #self.wpreadu.setConfiguration(conf=self.preaduConf[self.wg.qcombo_tpm.currentIndex()])
-                            self.eq_armed = False
-                            self.writing_preadu = False
 
             if self.stopThreads:
                 #print("Stopping Thread Live ReadRMS")
                 break
             sleep(1)
 
+    def closeMonitorReaders(self):
+        for reader in self.monitor_readers.values():
+            reader.close()
+        self.monitor_readers = {}
+
+    def monitorSlot(self):
+        """ Waterfall slot of the tile selected """
+        if self.waterfall_all_tiles:
+            return self.wg.qcombo_tpm.currentIndex()
+        return 0
+
+    def readMonitor(self):
+        """ Add the new integrations of the tiles followed to the waterfall """
+        current = self.wg.qcombo_tpm.currentIndex()
+        if self.waterfall_all_tiles:
+            tiles = range(len(self.waterfall.count))
+        else:
+            tiles = [current]
+            if current not in self.monitor_readers.keys():
+                # Only the selected tile is kept, its history starts again
+                self.closeMonitorReaders()
+                self.waterfall.clear(0)
+        # The directory is scanned once for all the tiles
+        self.monitor_catalogue.open(self.profile['Data']['integrated_spectra_path'])
+        for t in tiles:
+            if t not in self.monitor_readers.keys():
+                self.monitor_readers[t] = IntegratedSpectraReader(tile=t, backlog=self.waterfall.depth,
+                                                                  catalogue=self.monitor_catalogue)
+            monitorData, timestamps = self.monitor_readers[t].read()
+            if monitorData is not None:
+                self.waterfall.add(t if self.waterfall_all_tiles else 0, timestamps, spectra_db(monitorData))
+
+    def monitorLevels(self):
+        try:
+            return [float(self.wg.qline_int_level_min.text()), float(self.wg.qline_int_level_max.text())]
+        except ValueError:
+            return [0, 40]
+
+    def monitorViewChanged(self):
+        # Curves and images don't share the axes
+        self.monitorPlots.plotClear()
+        self.plotMonitor(forcePlot=True)
+
     def plotMonitor(self, forcePlot=False):
-        if self.monitor_daq is not None:
-            ipath = self.profile['Data']['integrated_spectra_path']
-            if ipath[-1] != "/":
-                ipath += "/"
-            if glob.glob(ipath + "*channel_integ_*hdf5"):
-                remap = [0, 1, 2, 3, 8, 9, 10, 11, 15, 14, 13, 12, 7, 6, 5, 4]
-                monitorData, timestamps = self.monitor_file_manager.read_data(tile_id=self.wg.qcombo_tpm.currentIndex(),
-                                                                              n_samples=1,
-                                                                              sample_offset=-1)
-                if timestamps[0][0] - self.monitor_tstart >= (8 * float(self.tpm_station.configuration['station']['channel_integration_time'])):
-                    if not timestamps[0][0] == self.monitorPrecTstamp or forcePlot:
-                        self.wg.qlabel_tstamp_int_spectra.setText(ts_to_datestring(timestamps[0][0]) +
-                                                                  " (Period: %3.1f secs)" %
-                                                                  (8 * float(self.tpm_station.configuration['station']['channel_integration_time'])))
-                        #logging.debug("PLOTTO ORA IL ", ts_to_datestring(timestamps[0][0]))
-                        for i in range(16):
-                            # Plot X Pol
-                            spettro = monitorData[:, remap[i], 0, -1]
-                            with np.errstate(divide='ignore'):
-                                spettro = 10 * np.log10(np.array(spettro))
-                            self.monitorPlots.plotCurve(self.monitor_asse_x, spettro, i, xAxisRange=[1, 400],
-                                                        yAxisRange=[0, 40], title="INPUT-%02d" % i,
-                                                        xLabel="MHz", yLabel="dB", colore="b", grid=True, lw=1,
-                                                        show_line=True)
-                            # Plot Y Pol
-                            spettro = monitorData[:, remap[i], 1, -1]
-                            with np.errstate(divide='ignore'):
-                                spettro = 10 * np.log10(np.array(spettro))
-                            self.monitorPlots.plotCurve(self.monitor_asse_x, spettro, i, xAxisRange=[1, 400],
-                                                        yAxisRange=[0, 40], colore="g", grid=True, lw=1,
-                                                        show_line=True)
+        if self.monitor_daq is not None and self.waterfall is not None:
+            try:
+                self.readMonitor()
+            except Exception as e:
+                self.logger.logger.warning("Failed to read the integrated spectra: " + str(e))
+                return
+            slot = self.monitorSlot()
+            tstamp, spettri = self.waterfall.latest(slot)
+            if tstamp is not None:
+                period = 8 * float(self.tpm_station.configuration['station']['channel_integration_time'])
+                if tstamp - self.monitor_tstart >= period:
+                    if not tstamp == self.monitorPrecTstamp or forcePlot:
+                        self.wg.qlabel_tstamp_int_spectra.setText(ts_to_datestring(tstamp) +
+                                                                  " (Period: %3.1f secs)" % period)
+                        levels = self.monitorLevels()
+                        view = self.wg.qcombo_int_view.currentText()
+                        if view == "Waterfall":
+                            pol = self.wg.qcombo_int_pol.currentIndex()
+                            for i in range(16):
+                                image, t = self.waterfall.image(slot, i, pol)
+                                self.monitorPlots.plotWaterfall(image, i, extent=[0, 400, -len(image), 0], clim=levels,
+                                                                title="INPUT-%02d %s" % (i, self.wg.qcombo_int_pol.currentText()))
+                        elif view == "Channel Time Series":
+                            try:
+                                freq = float(self.wg.qline_int_freq.text())
+                            except ValueError:
+                                freq = 160
+                            channel = int(closest(self.monitor_asse_x, freq))
+                            values, t = self.waterfall.series(slot, channel)
+                            asse_x = np.arange(1 - len(values), 1)
+                            # The series grows until the history is full, the lines are drawn again
+                            self.monitorPlots.plotClear()
+                            for i in range(16):
+                                self.monitorPlots.plotCurve(asse_x, values[:, i, 0], i,
+                                                            xAxisRange=[-self.waterfall.depth, 0], yAxisRange=levels,
+                                                            title="INPUT-%02d @ %3.1f MHz" % (i, self.monitor_asse_x[channel]),
+                                                            xLabel="integrations", yLabel="dB", colore="b", grid=True,
+                                                            lw=1, show_line=True)
+                                self.monitorPlots.plotCurve(asse_x, values[:, i, 1], i,
+                                                            xAxisRange=[-self.waterfall.depth, 0], yAxisRange=levels,
+                                                            colore="g", grid=True, lw=1, show_line=True)
+                        else:
+                            for i in range(16):
+                                # Plot X Pol
+                                self.monitorPlots.plotCurve(self.monitor_asse_x, spettri[i, 0], i, xAxisRange=[1, 400],
+                                                            yAxisRange=levels, title="INPUT-%02d" % i,
+                                                            xLabel="MHz", yLabel="dB", colore="b", grid=True, lw=1,
+                                                            show_line=True)
+                                # Plot Y Pol
+                                self.monitorPlots.plotCurve(self.monitor_asse_x, spettri[i, 1], i, xAxisRange=[1, 400],
+                                                            yAxisRange=levels, colore="g", grid=True, lw=1,
+                                                            show_line=True)
+                        self.wg.qlabel_int_history.setText("History: %d/%d integrations" %
+                                                           (min(self.waterfall.count[slot], self.waterfall.depth),
+                                                            self.waterfall.depth))
                         self.monitorPlots.updatePlot()
-                        self.monitorPrecTstamp = timestamps[0][0]
-                #     else:
-                #         logging.debug("Uguale al precedente")
-                # else:
-                #     logging.debug("Non ancora pronto: ", ts_to_datestring(timestamps[0][0]), "  vs start:", ts_to_datestring(self.monitor_tstart))
+                        self.monitorPrecTstamp = tstamp
 
     def readRms(self):
         if self.connected:
@@ -734,8 +822,8 @@ class Live(SkalabBase):
                 if self.rms_file is not None:
                     self.rms_file.write(name=k, data=remapped_rms)
                 if k not in self.data_rms_charts.keys():
-                    self.data_rms_charts[k] = [np.nan] * 32 * 201
-                self.data_rms_charts[k] = self.data_rms_charts[k][32:] + remapped_power
+                    self.data_rms_charts[k] = chart_history_from_profile(self.profile['Live'], nof_traces=32)
+                self.data_rms_charts[k].append(remapped_power)
             self.rms = rms
 
     def equalization(self):
@@ -743,63 +831,95 @@ class Live(SkalabBase):
             self.ThreadTempPause = True
             self.wg.qbutton_equalize.setEnabled(False)
             self.wg.qbutton_equalize.setStyleSheet("background-color: rgb(237, 212, 0);")
-            for iter in range(1):
-                # logging.debug("\n\nLEVEL EQUALIZATION (iter %d/3)" % (iter + 1))
-                self.readRms()
-                if len(self.rms) == len(self.tpm_station.tiles):
-                    if self.wg.qradio_eq_this.isChecked():
-                        tiles = [int(self.wg.qcombo_tpm.currentIndex())]
-                    else:
-                        tiles = range(len(self.tpm_station.tiles))
-                    RMS = self.rms
-                    target = float(self.wg.qline_eqvalue.text())
-                    if self.wg.qcombo_equnit.currentIndex() == 0:  # ADU RMS
-                        for t in tiles:
-                            #logging.debug("Tiles", tiles, "t", t, "len(RMS)", len(RMS), self.rms[self.wg.qcombo_tpm.currentIndex()])
-                            for i in range(len(RMS[t])):
-                                rms = RMS[t][i]
-                                if old_div(rms, target) > 0:
-                                    with np.errstate(divide='ignore', invalid='ignore'):
-                                        attenuation = 20 * math.log10(old_div(rms, target))
-                                else:
-                                    attenuation = 0
-                                dsa = self.wpreadu.staticRx.rx[self.preaduConf[t][i]['version']].op_get_attenuation(self.preaduConf[t][i]['code'])
-                                new_dsa = bound(int(round(dsa + attenuation)))
-                                self.preaduConf[t][i]['code'] = self.wpreadu.staticRx.rx[self.preaduConf[t][i]['version']].op_set_attenuation(self.preaduConf[t][i]['code'], new_dsa)
-                        self.writing_preadu = True
-                        self.eq_armed = True
-                        while self.writing_preadu:
-                            # wait for the write operation completed by the process
-                            time.sleep(0.1)
-                        #self.preadu.write_configuration()
-                        time.sleep(0.2)
-                    else:
-                        for t in tiles:
-                            for i in range(len(RMS[t])):
-                                rms = RMS[t][i]  # rms_remap[i]]
-                                with np.errstate(divide='ignore', invalid='ignore'):
-                                    power = 10 * np.log10(np.power((rms * (1.7 / 256.)), 2) / 400.) + 30 + 12
-                                if power == (-np.inf):
-                                    power = -30
-                                dsa = self.wpreadu.staticRx.rx[self.preaduConf[t][i]['version']].op_get_attenuation(self.preaduConf[t][i]['code'])
-                                new_dsa = bound(int(round(dsa + (power - target))))
-                                self.preaduConf[t][i]['code'] = self.wpreadu.staticRx.rx[self.preaduConf[t][i]['version']].op_set_attenuation(self.preaduConf[t][i]['code'], new_dsa)
-                                #logging.debug("TPM-%02d INPUT-%02d, Level: %3.1f, Old DSA %d, New DSA %d" % (b+1, i, power, dsa, new_dsa))
-                                #logging.debug(i, self.preadu.preadu.get_register_value(nrx=i), self.preaduConf[b][i]['dsa'])
-                            self.eq_armed = True
-                            self.writing_preadu = True
-                            while self.writing_preadu:
-                                # wait for the write operation completed by the process
-                                time.sleep(0.1)
-                            #self.preadu.write_configuration()
-                            time.sleep(0.2)
-                        # self.preadu.setTpm(self.tpm_station.tiles[self.wg.qcombo_tpm.currentIndex()])
-                else:
-                    self.logger.logger.warning("RMS pkt does not match expected len (len=%d instead of %d)" % (len(self.rms), len(self.tpm_station.tiles)))
+            while self.commBusy:
+                time.sleep(0.1)
+            self.commBusy = True
+            if self.wg.qradio_eq_this.isChecked():
+                tiles = [int(self.wg.qcombo_tpm.currentIndex())]
+            else:
+                tiles = range(len(self.tpm_station.tiles))
+            unit = "rms" if self.wg.qcombo_equnit.currentIndex() == 0 else "dbm"
+            try:
+                report = self.equalizer.equalize(target=float(self.wg.qline_eqvalue.text()), unit=unit, tiles=tiles,
+                                                 tolerance=self.eq_tolerance, max_iter=self.eq_max_iter)
+                for n, t in enumerate(report['tiles']):
+                    worst = np.argmax(np.abs(report['residuals'][n]))
+                    self.logger.logger.info("TPM-%02d equalized: worst input %d at %3.1f dB from target" %
+                                            (t + 1, worst, report['residuals'][n][worst]))
+                self.logger.logger.info("Equalization completed in %3.1f s (%d iterations), %d inputs not converged" %
+                                        (report['time'], report['iterations'], np.count_nonzero(~report['converged'])))
+                self.checkPreaduWrites(tiles=tiles)
+                self.preaduConf = [p.readConfiguration() for p in self.preadu]
+                self.preaduConfUpdated = True
+            except Exception as e:
+                self.logger.logger.warning("Equalization failed: %s" % str(e))
+            self.commBusy = False
             self.wg.qbutton_equalize.setEnabled(True)
             self.wg.qbutton_equalize.setStyleSheet("")
             self.ThreadTempPause = False
 
+    def savePreaduSnapshot(self):
+        if self.connected:
+            fd = QtWidgets.QFileDialog()
+            fd.setOption(QtWidgets.QFileDialog.DontUseNativeDialog, True)
+            result = fd.getSaveFileName(caption="Select a File Name to save the Station PreADU configuration...",
+                                        directory=self.profile['Live']['default_path_export_data'],
+                                        filter="PreADU Snapshot (*.npz)", options=fd.options())[0]
+            if not result == "":
+                while self.commBusy:
+                    time.sleep(0.1)
+                self.commBusy = True
+                try:
+                    save_snapshot(result, station_snapshot(self.preadu))
+                    self.logger.logger.info("Saved PreADU configuration of %d tiles on %s" % (len(self.preadu), result))
+                except Exception as e:
+                    self.logger.logger.error("Unable to save the PreADU configuration: %s" % str(e))
+                self.commBusy = False
+
+    def restorePreaduSnapshot(self):
+        if self.connected:
+            fd = QtWidgets.QFileDialog()
+            fd.setOption(QtWidgets.QFileDialog.DontUseNativeDialog, True)
+            result = fd.getOpenFileName(caption="Select a Station PreADU configuration to restore...",
+                                        directory=self.profile['Live']['default_path_export_data'],
+                                        filter="PreADU Snapshot (*.npz)", options=fd.options())[0]
+            if not result == "":
+                while self.commBusy:
+                    time.sleep(0.1)
+                self.commBusy = True
+                try:
+                    before, after = restore_snapshot(self.preadu, load_snapshot(result))
+                    self.logger.logger.info("Restored %s: %d receivers on %d tiles rewritten" %
+                                            (result, np.count_nonzero(before), np.count_nonzero(before.any(axis=1))))
+                    if after.any():
+                        self.logger.logger.warning("%d receivers still differ from the snapshot" % np.count_nonzero(after))
+                    self.checkPreaduWrites()
+                    self.preaduConf = [p.readConfiguration() for p in self.preadu]
+                    self.preaduConfUpdated = True
+                except Exception as e:
+                    self.logger.logger.error("Unable to restore the PreADU configuration: %s" % str(e))
+                self.commBusy = False
+
+    def checkPreaduWrites(self, tiles=None):
+        """ Log the receivers whose readback differs from the code written by the last write """
+        if tiles is None:
+            tiles = range(len(self.preadu))
+        for t in tiles:
+            last_write = self.preadu[t].last_write
+            if not last_write.get('verified', True):
+                self.logger.logger.warning("TPM-%02d PreADU readback mismatch on receivers %s" %
+                                           (t + 1, ", ".join(["%d" % x for x in last_write['mismatch']])))
+
+    def invalidatePreadu(self):
+        """ The PreADU registers may have been changed by someone else (e.g. a station initialisation) """
+        for p in self.preadu:
+            p.invalidate()
+        self.logger.logger.info("PreADU configuration will be read again from the TPMs")
+
+    def readEqualizationRms(self):
+        self.readRms()
+        return self.rms
+
     def readTemperatures(self):
         timestamp = dt_to_timestamp(datetime.datetime.utcnow())
         self.wg.qlabel_tstamp_temp.setText(ts_to_datestring(timestamp))
@@ -813,8 +933,8 @@ class Live(SkalabBase):
             if self.temp_file is not None:
                 self.temp_file.write(name=("TPM-%02d" % (n + 1)), data=tris)
             if k not in self.data_temp_charts.keys():
-                self.data_temp_charts[k] = [[np.nan, np.nan, np.nan]] * 201
-            self.data_temp_charts[k] = self.data_temp_charts[k][1:] + [tris]
+                self.data_temp_charts[k] = chart_history_from_profile(self.profile['Live'], nof_traces=3)
+            self.data_temp_charts[k].append(tris)
 
             #logging.debug("TPM-%02d Temperatures: Board %3.1f,\tFPGA-0 %3.1f,\tFPGA-1 %3.1f" %
             #      (n + 1, tris[0], tris[1], tris[2]))
@@ -1010,6 +1130,10 @@ class Live(SkalabBase):
                                      31, 30, 29, 28, 27, 26, 25, 24,
                                      22, 23, 20, 21, 18, 19, 16, 17]
                         colors = ['b', 'g'] * 16
+                    if self.wg.qradio_rms_dsa.isChecked():
+                        # DSA of all the receivers of the station in one go
+                        codes, versions = self.wpreadu.codec.from_conf(self.preaduConf)
+                        dsa = self.wpreadu.codec.get_attenuation(codes, versions)
                     for t in range(len(self.station_configuration['tiles'])):
                         powers = np.zeros(32)
                         for i in range(32):
@@ -1017,7 +1141,7 @@ class Live(SkalabBase):
                                 self.qp_rms[t].plotBar(self.rms[t][rms_remap[i]], i, colors[i])
                             elif self.wg.qradio_rms_dsa.isChecked():
                                 #self.qp_rms[t].plotBar(self.preaduConf[t][i]['dsa'], i, 'r')
-                                self.qp_rms[t].plotBar(self.wpreadu.staticRx.rx[self.preaduConf[t][i]['version']].op_get_attenuation(self.preaduConf[t][i]['code']), i, 'r')
+                                self.qp_rms[t].plotBar(dsa[t][i], i, 'r')
                             with np.errstate(divide='ignore', invalid='ignore'):
                                 power = 10 * np.log10(np.power((self.rms[t][rms_remap[i]] * (1.7 / 256.)), 2) / 400.) + 30 + 12
                             if power == -np.inf:
@@ -1073,7 +1197,7 @@ class Live(SkalabBase):
             self.drawTempCharts()
 
     def drawTempCharts(self):
-        self.tempChart.set_xlabel("time sample")
+        self.tempChart.set_xlabel("time samples (0 = latest)")
         # Draw selected chart
         if self.wg.qcombo_chart.currentIndex() == 0:
             self.tempChart.set_ylabel("TPM Board Temperatures (deg)")
@@ -1092,15 +1216,16 @@ class Live(SkalabBase):
             ymax = 80
         self.tempChart.set_ylim([ymin, ymax])
         for i in range(len(self.data_temp_charts.keys())):
-            self.tempChart.plotCurve(data=np.array(self.data_temp_charts["TPM-%02d" % (i + 1)]).transpose()[
-                self.wg.qcombo_chart.currentIndex()], trace=i, color=COLORI[i])
+            self.tempChart.plotHistory(history=self.data_temp_charts["TPM-%02d" % (i + 1)], trace=i, color=COLORI[i],
+                                       column=self.wg.qcombo_chart.currentIndex())
         self.tempChart.updatePlot()
 
     def drawRmsCharts(self):
-        self.rmsChart.set_xlabel("time sample")
+        self.rmsChart.set_xlabel("time samples (0 = latest)")
         self.rmsChart.set_ylim([float(self.wg.qline_rms_level_min.text()), float(self.wg.qline_rms_level_max.text())])
         for i in range(32):
-            self.rmsChart.plotCurve(data=self.data_rms_charts["TPM-%02d" % (self.wg.qcombo_tpm.currentIndex() + 1)][i::32], trace=i, color=COLORI[i])
+            self.rmsChart.plotHistory(history=self.data_rms_charts["TPM-%02d" % (self.wg.qcombo_tpm.currentIndex() + 1)],
+                                      trace=i, color=COLORI[i], column=i)
         self.rmsChart.updatePlot()
 
     def plotAcquisition(self):
@@ -1,5 +1,10 @@
 import logging
 import os.path
+import re
+import html
+import sqlite3
+from collections import deque
+from contextlib import contextmanager
 from logging.handlers import TimedRotatingFileHandler
 from PyQt5 import QtWidgets, QtCore, QtGui
 import sys
@@ -7,7 +12,108 @@ import time
 import datetime
 from pathlib import Path
 default_app_dir = str(Path.home()) + "/.skalab/LOG"
-from threading import Thread
+from threading import Thread, Lock
+
+LOG_BATCH = 200  # Max number of messages rendered per GUI update
+LOG_MAX_LINES = 5000  # Max number of messages kept in each log widget
+LOG_SIMILAR_MAX = 5  # Similar messages shown per window, the others are counted and summarised
+LOG_SIMILAR_WINDOW = 5.0  # seconds
+LOG_FRAME = 0.05  # seconds between two GUI updates
+EVENTS_FILENAME = "skalab_events.db"
+EVENTS_FLUSH = 1.0  # seconds between two commits of the event log
+EVENTS_FIELDS = ["tstamp", "level", "module", "source", "attribute", "value", "threshold", "message"]
+
+
+class EventLog:
+    """
+    Structured event log: one SQLite table with time and source indexes, shared by all the SkaLab apps.
+    Records are buffered and committed in bulk by flush().
+    """
+    def __init__(self, fname):
+        self.fname = fname
+        self.buffer = deque()
+        self.lock = Lock()
+        self.conn = sqlite3.connect(fname, timeout=10, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS events (tstamp REAL NOT NULL, level INTEGER NOT NULL, "
+                          "module TEXT, source TEXT, attribute TEXT, value REAL, threshold TEXT, message TEXT)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS events_tstamp ON events (tstamp)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS events_source ON events (source, tstamp)")
+        self.conn.commit()
+
+    def record(self, level, module, message="", source=None, attribute=None, value=None, threshold=None,
+               tstamp=None):
+        if tstamp is None:
+            tstamp = time.time()
+        try:
+            value = None if value is None else float(value)
+        except (TypeError, ValueError):
+            value = None
+        self.buffer.append((tstamp, level, module, source, attribute, value, threshold, message))
+
+    def flush(self):
+        with self.lock:
+            rows = []
+            while self.buffer:
+                rows += [self.buffer.popleft()]
+            if rows:
+                self.conn.executemany("INSERT INTO events VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows)
+                self.conn.commit()
+
+    def close(self):
+        self.flush()
+        with self.lock:
+            self.conn.close()
+
+
+def query_events(fname, start=None, stop=None, source=None, attribute=None, module=None, level=None, limit=None):
+    """
+    Read back the events of an EventLog database.
+
+    start, stop are UTC timestamps (seconds), source, attribute and module can be a string or a list of strings,
+    level is the minimum logging level. Return a list of dictionaries sorted by time.
+    """
+    where, args = [], []
+    if start is not None:
+        where += ["tstamp >= ?"]
+        args += [float(start)]
+    if stop is not None:
+        where += ["tstamp <= ?"]
+        args += [float(stop)]
+    for field, value in [("source", source), ("attribute", attribute), ("module", module)]:
+        if value is not None:
+            if type(value) is str:
+                value = [value]
+            where += ["%s IN (%s)" % (field, ",".join(["?"] * len(value)))]
+            args += list(value)
+    if level is not None:
+        where += ["level >= ?"]
+        args += [int(level)]
+    sql = "SELECT %s FROM events" % ", ".join(EVENTS_FIELDS)
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    sql += " ORDER BY tstamp"
+    if limit is not None:
+        sql += " LIMIT %d" % int(limit)
+    conn = sqlite3.connect(fname, timeout=10)
+    try:
+        return [dict(zip(EVENTS_FIELDS, row)) for row in conn.execute(sql, args)]
+    finally:
+        conn.close()
+
+
+class EventLogHandler(logging.Handler):
+    """ Copy the log records into an EventLog, structured fields are taken from the record 'extra' """
+    def __init__(self, eventlog, module=""):
+        super().__init__()
+        self.eventlog = eventlog
+        self.module = module
+
+    def emit(self, record):
+        self.eventlog.record(level=record.levelno, module=self.module, message=record.getMessage(),
+                             source=getattr(record, "source", None), attribute=getattr(record, "attribute", None),
+                             value=getattr(record, "value", None), threshold=getattr(record, "threshold", None),
+                             tstamp=record.created)
 
 
 class QTextEditLogger(logging.Handler):
@@ -17,11 +123,14 @@ class QTextEditLogger(logging.Handler):
         self.widget.setFont(QtGui.QFont("Courier New", 10))
         self.widget.setStyleSheet("background-color: rgb(255, 255, 255);")
         self.widget.setReadOnly(True)
+        self.widget.document().setMaximumBlockCount(LOG_MAX_LINES)
         self.level = level
         self.logname = ""
         self.caption = caption
         self.total = 0
-        self.msgQueue = []
+        self.msgQueue = deque()
+        self.similar = {}
+        self.drainPending = False
 
         html_header = "<!DOCTYPE HTML PUBLIC \"-//W3C//DTD HTML 4.0//EN\" "
         html_header += "\"http://www.w3.org/TR/REC-html40/strict.dtd\"><html><head>"
@@ -33,26 +142,69 @@ class QTextEditLogger(logging.Handler):
         # print("Start Thread Log: ", self.logname, ", Level:", self.level)
 
     def emit(self, record):
+        if not ((record.levelno == self.level) or (self.level == logging.INFO)):
+            return
+        # Messages differing only by numbers (values, tile ids...) are similar
+        key = (record.levelno, re.sub(r"[0-9.]+", "#", str(record.msg)))
+        now = time.time()
+        entry = self.similar.get(key)
+        if entry is None or now - entry['start'] > LOG_SIMILAR_WINDOW:
+            if entry is not None:
+                self.summary(entry)
+            entry = {'start': now, 'count': 0, 'suppressed': 0, 'record': record}
+            self.similar[key] = entry
+        entry['count'] += 1
+        if entry['count'] > LOG_SIMILAR_MAX:
+            entry['suppressed'] += 1
+            entry['record'] = record
+            return
         self.msgQueue.append([record.levelno, record.levelname, self.format(record)])
 
+    def summary(self, entry):
+        if entry['suppressed']:
+            record = entry['record']
+            self.msgQueue.append([record.levelno, record.levelname, "%d similar messages suppressed, last one: %s" %
+                                  (entry['suppressed'], self.format(record))])
+
+    def flushSimilar(self):
+        """ Summarise the expired windows of similar messages """
+        now = time.time()
+        with self.lock:
+            for key in [k for k, e in self.similar.items() if now - e['start'] > LOG_SIMILAR_WINDOW]:
+                self.summary(self.similar.pop(key))
+
     def clear(self):
         self.widget.clear()
 
-    def updateBox(self, level, name, msg):
-        if (level == self.level) or (self.level == logging.INFO):
-            fancymsg = ""
+    def drain(self, nof_messages=LOG_BATCH):
+        """ Render up to nof_messages queued messages with a single document update """
+        self.drainPending = False
+        self.flushSimilar()
+        batch = []
+        while self.msgQueue and len(batch) < nof_messages:
+            batch += [self.msgQueue.popleft()]
+        if batch:
+            self.updateBox(batch)
+
+    def updateBox(self, batch):
+        cursor = QtGui.QTextCursor(self.widget.document())
+        cursor.movePosition(QtGui.QTextCursor.End)
+        cursor.beginEditBlock()
+        name = ""
+        for level, name, msg in batch:
             if level == logging.INFO:
-                fancymsg += "\n<span style='font-weight:600; color:#22b80e;'>" + msg + "</span><br>"
+                fancymsg = "<span style='font-weight:600; color:#22b80e;'>" + html.escape(msg) + "</span>"
             elif level == logging.ERROR:
-                fancymsg += "\n<span style='font-weight:600; color:#ff0000;'>" + msg + "</span><br>"
+                fancymsg = "<span style='font-weight:600; color:#ff0000;'>" + html.escape(msg) + "</span>"
             else:
-                fancymsg += "\n<span style='font-weight:600; color:#ff7800;'>" + msg + "</span><br>"
-
-            self.widget.insertHtml(fancymsg)
-            self.widget.moveCursor(QtGui.QTextCursor.End)
-            if self.caption is not None:
-                self.total = self.total + 1
-                self.caption.setTabText(2, name[0] + name[1:].lower() + "s  cnt:%s" % str(self.total).rjust(3, " ") + " (*)")
+                fancymsg = "<span style='font-weight:600; color:#ff7800;'>" + html.escape(msg) + "</span>"
+            cursor.insertBlock()
+            cursor.insertHtml(fancymsg)
+        cursor.endEditBlock()
+        self.widget.moveCursor(QtGui.QTextCursor.End)
+        if self.caption is not None:
+            self.total = self.total + len(batch)
+            self.caption.setTabText(2, name[0] + name[1:].lower() + "s  cnt:%s" % str(self.total).rjust(3, " ") + " (*)")
 
 
 class SkalabLog(QtWidgets.QMainWindow):
@@ -154,6 +306,16 @@ class SkalabLog(QtWidgets.QMainWindow):
         # self.console_handler.setFormatter(formatter)
         # self.console_handler.setLevel(logging.INFO)
         # self.logger.addHandler(self.console_handler)
+        # Set the structured event log, shared by all the apps logging in the same directory
+        self.eventLog = None
+        try:
+            self.eventLog = EventLog(os.path.join(os.path.dirname(logname) or ".", EVENTS_FILENAME))
+            self.event_handler = EventLogHandler(self.eventLog, module=profile['Base']['app'])
+            self.event_handler.setLevel(logging.INFO)
+            self.logger.addHandler(self.event_handler)
+        except sqlite3.Error:
+            pass
+
         self.logger.setLevel(logging.INFO)
         self.logger.propagate = False
         self.logger.info("Log File: " + fname)
@@ -175,6 +337,33 @@ class SkalabLog(QtWidgets.QMainWindow):
     def error(self, msg):
         self.logger.error(msg)
 
+    def logEvent(self, level, msg, source=None, attribute=None, value=None, threshold=None):
+        """ Log a message carrying the structured fields of the event log """
+        self.logger.log(level, msg, extra={'source': source, 'attribute': attribute,
+                                           'value': value, 'threshold': threshold})
+
+    @contextmanager
+    def forwardLogger(self, name=None):
+        """
+        Show in this log the records of another logger (the root one by default, where the libraries like
+        pyaavs log) while in the with block, e.g. the progress of a station initialisation run in process
+        """
+        other = logging.getLogger(name)
+        if other is self.logger:
+            yield
+            return
+        level = other.level
+        if not other.isEnabledFor(logging.INFO):
+            other.setLevel(logging.INFO)
+        for handler in self.logger.handlers:
+            other.addHandler(handler)
+        try:
+            yield
+        finally:
+            for handler in self.logger.handlers:
+                other.removeHandler(handler)
+            other.setLevel(level)
+
     def logChanged(self):
         if "(*)" in self.qtabLog.tabText(self.qtabLog.currentIndex()):
             self.qtabLog.setTabText(self.qtabLog.currentIndex(), self.qtabLog.tabText(self.qtabLog.currentIndex())[:-3])
@@ -193,6 +382,9 @@ class SkalabLog(QtWidgets.QMainWindow):
 
     def stopLog(self):
         self.stopThread = True
+        if self.eventLog is not None:
+            self.eventLog.close()
+            self.eventLog = None
 
     def testFunc(self):
         self.qbutton_test = QtWidgets.QPushButton(self.wg)
@@ -212,36 +404,35 @@ class SkalabLog(QtWidgets.QMainWindow):
         self.qbutton_close.setText("TERMINATE")
 
     def procLog(self):
+        last_flush = time.time()
         while True:
             if not self.stopThread:
-                if self.logInfo.msgQueue:
-                    self.signalLogInfo.emit()
-                if self.logWarning.msgQueue:
-                    self.signalLogWarning.emit()
-                if self.logError.msgQueue:
-                    self.signalLogError.emit()
-                time.sleep(0.01)
+                if self.eventLog is not None and time.time() - last_flush > EVENTS_FLUSH:
+                    try:
+                        self.eventLog.flush()
+                    except sqlite3.Error:
+                        pass
+                    last_flush = time.time()
+                # One update per frame and per widget, each one renders a whole batch
+                for handler, signal in [(self.logInfo, self.signalLogInfo),
+                                        (self.logWarning, self.signalLogWarning),
+                                        (self.logError, self.signalLogError)]:
+                    if (handler.msgQueue or handler.similar) and not handler.drainPending:
+                        handler.drainPending = True
+                        signal.emit()
+                time.sleep(LOG_FRAME)
             else:
                 #print("Stopping Thread Log: ", self.logname, ", Level:", self.level)
                 break
 
     def writeLogInfo(self):
-        if self.logInfo.msgQueue:
-            l, n, m = self.logInfo.msgQueue[0]
-            self.logInfo.msgQueue = self.logInfo.msgQueue[1:]
-            self.logInfo.updateBox(l, n, m)
+        self.logInfo.drain()
 
     def writeLogWarning(self):
-        if self.logWarning.msgQueue:
-                l, n, m = self.logWarning.msgQueue[0]
-                self.logWarning.msgQueue = self.logWarning.msgQueue[1:]
-                self.logWarning.updateBox(l, n, m)
+        self.logWarning.drain()
 
     def writeLogError(self):
-        if self.logError.msgQueue:
-            l, n, m = self.logError.msgQueue[0]
-            self.logError.msgQueue = self.logError.msgQueue[1:]
-            self.logError.updateBox(l, n, m)
+        self.logError.drain()
 
 
 if __name__ == "__main__":
@@ -9,11 +9,16 @@ from pyfabil import TPMGeneric
 from pyfabil.base.definitions import LibraryError, BoardError, PluginError, InstrumentError
 from PyQt5 import QtWidgets, uic, QtCore, QtGui
 from hardware_client import WebHardwareClient
-from skalab_base import SkalabBase
+from skalab_base import SkalabBase, load_ui
 from skalab_log import SkalabLog
 from skalab_utils import dt_to_timestamp, ts_to_datestring, parse_profile, COLORI, Led, getTextFromFile, colors
+from skalab_utils import scan_tpms, scan_report
+from skalab_thresholds import ThresholdEngine, parse_limits, STATE_OK, STATE_WARNING, STATE_ALARM
 from threading import Thread, Event, Lock
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import TimeoutError as FutureTimeoutError
 from time import sleep
+import time
 from future.utils import iteritems
 import datetime
 from pathlib import Path
@@ -77,6 +82,53 @@ subrack_attribute = {
                 "subrack_fan_speeds_percent": [None]*8,
                 }
 
+# TPM slot bring-up states: off -> programming -> connected -> monitored (error on a failed bring-up)
+SLOT_OFF = "off"
+SLOT_PROGRAMMING = "programming"
+SLOT_CONNECTED = "connected"
+SLOT_MONITORED = "monitored"
+SLOT_ERROR = "error"
+
+# Cell states and the stylesheet used to render them
+CELL_NORMAL = 0
+CELL_WARNING = 1
+CELL_ALARM = 2
+CELL_STYLE = {CELL_NORMAL: "color: black; background:white",
+              CELL_WARNING: "color: white; background:orange",
+              CELL_ALARM: "color: white; background:red"}
+
+
+class CellModel:
+    """
+    Keep the last text and state shown by every table cell (and the LEDs) and touch
+    the Qt widgets only when they change: re-parsing the same stylesheet at every poll
+    for every attribute of every TPM is what makes the GUI stutter.
+    """
+    def __init__(self):
+        self.cells = {}
+        self.leds = {}
+
+    def setCell(self, widget, text, state=CELL_NORMAL):
+        last = self.cells.get(widget, (None, None))
+        if not last[0] == text:
+            widget.setText(text)
+        if not last[1] == state:
+            widget.setStyleSheet(CELL_STYLE[state])
+        self.cells[widget] = (text, state)
+
+    def getState(self, widget):
+        return self.cells.get(widget, (None, CELL_NORMAL))[1]
+
+    def setLed(self, led, colour, value):
+        if not self.leds.get(led, None) == (colour, value):
+            led.Colour = colour
+            led.value = value
+            self.leds[led] = (colour, value)
+
+    def clear(self):
+        self.cells = {}
+        self.leds = {}
+
 
 def populateTable(qtable, attribute):
     "Create table"
@@ -95,6 +147,8 @@ def populateTable(qtable, attribute):
             layout=QtWidgets.QVBoxLayout()
             attribute[k][v] = QtWidgets.QLineEdit(qtable)
             attribute[k][v+1]= QtWidgets.QLineEdit(qtable)
+            attribute[k][v].setAlignment(QtCore.Qt.AlignCenter)
+            attribute[k][v+1].setAlignment(QtCore.Qt.AlignCenter)
             layout.addWidget(attribute[k][v])
             layout.addWidget(attribute[k][v+1])
             cellWidget = QtWidgets.QWidget()
@@ -117,6 +171,8 @@ def populateSubrackPs(frame, attribute):
             subrack_attribute[k][v+1]= QtWidgets.QLineEdit(frame)
             subrack_attribute[k][v].setGeometry(QtCore.QRect(  size_x+45*v, 10 +  (size_y*(j)),  70,19))
             subrack_attribute[k][v+1].setGeometry(QtCore.QRect(size_x+45*v, 30 +  (size_y*(j)),  70,19))
+            subrack_attribute[k][v].setAlignment(QtCore.Qt.AlignCenter)
+            subrack_attribute[k][v+1].setAlignment(QtCore.Qt.AlignCenter)
         j+=1
 
 def populateWarningAlarmTable(true_table, warning, alarm):
@@ -162,6 +218,13 @@ class TileInitialization(SkalabBase):
     def __init__(self, profile, swpath="") -> None:
         super(TileInitialization, self).__init__(App="monitor", Profile=profile, Path=swpath, parent=self.wgProBox)
         self.config_file = self.profile['Init']['station_file']
+        self.scan_timeout = 3.0
+        self.scan_ping = False
+        try:
+            self.scan_timeout = float(self.profile['Init']['scan_timeout'])
+            self.scan_ping = self.profile['Init']['scan_ping'].lower() in ["true", "1", "yes"]
+        except:
+            pass
         self.wg.qline_configfile.setText(self.config_file)
         if 'Extras' in self.profile.keys():
             if 'text_editor' in self.profile['Extras'].keys():
@@ -265,22 +328,21 @@ class TileInitialization(SkalabBase):
                             msgBox.exec_()
                             station.configuration['tiles'] = list(tpm_ip_from_subrack_short)
                             self.wgLive.setupNewTilesIPs(list(tpm_ip_from_subrack))
-                for tpm_ip in station.configuration['tiles']:
-                    try:
-                        tpm = TPMGeneric()
-                        tpm_version = tpm.get_tpm_version(socket.gethostbyname(tpm_ip), 10000)
-                    except (BoardError, LibraryError):
-                        station_on = False
-                        break
+                # Probe all the boards at once, every unreachable one is reported
+                scan = scan_tpms(station.configuration['tiles'], timeout=self.scan_timeout, ping=self.scan_ping)
+                unreachable = [tpm['ip'] for tpm in scan if not tpm['reachable']]
+                station_on = not unreachable
                 if station_on:
                     self.signal_station_init.emit()
                 else:
                     msgBox = QtWidgets.QMessageBox()
-                    msgBox.setText("STATION\nOne or more TPMs forming the station is unreachable\n"
-                                "Please check the power or the connection!")
+                    msgBox.setText("STATION\n%d of %d TPMs forming the station are unreachable:\n%s\n"
+                                   "Please check the power or the connection!" %
+                                   (len(unreachable), len(scan), "\n".join(unreachable)))
                     msgBox.setWindowTitle("ERROR: TPM UNREACHABLE")
                     msgBox.setIcon(QtWidgets.QMessageBox.Critical)
-                    details = "STATION IP LIST FROM CONFIG FILE (%d): " % len(tpm_ip_list)
+                    details = scan_report(scan)
+                    details += "\n\nSTATION IP LIST FROM CONFIG FILE (%d): " % len(tpm_ip_list)
                     for i in tpm_ip_list:
                         details += "\n%s" % i
                     details += "\n\nSUBRACK IP LIST OF TPM POWERED ON: (%d): " % len(tpm_ip_from_subrack)
@@ -435,7 +497,7 @@ class Monitor(TileInitialization):
     def __init__(self, config="", uiFile="", profile="", size=[1170, 919], swpath=""):
         """ Initialise main window """
         # Load window file
-        self.wg = uic.loadUi(uiFile)
+        self.wg = load_ui(uiFile)
         self.wgProBox = QtWidgets.QWidget(self.wg.qtab_conf)
         self.wgProBox.setGeometry(QtCore.QRect(1, 1, 800, 860))
         self.wgProBox.setVisible(True)
@@ -447,8 +509,15 @@ class Monitor(TileInitialization):
         # Set variable
         self.from_subrack = {}
         self.interval_monitor = self.profile['Monitor']['query_interval']
+        try:
+            self.health_timeout = float(self.profile['Monitor']['health_timeout'])
+        except:
+            self.health_timeout = 5.0
+        # Seconds spent by each TPM to return its health status in the last cycle (None: never read)
+        self.tpm_health_latency = [None] * 8
         self.tlm_hdf_monitor = None
         self.tpm_initialized = [False] * 8
+        self.cells = CellModel()
         # Populate table
         populateSubrackPs(self.wg.sub_frame, subrack_attribute)
         self.populate_table_profile()
@@ -471,6 +540,8 @@ class Monitor(TileInitialization):
         self._lock_tab2 = Lock()
         self.check_tpm_tm = Thread(name= "TPM telemetry", target=self.monitoringTpm, daemon=True)
         self._tpm_lock = Lock()
+        self._slot_lock = Lock()
+        self.bringup_pool = ThreadPoolExecutor(max_workers=8, thread_name_prefix="TPM bring-up")
         self.wait_check_tpm = Event()
         self.check_tpm_tm.start()
 
@@ -494,17 +565,14 @@ class Monitor(TileInitialization):
     def clearValues(self):
         with (self._lock_led and self._lock_tab1 and self._lock_tab2):
             for i in range(16):
-                self.qled_alert[int(i/2)].Colour = Led.Grey
-                self.qled_alert[int(i/2)].value = False  
+                self.cells.setLed(self.qled_alert[int(i/2)], Led.Grey, False)
                 for attr in self.alarm:
                     self.alarm[attr][int(i/2)] = False
                     if attr in self.tile_table_attr:
-                        self.tile_table_attr[attr][i].setText(str(""))
-                        self.tile_table_attr[attr][i].setStyleSheet("color: black; background:white")  
+                        self.cells.setCell(self.tile_table_attr[attr][i], "")
                     elif attr in subrack_attribute:
                         try:
-                            subrack_attribute[attr][int(i/2)].setText(str(""))
-                            subrack_attribute[attr][int(i/2)].setStyleSheet("color: black; background:white")
+                            self.cells.setCell(subrack_attribute[attr][int(i/2)], "")
                         except:
                             pass
                          
@@ -512,6 +580,8 @@ class Monitor(TileInitialization):
         keys_to_be_removed = []
         self.tpm_on_off = [False] * 8
         self.tpm_active = [None] * 8
+        self.tpm_slot_state = [SLOT_OFF] * 8
+        self.tpm_bringup_id = [0] * 8
         #self.tpm_slot_ip = list(station.configuration['tiles'])
         self.tpm_slot_ip = eval(self.profile['Monitor']['tiles_slot_ip'])
         self.tpm_ip_check= list(station.configuration['tiles'])
@@ -532,80 +602,157 @@ class Monitor(TileInitialization):
         self.tpm_alarm = self.profile['TPM Alarm']
         self.alarm_values = dict(self.tpm_alarm, **self.subrack_alarm)
         for attr in self.warning:
-            self.warning[attr] = eval(self.warning[attr])
-            self.alarm_values[attr] = eval(self.alarm_values[attr])
-            if self.warning[attr][0] == None: self.warning[attr][0] = -float('inf')
-            if self.alarm_values[attr][0]   == None: self.alarm_values[attr][0]   = -float('inf')
-            if self.warning[attr][1] == None: self.warning[attr][1] =  float('inf')
-            if self.alarm_values[attr][1]   == None: self.alarm_values[attr][1]   =  float('inf')   
+            self.warning[attr] = parse_limits(self.warning[attr])
+            self.alarm_values[attr] = parse_limits(self.alarm_values[attr])
+        try:
+            hysteresis = float(self.profile['Monitor']['threshold_hysteresis'])
+        except:
+            hysteresis = 0.0
+        try:
+            debounce = int(self.profile['Monitor']['threshold_debounce'])
+        except:
+            debounce = 1
+        # Limits are compiled once, a TPM snapshot is a row of 8, a Subrack attribute has one value per row
+        self.tpm_thresholds = ThresholdEngine(self.tpm_warning, self.tpm_alarm, nof_rows=8,
+                                              hysteresis=hysteresis, debounce=debounce)
+        self.subrack_thresholds = ThresholdEngine(self.subrack_warning, self.subrack_alarm, nof_rows=8,
+                                                  hysteresis=hysteresis, debounce=debounce)
         populateWarningAlarmTable(self.wg.true_table, self.warning, self.alarm_values)
 
+    def logThresholdEvents(self, events, source, thresholds):
+        for row, attr, old_state, new_state, value in events:
+            n = thresholds.index[attr]
+            if new_state == STATE_ALARM:
+                limits = "[%s, %s]" % (thresholds.alarm_lo[n], thresholds.alarm_hi[n])
+                self.logger.logEvent(logging.ERROR, f"ERROR: {attr} parameter is out of range! ({source}{row + 1}: {value})",
+                                  source=f"{source}{row + 1}", attribute=attr, value=value, threshold=limits)
+            elif new_state == STATE_WARNING:
+                limits = "[%s, %s]" % (thresholds.warning_lo[n], thresholds.warning_hi[n])
+                self.logger.logEvent(logging.WARNING, f"WARNING: {attr} parameter is near the out of range threshold! ({source}{row + 1}: {value})",
+                                  source=f"{source}{row + 1}", attribute=attr, value=value, threshold=limits)
+            else:
+                limits = "[%s, %s]" % (thresholds.warning_lo[n], thresholds.warning_hi[n])
+                self.logger.logEvent(logging.INFO, f"{attr} parameter is back in range ({source}{row + 1}: {value})",
+                                  source=f"{source}{row + 1}", attribute=attr, value=value, threshold=limits)
+
+    def setSlotState(self, slot, state, job_id=None, current=None):
+        """ Move a slot to a new state, only if job_id is still the slot bring-up job and the slot is in current """
+        with self._slot_lock:
+            if job_id is not None and not job_id == self.tpm_bringup_id[slot]:
+                return False
+            if current is not None and not self.tpm_slot_state[slot] == current:
+                return False
+            if not self.tpm_slot_state[slot] == state:
+                self.tpm_slot_state[slot] = state
+                self.signal_update_log.emit("TPM#%d: %s" % (slot + 1, state), "info")
+        return True
+
     def tpmStatusChanged(self):
-        self.wait_check_tpm.clear()
-        with self._tpm_lock:
-            for k in range(8):
-                if self.tpm_on_off[k] and not self.tpm_active[k]:
-                    self.tpm_active[k] = Tile(self.tpm_slot_ip[k+1], self.cpld_port, self.lmc_ip, self.dst_port)
-                    self.tpm_active[k].program_fpgas(self.bitfile)
-                    self.tpm_active[k].connect()
-                elif not self.tpm_on_off[k] and self.tpm_active[k]:
+        # Bring-up runs in background jobs, the monitoring of the other boards goes on
+        for k in range(8):
+            if self.tpm_on_off[k] and self.tpm_slot_state[k] in [SLOT_OFF, SLOT_ERROR]:
+                if (k + 1) in self.tpm_slot_ip.keys():
+                    with self._slot_lock:
+                        self.tpm_bringup_id[k] += 1
+                        job_id = self.tpm_bringup_id[k]
+                    self.setSlotState(k, SLOT_PROGRAMMING)
+                    self.bringup_pool.submit(self.bringUpTpm, k, job_id)
+            elif not self.tpm_on_off[k] and not self.tpm_slot_state[k] == SLOT_OFF:
+                with self._slot_lock:
+                    # Invalidate any bring-up still running on this slot
+                    self.tpm_bringup_id[k] += 1
+                with self._tpm_lock:
                     self.tpm_active[k] = None
+                self.setSlotState(k, SLOT_OFF)
         if any(self.tpm_initialized):
             self.wait_check_tpm.set()
-            
+
+    def bringUpTpm(self, slot, job_id):
+        try:
+            tile = Tile(self.tpm_slot_ip[slot + 1], self.cpld_port, self.lmc_ip, self.dst_port)
+            tile.program_fpgas(self.bitfile)
+            tile.connect()
+        except:
+            self.signal_update_log.emit("TPM#%d: bring-up failed" % (slot + 1), "error")
+            self.setSlotState(slot, SLOT_ERROR, job_id)
+            return
+        with self._tpm_lock:
+            if self.setSlotState(slot, SLOT_CONNECTED, job_id):
+                self.tpm_active[slot] = tile
+
+    def readHealthStatus(self, tile):
+        tstart = time.time()
+        try:
+            tpm_monitoring_points = {}
+            for d in list(tile.get_health_status().values()):
+                tpm_monitoring_points.update(d)
+        except:
+            tpm_monitoring_points = None
+        return tpm_monitoring_points, time.time() - tstart
 
     def monitoringTpm(self):
+        # One worker per slot: a slow board delays only itself
+        health_pool = ThreadPoolExecutor(max_workers=8, thread_name_prefix="TPM health")
+        running = {}
         while True:
             self.wait_check_tpm.wait()
             # Get tm from tpm
             with self._tpm_lock:
-                for i in range(0,15,2):
-                    index = int(i/2)
-                    if self.tpm_on_off[index]:
-                        try:
-                            L = list(self.tpm_active[index].get_health_status().values())
-                            tpm_monitoring_points = {}
-                            for d in L:
-                                tpm_monitoring_points.update(d)
-                        except:
-                            self.signal_update_log.emit(f"Failed to get TPM Telemetry. Are you turning off TPM#{index+1}?","warning")
-                            #self.logger.warning(f"Failed to get TPM Telemetry. Are you turning off TPM#{index+1}?")
-                            tpm_monitoring_points = "ERROR"
-                            continue
-                        self.signal_update_tpm_attribute.emit(tpm_monitoring_points,i)
+                boards = [(index, self.tpm_active[index]) for index in range(8)
+                          if self.tpm_on_off[index] and self.tpm_active[index] is not None]
+            jobs = {}
+            for index, tile in boards:
+                if index in running and not running[index].done():
+                    # Still stuck on the previous request, don't pile up requests on the same board
+                    continue
+                running[index] = health_pool.submit(self.readHealthStatus, tile)
+                jobs[running[index]] = index
+            try:
+                for job in as_completed(jobs, timeout=self.health_timeout):
+                    index = jobs[job]
+                    tpm_monitoring_points, self.tpm_health_latency[index] = job.result()
+                    if tpm_monitoring_points is None:
+                        self.signal_update_log.emit(f"Failed to get TPM Telemetry. Are you turning off TPM#{index+1}?","warning")
+                        continue
+                    self.setSlotState(index, SLOT_MONITORED, current=SLOT_CONNECTED)
+                    self.signal_update_tpm_attribute.emit(tpm_monitoring_points, index * 2)
+            except FutureTimeoutError:
+                for job, index in jobs.items():
+                    if not job.done():
+                        self.tpm_health_latency[index] = None
+                        self.signal_update_log.emit(f"TPM#{index+1} did not return its health status within "
+                                                    f"{self.health_timeout} s","warning")
             #if self.wg.check_savedata.isChecked(): self.saveTlm(tpm_monitoring_points)
             sleep(float(self.interval_monitor))    
 
     def writeTpmAttribute(self,tpm_tmp,i):
+        if self.tpm_health_latency[int(i/2)] is not None:
+            self.qbutton_tpm[int(i/2)].setToolTip("Health status read in %3.2f s" % self.tpm_health_latency[int(i/2)])
+        states, events = self.tpm_thresholds.evaluate_row(int(i/2), tpm_tmp)
+        self.logThresholdEvents(events, "TPM#", self.tpm_thresholds)
         for attr in self.tile_table_attr:
             value = tpm_tmp[attr]
-            self.tile_table_attr[attr][i].setStyleSheet("color: black; background:white")
-            self.tile_table_attr[attr][i].setText(str(value))
-            self.tile_table_attr[attr][i].setAlignment(QtCore.Qt.AlignCenter)
+            self.cells.setCell(self.tile_table_attr[attr][i], str(value))
+            state = states[self.tpm_thresholds.index[attr]] if attr in self.tpm_thresholds.index else STATE_OK
             with self._lock_tab1:
-                if not(type(value)==str or type(value)==str) and not(self.alarm_values[attr][0] <= value <= self.alarm_values[attr][1]):
+                if state == STATE_ALARM:
                     # # tile_table_attr[attr][i].setStyleSheet("color: white; background:red")  
                     # segmentation error or free() pointer error
-                    self.tile_table_attr[attr][i+1].setText(str(value))
-                    self.tile_table_attr[attr][i+1].setStyleSheet("color: white; background:red")
-                    self.tile_table_attr[attr][i+1].setAlignment(QtCore.Qt.AlignCenter)
+                    self.cells.setCell(self.tile_table_attr[attr][i+1], str(value), CELL_ALARM)
                     self.alarm[attr][int(i/2)] = True
-                    self.logger.error(f"ERROR: {attr} parameter is out of range!")
                     with self._lock_led:
-                        self.qled_alert[int(i/2)].Colour = Led.Red
-                        self.qled_alert[int(i/2)].value = True
-                elif not(type(value)==str or type(value)==str) and not(self.warning[attr][0] <= value <= self.warning[attr][1]):
+                        self.cells.setLed(self.qled_alert[int(i/2)], Led.Red, True)
+                elif state == STATE_WARNING:
                     if not self.alarm[attr][int(i/2)]:
-                        self.tile_table_attr[attr][i+1].setText(str(value))
-                        self.tile_table_attr[attr][i+1].setStyleSheet("color: white; background:orange")
-                        self.tile_table_attr[attr][i+1].setAlignment(QtCore.Qt.AlignCenter)
-                        self.logger.warning(f"WARNING: {attr} parameter is near the out of range threshold!")
+                        self.cells.setCell(self.tile_table_attr[attr][i+1], str(value), CELL_WARNING)
                         if self.qled_alert[int(i/2)].Colour==4:
                             with self._lock_led:
-                                self.qled_alert[int(i/2)].Colour=Led.Orange
-                                self.qled_alert[int(i/2)].value = True
+                                self.cells.setLed(self.qled_alert[int(i/2)], Led.Orange, True)
 
     def readSubrackAttribute(self):
+        # The whole Subrack snapshot is evaluated at once, the cells just render the states
+        states, events = self.subrack_thresholds.evaluate(self.subrack_thresholds.snapshot(self.from_subrack))
+        self.logThresholdEvents(events, "Subrack#", self.subrack_thresholds)
         for attr in self.from_subrack:
             if attr in subrack_attribute:
                 self.writeSubrackAttribute(attr,subrack_attribute,False)
@@ -614,30 +761,23 @@ class Monitor(TileInitialization):
         for ind in range(0,len(table[attr]),2):
             value = self.from_subrack[attr][int(ind/2)]
             if (not(type(value) == bool) and not(type(value) == str)): value = round(value,1) 
-            table[attr][ind].setStyleSheet("color: black; background:white")
-            table[attr][ind].setText(str(value))
-            table[attr][ind].setAlignment(QtCore.Qt.AlignCenter)
+            self.cells.setCell(table[attr][ind], str(value))
+            state = STATE_OK
+            if attr in self.subrack_thresholds.index and int(ind/2) < self.subrack_thresholds.nof_rows:
+                state = self.subrack_thresholds.get_state(int(ind/2), attr)
             with self._lock_tab2:
-                if not(type(value)==str or type(value)==bool) and not(self.alarm_values[attr][0] <= value <= self.alarm_values[attr][1]):
-                    table[attr][ind+1].setText(str(value))
-                    table[attr][ind+1].setStyleSheet("color: white; background:red")
-                    table[attr][ind+1].setAlignment(QtCore.Qt.AlignCenter)
-                    self.logger.error(f"ERROR: {attr} parameter is out of range!")
+                if state == STATE_ALARM:
+                    self.cells.setCell(table[attr][ind+1], str(value), CELL_ALARM)
                     self.alarm[attr][int(ind/2)] = True
                     if led_flag:
                         with self._lock_led:
-                            self.qled_alert[int(ind/2)].Colour = Led.Red
-                            self.qled_alert[int(ind/2)].value = True
-                elif not(type(value)==str or type(value)==bool) and not(self.warning[attr][0] <= value <= self.warning[attr][1]):
+                            self.cells.setLed(self.qled_alert[int(ind/2)], Led.Red, True)
+                elif state == STATE_WARNING:
                     if not self.alarm[attr][int(ind/2)]:
-                        table[attr][ind+1].setText(str(value))
-                        table[attr][ind+1].setStyleSheet("color: white; background:orange")
-                        table[attr][ind+1].setAlignment(QtCore.Qt.AlignCenter)
-                        self.logger.warning(f"WARNING: {attr} parameter is near the out of range threshold!")
+                        self.cells.setCell(table[attr][ind+1], str(value), CELL_WARNING)
                         if self.qled_alert[int(ind/2)].Colour==4 and led_flag:
                             with self._lock_led:
-                                self.qled_alert[int(ind/2)].Colour=Led.Orange
-                                self.qled_alert[int(ind/2)].value = True
+                                self.cells.setLed(self.qled_alert[int(ind/2)], Led.Orange, True)
 
 
     def setupHdf5(self):
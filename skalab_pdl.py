@@ -0,0 +1,254 @@
+import time
+import datetime
+import h5py
+import numpy as np
+from threading import Event
+from concurrent.futures import ThreadPoolExecutor
+from skalab_utils import BandPower
+from skalab_preadu import read_routing_table, adu_power, ROUTING_TABLE_AAVS1, ROUTING_TABLE_AAVS3, fibre_remap
+
+NOF_FIBRES = 16
+
+# ADC RMS ordering of the TPM 1.2 (preADU < 3.0)
+RMS_REMAP_TPM12 = np.array([1, 0, 3, 2, 5, 4, 7, 6,
+                            8, 9, 10, 11, 12, 13, 14, 15,
+                            17, 16, 19, 18, 21, 20, 23, 22,
+                            24, 25, 26, 27, 28, 29, 30, 31])
+
+# Power reported for a dead input (RMS = 0)
+NO_SIGNAL_DBM = -60.
+POLS = ['Pol-X', 'Pol-Y']
+
+
+def fibre_pairs(nof_tiles, fibres=range(NOF_FIBRES)):
+    """ All the (tile, fibre) pairs of a station, zero based """
+    return [(t, f) for t in range(nof_tiles) for f in fibres]
+
+
+def parse_pairs(pairs):
+    """ "1:1,1:2,3:1-16" style strings (TPM:Fibre or TPM:First-Last, one based) into zero based (tile, fibre) pairs """
+    result = []
+    for item in pairs.split(","):
+        tile, fibre = item.split(":")
+        if "-" in fibre:
+            fibres = list(range(int(fibre.split("-")[0]) - 1, int(fibre.split("-")[1])))
+        else:
+            fibres = [int(fibre) - 1]
+        result += [(int(tile) - 1, f) for f in fibres]
+    return result
+
+
+def tile_rms(tile, version):
+    """ ADC RMS of the 32 ADU inputs of a tile, in the ADU input order """
+    adc_rms = np.asarray(tile.get_adc_rms(), dtype=float)
+    if float(version) < 3:
+        return adc_rms[RMS_REMAP_TPM12]
+    return adc_rms
+
+
+class RingBuffer(object):
+    """ The last 'size' rows of a (time, columns) series, preallocated """
+    def __init__(self, size, width):
+        self.size = int(size)
+        self.tstamp = np.zeros(self.size)
+        self.values = np.zeros((self.size, width))
+        self.count = 0
+
+    def append(self, tstamp, values):
+        n = self.count % self.size
+        self.tstamp[n] = tstamp
+        self.values[n] = values
+        self.count += 1
+
+    def data(self):
+        """ Timestamps and values in time order """
+        if self.count <= self.size:
+            return self.tstamp[:self.count], self.values[:self.count]
+        n = self.count % self.size
+        return np.roll(self.tstamp, -n), np.roll(self.values, -n, axis=0)
+
+
+class PdlStats(object):
+    """ Running first/last/min/max/mean of each column, the PDL is max - min """
+    def __init__(self, width):
+        self.count = 0
+        self.first = np.full(width, np.nan)
+        self.last = np.full(width, np.nan)
+        self.min = np.full(width, np.inf)
+        self.max = np.full(width, -np.inf)
+        self.mean = np.zeros(width)
+
+    def update(self, values):
+        if not self.count:
+            self.first[:] = values
+        self.count += 1
+        self.last[:] = values
+        np.minimum(self.min, values, out=self.min)
+        np.maximum(self.max, values, out=self.max)
+        self.mean += (values - self.mean) / self.count
+
+    def pdl(self):
+        return self.max - self.min
+
+
+class PdlWriter(object):
+    """ Stream the measurement into an HDF5 file, the datasets grow by chunks while acquiring """
+    def __init__(self, fname, columns, attrs=None, chunk=256):
+        self.chunk = chunk
+        self.count = 0
+        self.f = h5py.File(fname, "w")
+        self.f.create_dataset("columns", data=np.array(columns, dtype="S"))
+        self.tstamp = self.f.create_dataset("tstamp", (0,), maxshape=(None,), dtype=np.float64, chunks=(chunk,))
+        self.power = self.f.create_dataset("power", (0, len(columns)), maxshape=(None, len(columns)),
+                                           dtype=np.float32, chunks=(chunk, len(columns)))
+        for k, v in (attrs or {}).items():
+            self.f.attrs[k] = v
+
+    def append(self, tstamp, values):
+        if self.count == len(self.tstamp):
+            self.tstamp.resize((self.count + self.chunk,))
+            self.power.resize((self.count + self.chunk, self.power.shape[1]))
+        self.tstamp[self.count] = tstamp
+        self.power[self.count] = values
+        self.count += 1
+        if not self.count % self.chunk:
+            self.f.flush()
+
+    def close(self, stats=None):
+        self.tstamp.resize((self.count,))
+        self.power.resize((self.count, self.power.shape[1]))
+        if stats is not None:
+            for k in ["first", "min", "max", "mean"]:
+                self.f.create_dataset(k, data=getattr(stats, k))
+            self.f.create_dataset("pdl", data=stats.pdl())
+        self.f.close()
+
+
+class PdlRunner(object):
+    def __init__(self, tiles, pairs, version="2.1", mode="rms", mydaq=None, resolution=1000, band=(160, 160),
+                 interval=0.1, history=4096, hdf5_file="", logger=None):
+        """
+        Headless PDL measurement of many (tile, fibre) pairs at once, zero based.
+
+        Each sample reads the RMS of all the tiles involved concurrently (mode "rms"), or a raw burst
+        of the whole station through mydaq (mode "daq") whose band power is computed per tile in parallel.
+        Samples go to a ring buffer, to the optional HDF5 file and to the running statistics; the subscribers
+        (e.g. a plot) are called with (tstamp, values, stats) after each sample.
+        Columns are ordered as the pairs, Pol-X and Pol-Y for each one.
+        """
+        super(PdlRunner, self).__init__()
+        self.tiles = tiles
+        self.pairs = [(int(t), int(f)) for t, f in pairs]
+        self.version = version
+        self.mode = mode
+        self.mydaq = mydaq
+        self.interval = interval
+        self.logger = logger
+        self.subscribers = []
+        self.stop_event = Event()
+        self.columns = ["TPM-%02d_INPUT-%02d_%s" % (t + 1, f + 1, p) for t, f in self.pairs for p in POLS]
+        self.used_tiles = sorted(set([t for t, f in self.pairs]))
+        self.spectrum = BandPower(resolution, [band]) if mode == "daq" else None
+
+        # Where each column is found in the (used tiles x 32) RMS matrix
+        rf_map = read_routing_table(ROUTING_TABLE_AAVS3 if float(version) >= 3 else ROUTING_TABLE_AAVS1)
+        is_x = np.zeros(32, dtype=bool)
+        is_x[rf_map['adu_in']] = np.char.upper(rf_map['pol']) == "RF-2"
+        remap = fibre_remap(version)
+        self.rms_row = np.zeros(len(self.columns), dtype=int)
+        self.rms_input = np.zeros(len(self.columns), dtype=int)
+        for k, (t, f) in enumerate(self.pairs):
+            for n in range(2):
+                rx = remap[f * 2 + n]
+                col = 2 * k + (0 if is_x[rx] else 1)
+                self.rms_row[col] = self.used_tiles.index(t)
+                self.rms_input[col] = rx
+        # Fibres and columns of each tile for the raw data
+        self.daq_fibres = {}
+        for k, (t, f) in enumerate(self.pairs):
+            fibres, cols = self.daq_fibres.setdefault(t, ([], []))
+            fibres += [f]
+            cols += [2 * k, 2 * k + 1]
+
+        self.ring = RingBuffer(history, len(self.columns))
+        self.stats = PdlStats(len(self.columns))
+        self.writer = None
+        if hdf5_file:
+            self.writer = PdlWriter(hdf5_file, self.columns, attrs={'version': version, 'mode': mode,
+                                                                    'interval': interval})
+        self.pool = ThreadPoolExecutor(max_workers=max(len(self.used_tiles), 1), thread_name_prefix="PDL")
+        self.closed = False
+
+    def subscribe(self, callback):
+        self.subscribers += [callback]
+
+    def stop(self):
+        self.stop_event.set()
+
+    def read_rms(self):
+        rms = np.array(list(self.pool.map(lambda t: tile_rms(self.tiles[t], self.version), self.used_tiles)))
+        power = adu_power(rms[self.rms_row, self.rms_input])
+        return np.where(power == -np.inf, NO_SIGNAL_DBM, power)
+
+    def read_daq(self):
+        data = self.mydaq.execute()
+        values = np.zeros(len(self.columns))
+
+        def tile_power(t):
+            fibres, cols = self.daq_fibres[t]
+            raw = np.asarray(data[t])[fibres, :2, :]
+            values[cols] = self.spectrum.power_db(raw.reshape(len(fibres) * 2, -1))[:, 0]
+        list(self.pool.map(tile_power, self.used_tiles))
+        return values
+
+    def acquire(self, tstamp):
+        values = self.read_daq() if self.mode == "daq" else self.read_rms()
+        self.ring.append(tstamp, values)
+        self.stats.update(values)
+        if self.writer is not None:
+            self.writer.append(tstamp, values)
+        for callback in self.subscribers:
+            try:
+                callback(tstamp, values, self.stats)
+            except Exception as e:
+                if self.logger is not None:
+                    self.logger.warning("PDL subscriber error: " + str(e))
+        return values
+
+    def run(self, duration=10):
+        """
+        Acquire until duration seconds are elapsed or stop() is called, return the running statistics.
+        The runner is closed at the end (HDF5 file and thread pool), it can run only once.
+        """
+        if self.closed:
+            raise RuntimeError("This PdlRunner has already run, create a new one for another measurement")
+        self.stop_event.clear()
+        t_start = datetime.datetime.utcnow().timestamp()
+        t_stamp = 0.0
+        try:
+            while t_stamp <= duration and not self.stop_event.is_set():
+                t_sample = time.time()
+                self.acquire(t_stamp)
+                if self.mode == "rms":
+                    # The interval is between samples, the acquisition time is part of it
+                    self.stop_event.wait(max(self.interval - (time.time() - t_sample), 0))
+                t_stamp = datetime.datetime.utcnow().timestamp() - t_start
+        finally:
+            self.close()
+        if self.logger is not None:
+            self.logger.info("PDL measurement of %d fibres: %d samples in %3.1f s" %
+                             (len(self.pairs), self.stats.count, t_stamp))
+        return self.stats
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close(self.stats)
+            self.writer = None
+        self.pool.shutdown(wait=True)
+        self.closed = True
+
+    def series(self, pair):
+        """ Timestamps, Pol-X and Pol-Y of a pair from the ring buffer """
+        k = self.pairs.index(pair)
+        t, v = self.ring.data()
+        return t, v[:, 2 * k], v[:, 2 * k + 1]
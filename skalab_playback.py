@@ -1,21 +1,22 @@
 #!/usr/bin/env python
 import datetime
 
-from skalab_base import SkalabBase
+from skalab_base import SkalabBase, load_ui
 from skalab_log import SkalabLog
 import shutil
 import sys
 import os
 import gc
-import glob
 from pathlib import Path
+from collections import deque
 
 import configparser
 import numpy as np
 from PyQt5 import QtWidgets, uic, QtCore, QtGui
 from PyQt5.QtCore import Qt
-from skalab_utils import dB2Linear, linear2dB, MiniPlots, read_data, dircheck, findtiles, calc_disk_usage
+from skalab_utils import dB2Linear, linear2dB, MiniPlots, read_data, RawDataCatalogue, format_size
 from skalab_utils import calcolaspettro, closest, parse_profile, getTextFromFile, moving_average
+from skalab_utils import BandPower, decodeBandList
 from pyaavs import station
 from pydaq.persisters import FileDAQModes, RawFormatFileManager
 COLORI = ["b", "g"]
@@ -71,12 +72,51 @@ configuration = {'tiles': None,
                  }
 
 
+class PlaybackHistory(object):
+    """
+    Results of the last 'size' files seen in follow mode, each file is analysed only once when it arrives:
+    band powers, ADU RMS, RF power and the spectrogram rows of the selected inputs (rows are input * 2 + pol).
+    """
+    def __init__(self, size, settings):
+        self.settings = settings
+        input_list, power_rbw, power_bands, spg_rbw, spg_band, spg_pol = settings
+        self.inputs = np.array(input_list) - 1
+        self.spg_pol = spg_pol
+        self.band_power = BandPower(power_rbw, power_bands)
+        self.spg = BandPower(spg_rbw)
+        self.spg_lo = closest(self.spg.asse_x, spg_band[0])
+        self.spg_hi = closest(self.spg.asse_x, spg_band[1])
+        self.count = 0
+        self.tstamp = deque(maxlen=size)
+        self.bandpower = deque(maxlen=size)
+        self.rms = deque(maxlen=size)
+        self.rfpow = deque(maxlen=size)
+        self.spgram = deque(maxlen=size)
+
+    def add(self, tstamp, data):
+        raw = data[self.inputs, :2, :].reshape(len(self.inputs) * 2, -1)
+        adu_rms = np.sqrt(np.mean(np.power(raw.astype(np.int64), 2), axis=1))
+        with np.errstate(divide='ignore'):
+            rfpow = 10 * np.log10(np.power(adu_rms * (1.7 / 256.), 2) / 400.) + 30 + 12
+            spgram = 10 * np.log10(self.spg.spectra(raw[self.spg_pol::2])[:, self.spg_lo:self.spg_hi + 1])
+        self.tstamp.append(tstamp)
+        self.bandpower.append(self.band_power.power_db(raw))
+        self.rms.append(adu_rms)
+        self.rfpow.append(rfpow)
+        self.spgram.append(spgram.astype(np.float32))
+        self.count += 1
+
+    def first(self):
+        """ Sample number of the oldest file kept """
+        return self.count - len(self.tstamp)
+
+
 class Playback(SkalabBase):
     """ Main UI Window class """
 
     def __init__(self, config="", uiFile="", profile="Default", size=[1190, 936], swpath=default_app_dir):
         """ Initialise main window """
-        self.wg = uic.loadUi(uiFile)
+        self.wg = load_ui(uiFile)
         self.wgProBox = QtWidgets.QWidget(self.wg.qtab_conf)
         self.wgProBox.setGeometry(QtCore.QRect(1, 1, 800, 860))
         self.wgProBox.setVisible(True)
@@ -135,6 +175,12 @@ class Playback(SkalabBase):
         self.show_rms_grid = self.wg.qcheck_rms_grid.isChecked()
         self.show_power_grid = self.wg.qcheck_power_grid.isChecked()
         self.move_avg = {}
+        self.band_power = None
+        self.power_bands = []
+        try:
+            self.power_bands = decodeBandList(self.profile['Playback']['power_bands'])
+        except:
+            pass
 
         self.input_list = np.arange(1, 17)
         self.channels_line = self.wg.qline_channels.text()
@@ -143,6 +189,24 @@ class Playback(SkalabBase):
         self.yAxisRange = [float(self.wg.qline_level_min.text()), float(self.wg.qline_level_max.text())]
 
         self.tiles = []
+        self.catalogue = RawDataCatalogue()
+        self.data_tile = None
+        # File timestamp (from its name) of the last file appended to self.data
+        self.data_tstamp = 0
+        self.follow_tile = None
+        self.follow_tstamp = 0
+        self.follow_pending = None
+        self.follow_history = None
+        self.follow_manager = None
+        self.follow_interval = 2
+        self.follow_size = 500
+        try:
+            self.follow_interval = float(self.profile['Playback']['follow_interval'])
+            self.follow_size = int(self.profile['Playback']['follow_history'])
+        except:
+            pass
+        self.follow_timer = QtCore.QTimer(self)
+        self.follow_timer.timeout.connect(self.follow_update)
         self.data = []
         self.power = {}
         self.raw = {}
@@ -187,6 +251,7 @@ class Playback(SkalabBase):
         self.wg.qcheck_ypol_sp.stateChanged.connect(self.cb_show_yline)
         self.wg.qcheck_rms.stateChanged.connect(self.cb_show_rms)
         self.wg.qbutton_save.clicked.connect(lambda: self.savePicture())
+        self.wg.qcheck_follow.stateChanged.connect(self.follow_toggle)
 
     def setup_config(self):
         if not self.config_file == "":
@@ -239,25 +304,25 @@ class Playback(SkalabBase):
 
     def check_dir(self):
         if not self.wg.qline_datapath.text() == "":
-            self.data_tiles = findtiles(directory=self.wg.qline_datapath.text())
+            self.catalogue.open(self.wg.qline_datapath.text())
+            self.data_tiles = self.catalogue.tiles()
             self.wg.qlabel_dircheck.setText("Found HDF5 Raw files for %d Tiles" % len(self.data_tiles))
             self.play_tpm_update()
 
     def calc_data_volume(self):
         if not self.wg.qline_datapath.text() == "":
-            if len(self.data_tiles):
-                self.wg.qlabel_dataload.setText("# Files: %d" %
-                        dircheck(self.wg.qline_datapath.text(),
-                                 int(self.data_tiles[self.wg.qcombo_tpm.currentIndex()])) +
-                        ", Data Volume: " + calc_disk_usage(self.wg.qline_datapath.text(),
-                        "raw_burst_%d_*.hdf5" % int(self.data_tiles[self.wg.qcombo_tpm.currentIndex()])))
-                #print("raw_burst_%d_*.hdf5" % int(self.data_tiles[self.wg.qcombo_tpm.currentIndex()]))
+            if len(self.data_tiles) and self.wg.qcombo_tpm.currentIndex() >= 0:
+                self.catalogue.refresh()
+                tile = int(self.data_tiles[self.wg.qcombo_tpm.currentIndex()])
+                self.wg.qlabel_dataload.setText("# Files: %d" % self.catalogue.count(tile) +
+                                                ", Data Volume: " + format_size(self.catalogue.volume(tile)))
 
     def load_data(self):
         if not self.wg.qline_datapath.text() == "":
             if os.path.isdir(self.wg.qline_datapath.text()):
-                lista = sorted(glob.glob(self.wg.qline_datapath.text() + "/raw_burst_%d_*hdf5" % int(
-                    self.data_tiles[self.wg.qcombo_tpm.currentIndex()])))
+                self.catalogue.open(self.wg.qline_datapath.text())
+                lista = self.catalogue.files(self.data_tiles[self.wg.qcombo_tpm.currentIndex()])
+                tstamps = self.catalogue.timestamps(self.data_tiles[self.wg.qcombo_tpm.currentIndex()])
                 self.nof_files = len(lista)
                 if self.nof_files:
                     progress_format = "TILE-%02d   " % (self.data_tiles[self.wg.qcombo_tpm.currentIndex()] + 1) + "%p%"
@@ -268,14 +333,18 @@ class Playback(SkalabBase):
                     del self.data
                     gc.collect()
                     self.data = []
+                    self.data_tstamp = 0
+                    self.data_tile = int(self.data_tiles[self.wg.qcombo_tpm.currentIndex()])
+                    self.follow_history = None
                     for nn, l in enumerate(lista):
                         # Call the data Load
                         t, d = read_data(fmanager=file_manager,
                                          hdf5_file=l,
                                          tile=self.data_tiles[self.wg.qcombo_tpm.currentIndex()],
-                                         nof_tiles=self.nof_tiles)
+                                         nof_tiles=self.nof_tiles, tstamp=tstamps[nn])
                         if t:
                             self.data += [{'timestamp': t, 'data': d}]
+                            self.data_tstamp = tstamps[nn]
                         self.wg.qprogress_load.setValue(int((nn + 1) * 100 / len(lista)))
                     self.wg.qline_sample_start.setText("1")
                     self.wg.qline_sample_stop.setText("%d" % len(lista))
@@ -422,20 +491,31 @@ class Playback(SkalabBase):
                         for npol, pol in enumerate(["Pol-X", "Pol-Y"]):
                             self.power["Input-%02d_%s" % (i, pol)] = []
                             self.power["Input-%02d_%s_adc-clip" % (i, pol)] = []
+                    # The plotted band first, then the ones of the profile (only exported)
+                    bands = [("", float(self.wg.qline_power_band_from.text()),
+                              float(self.wg.qline_power_band_to.text()))] + self.power_bands
+                    if self.band_power is None or not self.band_power.rbw == self.rbw or \
+                            not self.band_power.bands == [(b[1], b[2]) for b in bands]:
+                        self.band_power = BandPower(self.resolutions[self.rbw], [(b[1], b[2]) for b in bands])
+                    for name, start, stop in self.power_bands:
+                        for i in self.input_list:
+                            for pol in ["Pol-X", "Pol-Y"]:
+                                self.power["Input-%02d_%s_%s" % (i, pol, name)] = []
+                    inputs = np.array(self.input_list) - 1
                     self.power_x = []
                     for k in range(self.nof_files):
                         self.power_x += [self.data[k]['timestamp']]
+                        # All the inputs and pols of a file in one batch: rows are input * 2 + pol
+                        raw = self.data[k]['data'][inputs, :2, :].reshape(len(inputs) * 2, -1)
+                        clip = ((raw == 127) | (raw == -128)).any(axis=1)
+                        bandpower = self.band_power.power_db(raw)
                         for n, i in enumerate(self.input_list):
                             for npol, pol in enumerate(["Pol-X", "Pol-Y"]):
-                                if 127 in self.data[k]['data'][i - 1, npol, :] or \
-                                        -128 in self.data[k]['data'][i - 1, npol, :]:
+                                if clip[n * 2 + npol]:
                                     self.power["Input-%02d_%s_adc-clip" % (i, pol)] += [self.data[k]['timestamp']]
-                                spettro, rfpow, rms = calcolaspettro(self.data[k]['data'][i - 1, npol, :], self.nsamples, log=False)
-                                bandpower = np.sum(spettro[closest(self.asse_x, float(self.wg.qline_power_band_from.text())): closest(self.asse_x, float(self.wg.qline_power_band_to.text()))])
-                                if not len(self.power["Input-%02d_%s" % (i, pol)]):
-                                    self.power["Input-%02d_%s" % (i, pol)] = [linear2dB(bandpower)]
-                                else:
-                                    self.power["Input-%02d_%s" % (i, pol)] += [linear2dB(bandpower)]
+                                self.power["Input-%02d_%s" % (i, pol)] += [bandpower[n * 2 + npol, 0]]
+                                for b, band in enumerate(self.power_bands):
+                                    self.power["Input-%02d_%s_%s" % (i, pol, band[0])] += [bandpower[n * 2 + npol, b + 1]]
                         self.wg.qprogress_plot.setValue(int((k + 1) * 100 / self.nof_files))
 
                     if not self.wg.qcheck_datetime.isChecked():
@@ -469,6 +549,13 @@ class Playback(SkalabBase):
                         self.powerPlots.plotPower(self.power_x, self.move_avg["Input-%02d_Pol-Y" % i], n, xAxisRange=xAxisRange,
                                                   colore="g", show_line=self.wg.qcheck_ypol_power.isChecked(), lw=lw,
                                                   xdatetime=self.wg.qcheck_datetime.isChecked())
+                    for name, start, stop in self.power_bands:
+                        for i in self.input_list:
+                            for pol in ["Pol-X", "Pol-Y"]:
+                                key = "Input-%02d_%s_%s" % (i, pol, name)
+                                self.move_avg[key] = self.power[key].copy()
+                                if self.wg.qcheck_movavg.isChecked():
+                                    self.move_avg[key] = moving_average(self.power[key].copy(), move_avg_len)
                     self.powerPlots.updatePlot()
                     self.wg.qbutton_export.setEnabled(True)
                     self.wg.qbutton_save.setEnabled(True)
@@ -566,6 +653,153 @@ class Playback(SkalabBase):
                 self.rmsPlots.updatePlot()
                 self.wg.qbutton_save.setEnabled(True)
 
+    def follow_toggle(self, state):
+        if state == Qt.Checked:
+            if self.wg.qline_datapath.text() == "" or not self.data_tiles:
+                msgBox = QtWidgets.QMessageBox()
+                msgBox.setText("Please SELECT a valid data directory first...")
+                msgBox.setWindowTitle("Error!")
+                msgBox.exec_()
+                self.wg.qcheck_follow.setChecked(False)
+                return
+            self.follow_tile = int(self.data_tiles[self.wg.qcombo_tpm.currentIndex()])
+            self.follow_manager = RawFormatFileManager(root_path=self.wg.qline_datapath.text(),
+                                                       daq_mode=FileDAQModes.Burst)
+            self.catalogue.open(self.wg.qline_datapath.text())
+            # The data loaded for this tile is the start of the history, from now on only the new files are read
+            if not self.data_tile == self.follow_tile:
+                self.data = []
+                self.data_tstamp = 0
+                self.data_tile = self.follow_tile
+            # Files acquired after the loaded ones are read by the first check, at most the last follow_size
+            # of them if nothing is loaded
+            self.follow_tstamp = self.data_tstamp if self.data else 0
+            self.follow_pending = None
+            self.follow_history = None
+            self.wg.qbutton_load.setEnabled(False)
+            self.wg.qcombo_tpm.setEnabled(False)
+            self.wg.qbutton_browse.setEnabled(False)
+            self.follow_timer.start(int(self.follow_interval * 1000))
+            self.logger.logger.info("Following TILE-%02d files in %s" % (self.follow_tile + 1,
+                                                                        self.wg.qline_datapath.text()))
+        else:
+            self.follow_timer.stop()
+            self.wg.qbutton_load.setEnabled(True)
+            self.wg.qcombo_tpm.setEnabled(True)
+            self.wg.qbutton_browse.setEnabled(True)
+
+    def follow_settings(self):
+        """ Everything the analysis of a file depends on, a change restarts the history from the loaded data """
+        bands = [(float(self.wg.qline_power_band_from.text()), float(self.wg.qline_power_band_to.text()))]
+        bands += [(b[1], b[2]) for b in self.power_bands]
+        return (tuple(self.input_list), float(self.wg.qline_power_rbw.text()), bands,
+                float(self.wg.qline_spg_rbw.text()),
+                (float(self.wg.qline_spg_band_from.text()), float(self.wg.qline_spg_band_to.text())),
+                1 if self.wg.qcheck_ypol_spg.isChecked() else 0)
+
+    def follow_update(self):
+        if not self.wg.qline_channels.text() == self.channels_line:
+            self.reformat_plots()
+        try:
+            settings = self.follow_settings()
+        except ValueError:
+            return
+        replot = False
+        if self.follow_history is None or not self.follow_history.settings == settings:
+            self.follow_history = PlaybackHistory(self.follow_size, settings)
+            for d in self.data[-self.follow_size:]:
+                self.follow_history.add(d['timestamp'], d['data'])
+            replot = True
+        self.catalogue.refresh()
+        # Older files would be dropped from the history anyway
+        new_files = self.catalogue.newer(self.follow_tile, self.follow_tstamp)[-self.follow_size:]
+        loaded = False
+        for n, (tstamp, fname) in enumerate(new_files):
+            if n == len(new_files) - 1:
+                # The newest file may still be written, it is read once its size is the same of the previous check
+                pending = (tstamp, self.catalogue.volume(self.follow_tile))
+                if not pending == self.follow_pending:
+                    self.follow_pending = pending
+                    break
+            try:
+                t, d = read_data(fmanager=self.follow_manager, hdf5_file=fname, tile=self.follow_tile,
+                                 nof_tiles=self.nof_tiles, tstamp=tstamp)
+            except Exception:
+                # Still being written, it is read at the next check
+                break
+            self.follow_tstamp = tstamp
+            if t:
+                self.data += [{'timestamp': t, 'data': d}]
+                self.data_tstamp = tstamp
+                self.follow_history.add(t, d)
+                loaded = True
+                if len(self.data) > self.follow_size:
+                    del self.data[:len(self.data) - self.follow_size]
+        self.nof_files = len(self.data)
+        self.calc_data_volume()
+        if (loaded or replot) and self.follow_history.count:
+            for q in [self.wg.qline_sample_stop, self.wg.qline_avg_sample_stop, self.wg.qline_power_sample_stop,
+                      self.wg.qline_rms_sample_stop]:
+                q.setText("%d" % self.nof_files)
+            self.wg.qlabel_raw_filenum.setText("Select File Number (%d-%d)" % (1, self.nof_files))
+            self.follow_plot()
+
+    def follow_plot(self):
+        """ Plot the history of the follow mode in the selected view """
+        h = self.follow_history
+        samples = np.arange(h.first(), h.count)
+        if self.wg.qradio_spectrogram.isChecked():
+            spgram = np.array(h.spgram)
+            wclim = (int(self.wg.qline_spg_color_min.text()), int(self.wg.qline_spg_color_max.text()))
+            band = h.settings[4]
+            for num, tpm_input in enumerate(self.input_list):
+                self.spectrogramPlots.plotSpectrogram(spettrogramma=spgram[:, num, :], ant=num,
+                                                      ytickstep=int((band[1] - band[0]) / 5),
+                                                      xmin=h.first(), xmax=h.count, startfreq=band[0],
+                                                      stopfreq=band[1], title="INPUT-%02d" % int(tpm_input),
+                                                      wclim=wclim)
+            self.spectrogramPlots.updatePlot()
+        elif self.wg.qradio_power.isChecked():
+            lw = 0 if self.wg.qcheck_power_noline.isChecked() else 1
+            power = np.array(h.bandpower)
+            self.power_x = list(h.tstamp) if self.wg.qcheck_datetime.isChecked() else samples.tolist()
+            xAxisRange = (self.power_x[0], self.power_x[-1])
+            yAxisRange = (float(self.wg.qline_power_level_min.text()), float(self.wg.qline_power_level_max.text()))
+            self.move_avg = {}
+            self.powerPlots.plotClear()
+            for n, i in enumerate(self.input_list):
+                for npol, pol in enumerate(["Pol-X", "Pol-Y"]):
+                    self.move_avg["Input-%02d_%s" % (i, pol)] = power[:, n * 2 + npol, 0].tolist()
+                    for b, band in enumerate(self.power_bands):
+                        self.move_avg["Input-%02d_%s_%s" % (i, pol, band[0])] = power[:, n * 2 + npol, b + 1].tolist()
+                self.powerPlots.plotPower(self.power_x, power[:, n * 2, 0], n, xAxisRange=xAxisRange,
+                                          yAxisRange=yAxisRange, title="INPUT-%02d" % i, xLabel="time samples",
+                                          yLabel="dB", colore="b", grid=self.show_power_grid, lw=lw,
+                                          show_line=self.wg.qcheck_xpol_power.isChecked(),
+                                          xdatetime=self.wg.qcheck_datetime.isChecked())
+                self.powerPlots.plotPower(self.power_x, power[:, n * 2 + 1, 0], n, xAxisRange=xAxisRange,
+                                          colore="g", show_line=self.wg.qcheck_ypol_power.isChecked(), lw=lw,
+                                          xdatetime=self.wg.qcheck_datetime.isChecked())
+            self.powerPlots.updatePlot()
+            self.wg.qbutton_export.setEnabled(True)
+        elif self.wg.qradio_rms.isChecked():
+            lw = 0 if self.wg.qcheck_rms_noline.isChecked() else 1
+            if self.wg.qcheck_raw_dbm.isChecked():
+                rms = np.array(h.rfpow)
+                yAxisRange = (float(self.wg.qline_rms_level_min.text()), float(self.wg.qline_rms_level_max.text()))
+            else:
+                rms = np.array(h.rms)
+                yAxisRange = (float(self.wg.qline_rms_min.text()), float(self.wg.qline_rms_max.text()))
+            self.rmsPlots.plotClear()
+            for n, i in enumerate(self.input_list):
+                self.rmsPlots.plotPower(samples, rms[:, n * 2], n, xAxisRange=(samples[0], samples[-1]),
+                                        yAxisRange=yAxisRange, title="INPUT-%02d" % i, xLabel="time samples",
+                                        yLabel="ADU RMS", colore="b", grid=self.show_rms_grid, lw=lw,
+                                        show_line=self.wg.qcheck_xpol_rms.isChecked())
+                self.rmsPlots.plotPower(samples, rms[:, n * 2 + 1], n, colore="g",
+                                        show_line=self.wg.qcheck_ypol_rms.isChecked(), lw=lw)
+            self.rmsPlots.updatePlot()
+
     def export_data(self):
         if self.wg.qradio_spectrogram.isChecked():
             msgBox = QtWidgets.QMessageBox()
@@ -864,6 +1098,7 @@ class Playback(SkalabBase):
         self.wg.qbutton_apply.setEnabled(False)
 
     def cmdClose(self):
+        self.follow_timer.stop()
         self.stopThreads = True
         self.logger.logger.info("Stopping Threads")
         self.logger.stopLog()
@@ -1,8 +1,11 @@
 import gc
+import os
 import struct
 import time
 import copy
 import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
 from PyQt5 import QtWidgets, QtCore, QtGui
 
 CHANNELS = 32
@@ -22,6 +25,27 @@ DIALOG_HEIGHT = 720
 
 SIGNALS_MAP_FILENAME = "SignalMap/signals_map.txt"
 
+SKALAB_DIR = os.path.dirname(os.path.abspath(__file__))
+ROUTING_TABLE_AAVS1 = "SignalMap/TPM_AAVS1.txt"
+ROUTING_TABLE_AAVS3 = "SignalMap/TPM_AAVS3.txt"
+# ADU Input, RF-Pol, Fiber Input, PreADU ID, ChannelFilter IDx
+ROUTING_DTYPE = np.dtype([('adu_in', np.int16), ('pol', 'U8'), ('fibre', 'U8'),
+                          ('preadu_id', np.int16), ('channel_filter', np.int16)])
+# Routing tables parsed so far: {absolute path: (mtime, table)}
+ROUTING_TABLES = {}
+
+# ADU input of the two receivers of each input fibre (fibre * 2, fibre * 2 + 1) for each preADU version
+FIBRE_REMAP = {"2.1": [1, 0, 3, 2, 5, 4, 7, 6,
+                       17, 16, 19, 18, 21, 20, 23, 22,
+                       30, 31, 28, 29, 26, 27, 24, 25,
+                       14, 15, 12, 13, 10, 11, 8, 9],
+               "3.0": [15, 14, 13, 12, 11, 10, 9, 8,
+                       6, 7, 4, 5, 2, 3, 0, 1,
+                       31, 30, 29, 28, 27, 26, 25, 24,
+                       22, 23, 20, 21, 18, 19, 16, 17]}
+FIBRE_REMAP["3.1"] = FIBRE_REMAP["3.0"]
+ROUTING_TABLES_LOCK = Lock()
+
 
 def bound(value, low=0, high=31):
     '''
@@ -126,6 +150,7 @@ def update_flag_termination(record, val):
 def create_record(Dialog, rf_map):
     rec = {}
     idx = int(rf_map[0])
+    rf_map = [str(x) for x in rf_map]
     rec['reg_val'] = 0
     rec['label'] = create_label(Dialog, 10 + 20 + (((idx & 8) >> 3) * TABLE_HSPACE),
                                 90 + ((idx & 7) * TABLE_VSPACE) + (((idx & 16) >> 4) * 280), rf_map[0].strip() + ":")
@@ -169,16 +194,58 @@ def font_normal():
     return font
 
 
-def read_routing_table(map_file):
+def parse_routing_table(map_file):
     mappa = []
     f_map = open(map_file)
     input_list = f_map.readlines()
     for i in input_list:
         if not'#' in i[:2] and not " " in i[0]:
             if len(i.split(",")) > 2:
-                mappa += [i.split(",")]
+                mappa += [tuple([x.strip() for x in i.split(",")])]
     f_map.close()
-    return mappa
+    return np.array(mappa, dtype=ROUTING_DTYPE)
+
+
+def read_routing_table(map_file):
+    """
+    Signal routing table as a read only structured array (one record per ADU input).
+    Each file is parsed once per process and shared, it is parsed again only if modified.
+    Relative paths are taken from the SKALAB folder, not from the current directory.
+    """
+    if not os.path.isabs(map_file):
+        map_file = os.path.join(SKALAB_DIR, map_file)
+    map_file = os.path.normpath(map_file)
+    mtime = os.stat(map_file).st_mtime_ns
+    with ROUTING_TABLES_LOCK:
+        if map_file not in ROUTING_TABLES or not ROUTING_TABLES[map_file][0] == mtime:
+            table = parse_routing_table(map_file)
+            table.flags.writeable = False
+            ROUTING_TABLES[map_file] = (mtime, table)
+        return ROUTING_TABLES[map_file][1]
+
+
+def fibre_remap(preadu_version):
+    """ Fibre to ADU input remap of a preADU version, the versions not listed take the one of their family """
+    if str(preadu_version) in FIBRE_REMAP.keys():
+        return FIBRE_REMAP[str(preadu_version)]
+    if float(preadu_version) < 3:
+        return FIBRE_REMAP["2.1"]
+    return FIBRE_REMAP["3.0"]
+
+
+def routing_table_file(preadu_version):
+    if preadu_version == "3.1":
+        return ROUTING_TABLE_AAVS3
+    return ROUTING_TABLE_AAVS1
+
+
+def spi_remap_vectors(rf_map):
+    """ PreADU id and channel filter index of each ADU input, as two arrays indexed by the ADU input """
+    preadu_ids = np.zeros(CHANNELS, dtype=int)
+    channel_filters = np.zeros(CHANNELS, dtype=int)
+    preadu_ids[rf_map['adu_in']] = rf_map['preadu_id']
+    channel_filters[rf_map['adu_in']] = rf_map['channel_filter']
+    return preadu_ids, channel_filters
 
 
 class Rx:
@@ -941,7 +1008,7 @@ class Preadu(object):
         self.write_armed = False  # Tells the top layer (skalab_live) that a write operation is ready to go
 
         self.inputs = CHANNELS
-        self.rf_map = read_routing_table("./SignalMap/TPM_AAVS1.txt")
+        self.rf_map = read_routing_table(routing_table_file(self.preadu_version))
         if self.preadu_version == "2.0":
             self.preadu = preAduRf()
             print(self.tpm.get_ip() + " PREADU: RF without optical receivers")
@@ -953,7 +1020,6 @@ class Preadu(object):
             print(self.tpm.get_ip() + " PREADU: SADino with Mixed RF and AAVS1 Like RF Rxs selected")
         elif self.preadu_version == "3.1":
             self.preadu = preAduAAVS3()
-            self.rf_map = read_routing_table("./SignalMap/TPM_AAVS3.txt")
             print(self.tpm.get_ip() + " PREADU: New Gen with Embedded Optical WDM Receivers selected")
 
         for spimap in self.rf_map:
@@ -963,54 +1029,80 @@ class Preadu(object):
                                      pol=spimap[1], adu_in=spimap[0], tpm_in=spimap[2])
 
         self.spi_remap = self.preadu.spi_remap
-
-    def readConfiguration(self):
+        self.last_write = {}
+        self.setupRegisterMap()
+
+    def readConfiguration(self, force=False):
+        """
+        Configuration of the 32 receivers. The registers are read from the TPM only when the cache
+        is not valid (first read, after invalidate() or a failed verify) or when forced.
+        """
         preaduConf = []
         if self.tpm is not None:
-            time.sleep(0.01)
-            self.tpm.tpm.tpm_preadu[0].read_configuration()  # TOP
-            time.sleep(0.01)
-            self.tpm.tpm.tpm_preadu[1].read_configuration()  # BOTTOM
+            if force or not self.cache_valid:
+                self.readRegisters()
             for i in range(32):
                 fw_map = self.preadu.get_spi_conf(nrx=i)
-                preadu_id = int(fw_map['preadu_id'])
-                channel_filter = int(fw_map['channel_filter'])
-                pol = fw_map['pol']
-                self.preadu.set_register_value(nrx=i, value=self.tpm.tpm.tpm_preadu[preadu_id].channel_filters[channel_filter])
+                self.preadu.set_register_value(nrx=i, value=int(self.cache[i]))
                 preaduConf += [{'id': i,
                                 'sn': "n/a",
                                 'code': self.preadu.get_register_value(nrx=i),
-                                'preadu_id': preadu_id,
-                                'channel_filter': channel_filter,
-                                'pol': pol,
+                                'preadu_id': int(fw_map['preadu_id']),
+                                'channel_filter': int(fw_map['channel_filter']),
+                                'pol': fw_map['pol'],
                                 #'dsa': self.preadu.get_rx_attenuation(i),
                                 'version': self.preadu.rx[i].version}]  # ,
         return preaduConf
 
+    def readRegisters(self, preadu_ids=(0, 1)):
+        """ Read back the given preADUs (0 TOP, 1 BOTTOM) and refresh their receivers in the cache """
+        for preadu_id in preadu_ids:
+            time.sleep(0.01)
+            self.tpm.tpm.tpm_preadu[preadu_id].read_configuration()
+        for i in range(32):
+            if self.preadu_ids[i] in preadu_ids:
+                self.cache[i] = self.tpm.tpm.tpm_preadu[self.preadu_ids[i]].channel_filters[self.channel_filters[i]]
+        self.cache_valid = True
+
+    def invalidate(self):
+        """ Next readConfiguration will read the registers from the TPM """
+        self.cache_valid = False
+
     def write_configuration(self, preaduConf=None):
+        """
+        Write the receivers whose code differs from the cache, only the preADUs holding them are
+        programmed and then read back to verify the new codes. The outcome is kept in last_write,
+        with the receivers whose readback differs from the code written in 'mismatch'.
+        """
         if preaduConf is None:
             preaduConf = []
         self.Busy = True
-        # print("\nwrite_configuration")
-        # for n, p in enumerate(preaduConf):
-        #     print(n, p)
-        if self.tpm is not None:
-            for i in range(32):
-                value = preaduConf[i]['code']
-                self.preadu.set_register_value(nrx=i, value=value)
-                fw_map = self.preadu.get_spi_conf(nrx=i)
-                preadu_id = int(fw_map['preadu_id'])
-                channel_filter = int(fw_map['channel_filter'])
-                #print("PREADU ID: %d, CHAN-FILTER %02d, RMS-INDEX %d, CODE %d" % (spi_map[0], spi_map[1], i, value))
-                self.tpm.tpm.tpm_preadu[preadu_id].channel_filters[channel_filter] = value
-            for preadu_id in [1, 0]:
-                self.tpm.tpm.tpm_preadu[preadu_id].write_configuration()
-            self.reload()
+        self.last_write = {'written': 0, 'preadu_ids': [], 'verified': True, 'mismatch': []}
+        if self.tpm is not None and len(preaduConf):
+            codes = np.array([int(preaduConf[i]['code']) for i in range(32)])
+            dirty = np.ones(32, dtype=bool) if not self.cache_valid else ~(codes == self.cache)
+            if dirty.any():
+                preadu_ids = sorted(set(self.preadu_ids[dirty].tolist()), reverse=True)
+                # The preADU configuration is written as a whole, so every channel of it is refreshed
+                for i in range(32):
+                    if self.preadu_ids[i] in preadu_ids:
+                        value = int(codes[i]) if dirty[i] else int(self.cache[i])
+                        self.preadu.set_register_value(nrx=i, value=value)
+                        self.tpm.tpm.tpm_preadu[self.preadu_ids[i]].channel_filters[self.channel_filters[i]] = value
+                for preadu_id in preadu_ids:
+                    self.tpm.tpm.tpm_preadu[preadu_id].write_configuration()
+                self.readRegisters(preadu_ids=preadu_ids)
+                mismatch = np.nonzero(dirty & ~(self.cache == codes))[0].tolist()
+                verified = not mismatch
+                if not verified:
+                    self.invalidate()
+                self.last_write = {'written': int(dirty.sum()), 'preadu_ids': preadu_ids, 'verified': verified,
+                                   'mismatch': mismatch}
         self.write_armed = False
         self.Busy = False
 
     def reload(self):
-        conf = self.readConfiguration()
+        conf = self.readConfiguration(force=True)
         if not conf == []:
             for i in range(32):
                 self.preadu.set_register_value(nrx=i, value=conf[i]['code'])
@@ -1018,11 +1110,17 @@ class Preadu(object):
             for i in range(32):
                 self.preadu.set_register_value(nrx=i, value=255)
 
+    def setupRegisterMap(self):
+        """ Where each receiver is found in the preADU registers (preadu id, channel filter), and an empty cache """
+        self.preadu_ids, self.channel_filters = spi_remap_vectors(self.rf_map)
+        self.cache = np.zeros(32, dtype=int)
+        self.cache_valid = False
+
     def set_preadu_version(self, preadu_version="3.1"):
         del self.preadu
         gc.collect()
         self.preadu_version = preadu_version
-        self.rf_map = read_routing_table("./SignalMap/TPM_AAVS1.txt")
+        self.rf_map = read_routing_table(routing_table_file(self.preadu_version))
         if self.preadu_version == "2.0":
             self.preadu = preAduRf()
             print(self.tpm.get_ip() + " PREADU: RF without optical receivers")
@@ -1034,11 +1132,11 @@ class Preadu(object):
             print(self.tpm.get_ip() + " PREADU: SADino with Mixed RF and AAVS1 Like RF Rxs selected")
         elif self.preadu_version == "3.1":
             self.preadu = preAduAAVS3()
-            self.rf_map = read_routing_table("./SignalMap/TPM_AAVS3.txt")
             print(self.tpm.get_ip() + " PREADU: New Gen with Embedded Optical WDM Receivers selected")
         for spimap in self.rf_map:
             self.preadu.set_spi_conf(nrx=int(spimap[0]), preadu_id=int(spimap[3]), channel_filter=int(spimap[4]),
                                      pol=spimap[1], adu_in=spimap[0], tpm_in=spimap[2])
+        self.setupRegisterMap()
         self.reload()
 
 
@@ -1050,6 +1148,242 @@ class TestingReceivers:
                    'NewSKAOpticalRx': NewSKAOpticalRx()}
 
 
+class RxCodec(object):
+    def __init__(self, receivers=None):
+        """
+        Vectorized encoder/decoder of the receiver register codes.
+
+        Every operation of every receiver version is tabulated once over the 256 possible codes
+        (and the 32 attenuations), so a whole tile or station of uint8 codes is decoded or updated
+        with a single numpy indexing, the version of each receiver being given by its index in self.versions.
+        """
+        super(RxCodec, self).__init__()
+        if receivers is None:
+            receivers = TestingReceivers().rx
+        self.versions = sorted(receivers.keys())
+        codes = range(256)
+        rx = [receivers[v] for v in self.versions]
+        self.lut_attenuation = np.array([[r.op_get_attenuation(c) for c in codes] for r in rx], dtype=np.uint8)
+        self.lut_set_attenuation = np.array([[[r.op_set_attenuation(c, a) & 0xff for a in range(32)] for c in codes]
+                                             for r in rx], dtype=np.uint8)
+        self.lut_hipass = np.array([[r.op_is_hipass(c) for c in codes] for r in rx], dtype=bool)
+        self.lut_lopass = np.array([[r.op_is_lopass(c) for c in codes] for r in rx], dtype=bool)
+        self.lut_terminated = np.array([[r.op_is_terminated(c) for c in codes] for r in rx], dtype=bool)
+        self.lut_set_hipass = np.array([[r.op_set_hipass(c) & 0xff for c in codes] for r in rx], dtype=np.uint8)
+        self.lut_set_lopass = np.array([[r.op_set_lopass(c) & 0xff for c in codes] for r in rx], dtype=np.uint8)
+        self.lut_rf_on = np.array([[r.op_rf_on(c) & 0xff for c in codes] for r in rx], dtype=np.uint8)
+        self.lut_rf_off = np.array([[r.op_rf_off(c) & 0xff for c in codes] for r in rx], dtype=np.uint8)
+
+    def version_index(self, versions):
+        """ Receiver version names (any shape) to their index in the lookup tables """
+        index = {}
+        for n, v in enumerate(self.versions):
+            index[v] = n
+        return np.vectorize(lambda v: index[v], otypes=[np.uint8])(np.asarray(versions, dtype=object))
+
+    def from_conf(self, conf):
+        """ (codes, versions) uint8 arrays of a tile configuration or of a list of tiles configurations """
+        if len(conf) and type(conf[0]) is dict:
+            codes = np.array([rx['code'] for rx in conf], dtype=np.uint8)
+            return codes, self.version_index([rx['version'] for rx in conf])
+        codes = np.array([[rx['code'] for rx in c] for c in conf], dtype=np.uint8)
+        return codes, self.version_index([[rx['version'] for rx in c] for c in conf])
+
+    def to_conf(self, conf, codes):
+        """ Copy the codes back into the configuration dictionaries """
+        for rx, code in zip(conf if type(conf[0]) is dict else [rx for c in conf for rx in c],
+                            np.asarray(codes).ravel().tolist()):
+            rx['code'] = int(code)
+
+    def get_attenuation(self, codes, versions):
+        return self.lut_attenuation[versions, codes]
+
+    def set_attenuation(self, codes, versions, attenuation):
+        attenuation = np.clip(np.asarray(attenuation, dtype=int), 0, 31)
+        return self.lut_set_attenuation[versions, codes, attenuation]
+
+    def is_hipass(self, codes, versions):
+        return self.lut_hipass[versions, codes]
+
+    def is_lopass(self, codes, versions):
+        return self.lut_lopass[versions, codes]
+
+    def is_terminated(self, codes, versions):
+        return self.lut_terminated[versions, codes]
+
+    def set_hipass(self, codes, versions):
+        return self.lut_set_hipass[versions, codes]
+
+    def set_lopass(self, codes, versions):
+        return self.lut_set_lopass[versions, codes]
+
+    def rf_on(self, codes, versions):
+        return self.lut_rf_on[versions, codes]
+
+    def rf_off(self, codes, versions):
+        return self.lut_rf_off[versions, codes]
+
+
+def adu_power(rms):
+    """ ADU RMS to power (dBm) """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return 10 * np.log10(np.power((np.asarray(rms, dtype=float) * (1.7 / 256.)), 2) / 400.) + 30 + 12
+
+
+class PreaduEqualizer(object):
+    def __init__(self, preadu, read_rms, settle=0.2, logger=None):
+        """
+        Closed loop equalization of the PreADU levels, it does not need the GUI.
+
+        preadu is the list of Preadu objects of the station, read_rms a function returning
+        the ADU RMS of all the tiles as a (tiles x 32) array, indexed as the receivers of the configuration.
+        """
+        super(PreaduEqualizer, self).__init__()
+        self.preadu = preadu
+        self.read_rms = read_rms
+        self.settle = settle
+        self.logger = logger
+        self.codec = rx_codec()
+        self.report = {}
+
+    def level_error(self, rms, target, unit="rms"):
+        """ How many dB each input is above the target level """
+        rms = np.asarray(rms, dtype=float)
+        if unit == "rms":
+            with np.errstate(divide='ignore', invalid='ignore'):
+                error = 20 * np.log10(rms / target)
+            return np.where(rms > 0, error, 0.)
+        power = adu_power(rms)
+        return np.where(power == -np.inf, -30., power) - target
+
+    def get_attenuation(self, conf):
+        """ DSA attenuation of the configurations of the given tiles as a (tiles x 32) array """
+        codes, versions = self.codec.from_conf(conf)
+        return self.codec.get_attenuation(codes, versions).astype(int)
+
+    def set_attenuation(self, conf, attenuation):
+        codes, versions = self.codec.from_conf(conf)
+        self.codec.to_conf(conf, self.codec.set_attenuation(codes, versions, attenuation))
+
+    def write(self, tiles, conf):
+        """ Write the configuration of the tiles all at once, one worker per tile """
+        with ThreadPoolExecutor(max_workers=len(tiles), thread_name_prefix="PreADU write") as pool:
+            list(pool.map(lambda tc: self.preadu[tc[0]].write_configuration(tc[1]), zip(tiles, conf)))
+
+    def equalize(self, target, unit="rms", tiles=None, tolerance=0.5, max_iter=5):
+        """
+        Iterate measure/correct until every input is within tolerance (dB) of the target, or it cannot be
+        corrected further (DSA at its limit), or max_iter corrections were done.
+        Return a report with the per input residuals (dB), the final attenuations and the convergence flags.
+        """
+        if tiles is None:
+            tiles = range(len(self.preadu))
+        tiles = list(tiles)
+        conf = [self.preadu[t].readConfiguration() for t in tiles]
+        tstart = time.time()
+        iteration = 0
+        while True:
+            rms = np.asarray(self.read_rms(), dtype=float)
+            if rms.ndim < 2 or len(rms) < (max(tiles) + 1):
+                raise ValueError("RMS of %d tiles received, expected at least %d" % (len(rms), max(tiles) + 1))
+            residual = self.level_error(rms[tiles], target, unit)
+            dsa = self.get_attenuation(conf)
+            new_dsa = np.clip(np.round(dsa + residual), 0, 31).astype(int)
+            converged = (np.abs(residual) <= tolerance) | (new_dsa == dsa)
+            if self.logger is not None:
+                self.logger.info("Equalization iteration %d: max residual %3.1f dB, %d inputs to correct" %
+                                 (iteration, np.max(np.abs(residual)), np.count_nonzero(~converged)))
+            if converged.all() or iteration >= max_iter:
+                break
+            self.set_attenuation(conf, np.where(converged, dsa, new_dsa))
+            changed = [n for n in range(len(tiles)) if not converged[n].all()]
+            self.write([tiles[n] for n in changed], [conf[n] for n in changed])
+            # The receivers really programmed are the ones read back
+            conf = [self.preadu[t].readConfiguration() for t in tiles]
+            iteration += 1
+            time.sleep(self.settle)
+        self.report = {'tiles': tiles, 'iterations': iteration, 'residuals': residual,
+                       'attenuation': self.get_attenuation(conf), 'converged': converged,
+                       'time': time.time() - tstart}
+        return self.report
+
+
+# Codec of the receiver versions known, its tables are built at the first use and then shared
+RX_CODEC = None
+RX_CODEC_LOCK = Lock()
+
+
+def rx_codec():
+    global RX_CODEC
+    with RX_CODEC_LOCK:
+        if RX_CODEC is None:
+            RX_CODEC = RxCodec()
+        return RX_CODEC
+
+
+def station_snapshot(preadu, force=True):
+    """
+    PreADU configuration of a whole station: register codes (tiles x 32, uint8), receiver versions
+    (indexes in 'version_names') and the preADU version and IP of each tile.
+    """
+    codec = rx_codec()
+    conf = [p.readConfiguration(force=force) for p in preadu]
+    codes, versions = codec.from_conf(conf)
+    return {'codes': codes.reshape(len(preadu), CHANNELS), 'versions': versions.reshape(len(preadu), CHANNELS),
+            'version_names': np.array(codec.versions),
+            'preadu_version': np.array([p.preadu_version for p in preadu]),
+            'tiles': np.array([p.tpm.get_ip() if p.tpm is not None else "" for p in preadu]),
+            'timestamp': time.time()}
+
+
+def save_snapshot(fname, snapshot):
+    np.savez_compressed(fname, **snapshot)
+
+
+def load_snapshot(fname):
+    with np.load(fname) as f:
+        return {k: f[k] for k in f.files}
+
+
+def snapshot_diff(snapshot, current):
+    """
+    (tiles x 32) mask of the receivers whose code in current differs from the snapshot.
+    A snapshot of another station (tile IPs), or taken with other preADU or receiver versions, is refused.
+    """
+    if not snapshot['codes'].shape == current['codes'].shape:
+        raise ValueError("Snapshot of %d tiles, the station has %d tiles" %
+                         (len(snapshot['codes']), len(current['codes'])))
+    if not (snapshot['preadu_version'] == current['preadu_version']).all():
+        raise ValueError("The snapshot was taken with a different PreADU version")
+    if not (snapshot['tiles'] == current['tiles']).all():
+        raise ValueError("The snapshot was taken on another station (tiles %s)" % ", ".join(snapshot['tiles'].tolist()))
+    # Version indexes are compared by name, the codec of the snapshot may have listed them in another order
+    versions = np.asarray(snapshot['version_names'])[snapshot['versions']]
+    differ = ~(versions == np.asarray(current['version_names'])[current['versions']])
+    if differ.any():
+        raise ValueError("The snapshot was taken with different receivers on %d inputs" % np.count_nonzero(differ))
+    return ~(snapshot['codes'] == current['codes'])
+
+
+def restore_snapshot(preadu, snapshot):
+    """
+    Bring the station back to a snapshot: only the tiles with differences are written (all at once),
+    and of those only the receivers that changed. Return the diff mask found before the restore
+    and the one after it (all False if the restore succeeded).
+    """
+    before = snapshot_diff(snapshot, station_snapshot(preadu))
+    tiles = [t for t in range(len(preadu)) if before[t].any()]
+    if tiles:
+        conf = [preadu[t].readConfiguration() for t in tiles]
+        for c, t in zip(conf, tiles):
+            for rx, code in zip(c, snapshot['codes'][t].tolist()):
+                rx['code'] = int(code)
+        with ThreadPoolExecutor(max_workers=len(tiles), thread_name_prefix="PreADU restore") as pool:
+            list(pool.map(lambda tc: preadu[tc[0]].write_configuration(tc[1]), zip(tiles, conf)))
+    after = snapshot_diff(snapshot, station_snapshot(preadu, force=False))
+    return before, after
+
+
 class PreaduGui(object):
     def __init__(self, parent, preadu_version="3.1", debug=0):
         """ This is the PreADU Gui Class """
@@ -1058,13 +1392,12 @@ class PreaduGui(object):
         self.preadu_version = preadu_version
         self.debug = debug
         self.staticRx = TestingReceivers()  # used to query Receivers static methods
+        self.codec = RxCodec(self.staticRx.rx)  # same, on whole arrays of codes
         self.Busy = False  # UCP Communication Token
         self.write_armed = False  # Tells the top layer (skalab_live) that a write operation is ready to go
 
         self.inputs = CHANNELS
-        self.rf_map = read_routing_table("./SignalMap/TPM_AAVS1.txt")
-        if self.preadu_version == "3.1":
-            self.rf_map = read_routing_table("./SignalMap/TPM_AAVS3.txt")
+        self.rf_map = read_routing_table(routing_table_file(self.preadu_version))
         self.tpmConf = {}
         self.guiConf = {}
 
@@ -1119,6 +1452,10 @@ class PreaduGui(object):
         self.button_discard.setGeometry(QtCore.QRect(900, 640, 90, 31))
         self.button_apply = QtWidgets.QPushButton(parent)
         self.button_apply.setGeometry(QtCore.QRect(1020, 640, 90, 31))
+        self.button_snapshot = QtWidgets.QPushButton(parent)
+        self.button_snapshot.setGeometry(QtCore.QRect(20, 640, 70, 31))
+        self.button_restore = QtWidgets.QPushButton(parent)
+        self.button_restore.setGeometry(QtCore.QRect(100, 640, 70, 31))
 
         self.button_discard.setText("Discard")
         self.button_decrease.setText("-")
@@ -1126,6 +1463,10 @@ class PreaduGui(object):
         self.button_rfon.setText("RF ON")
         self.button_rfoff.setText("RF OFF")
         self.button_apply.setText("Apply")
+        self.button_snapshot.setText("Save")
+        self.button_snapshot.setToolTip("Save the PreADU configuration of the whole Station")
+        self.button_restore.setText("Restore")
+        self.button_restore.setToolTip("Restore a saved PreADU configuration of the whole Station")
 
         self.records = []
         for i in range(self.inputs):
@@ -1170,27 +1511,23 @@ class PreaduGui(object):
 
     def updateForm(self):
         # print("UPDATE FORM")
-        time.sleep(0.001)
+        codes, versions = self.codec.from_conf(self.guiConf)
+        attenuation = self.codec.get_attenuation(codes, versions)
+        lopass = self.codec.is_lopass(codes, versions)
+        hipass = self.codec.is_hipass(codes, versions)
+        terminated = self.codec.is_terminated(codes, versions)
         for num in range(self.inputs):
             self.records[num]['reg_val'] = self.guiConf[num]['code']
             self.records[num]['code'].setText(str(hex(self.guiConf[num]['code']))[2:])
             # Attenuation
-            self.records[num]['att'].setText(str(self.staticRx.rx[self.guiConf[num]['version']].op_get_attenuation(self.guiConf[num]['code'])))
-            #time.sleep(0.001)
+            self.records[num]['att'].setText(str(attenuation[num]))
             if not self.preadu_version == "3.1":
-                # print(num, self.staticRx.rx[self.guiConf[num]['version']].op_is_lopass(self.guiConf[num]['code']))
-                update_flag_lo_filter(self.records[num], self.staticRx.rx[self.guiConf[num]['version']].op_is_lopass(
-                    self.guiConf[num]['code']))
-                #time.sleep(0.001)
-                update_flag_hi_filter(self.records[num], self.staticRx.rx[self.guiConf[num]['version']].op_is_hipass(
-                    self.guiConf[num]['code']))
-                #time.sleep(0.001)
-                update_flag_termination(self.records[num], self.staticRx.rx[self.guiConf[num]['version']].op_is_terminated(self.guiConf[num]['code']))
+                update_flag_lo_filter(self.records[num], lopass[num])
+                update_flag_hi_filter(self.records[num], hipass[num])
+                update_flag_termination(self.records[num], terminated[num])
             else:
                 update_flag_termination(self.records[num], False)
-                #time.sleep(0.001)
             self.records[num]['code'].setFont(font_normal())
-            time.sleep(0.001)
 
     def set_hi(self):
         for num in range(self.inputs):
@@ -1298,6 +1635,7 @@ class PreaduGui(object):
 
     def set_preadu_version(self, preadu_version="3.1"):
         self.preadu_version = preadu_version
+        self.rf_map = read_routing_table(routing_table_file(self.preadu_version))
         self.adjustControls()
 
     def adjustControls(self):
@@ -1,10 +1,11 @@
 #!/usr/bin/env python
-from skalab_base import SkalabBase
+from skalab_base import SkalabBase, load_ui
 from skalab_log import SkalabLog
 from PyQt5 import QtWidgets, uic, QtCore, QtGui
 import logging
 import socket
 from threading import Thread
+from concurrent.futures import ThreadPoolExecutor
 import time
 import gc
 import os
@@ -15,15 +16,58 @@ from pyaavs.station import Station, get_slack_instance
 from pyaavs.tile_wrapper import Tile
 from pyfabil import TPMGeneric
 from pyfabil.base.definitions import LibraryError, BoardError, PluginError, InstrumentError
-import subprocess
 
-from skalab_utils import MapPlot
+from skalab_utils import MapPlot, scan_tpms, scan_report
+from skalab_stationmap import StationMap, StationMapRegistry
+from skalab_preadu import adu_power, fibre_remap
 
 default_app_dir = str(Path.home()) + "/.skalab/"
 default_profile = "Default"
 profile_filename = "station.ini"
 
 
+def run_tile_steps(tile, steps, name="", logger=None):
+    """ Run the (step name, function(tile)) steps on a tile, stop at the first failure """
+    report = {'name': name, 'steps': [], 'ok': True}
+    for step, func in steps:
+        tstart = time.time()
+        try:
+            func(tile)
+            report['steps'] += [(step, time.time() - tstart, None)]
+            if logger is not None:
+                logger.info("%s: %s done (%3.2f s)" % (name, step, time.time() - tstart))
+        except Exception as e:
+            report['steps'] += [(step, time.time() - tstart, str(e))]
+            report['ok'] = False
+            if logger is not None:
+                logger.error("%s: %s FAILED (%s)" % (name, step, str(e)))
+            break
+    return report
+
+
+def tile_pipeline(tiles, steps, logger=None):
+    """
+    Run the same steps on all the tiles at once (one worker per tile), a failure affects only its own tile.
+    Return the per tile reports as built by run_tile_steps.
+    """
+    if not len(tiles):
+        return []
+    with ThreadPoolExecutor(max_workers=len(tiles), thread_name_prefix="Tile init") as pool:
+        jobs = [pool.submit(run_tile_steps, tile, steps, "TPM-%02d" % (n + 1), logger) for n, tile in enumerate(tiles)]
+        return [job.result() for job in jobs]
+
+
+def pipeline_timing(reports):
+    """ Per step timing breakdown: {step: [min, max]} seconds over the tiles that ran it """
+    timing = {}
+    for report in reports:
+        for step, elapsed, error in report['steps']:
+            if step not in timing:
+                timing[step] = [elapsed, elapsed]
+            timing[step] = [min(timing[step][0], elapsed), max(timing[step][1], elapsed)]
+    return timing
+
+
 # class MyStation(Station):
 #     """ Customized Class representing an AAVS station using parent Logger """
 #
@@ -53,11 +97,12 @@ class SkalabStation(SkalabBase):
     """ Main UI Window class """
     # Signal for Slots
     signalTlm = QtCore.pyqtSignal()
+    signalInitDone = QtCore.pyqtSignal()
 
     def __init__(self, uiFile="", profile="", size=[1190, 936], swpath=default_app_dir):
         """ Initialise main window """
         # Load window file
-        self.wg = uic.loadUi(uiFile)
+        self.wg = load_ui(uiFile)
         self.wgProBox = QtWidgets.QWidget(self.wg.qtab_conf)
         self.wgProBox.setGeometry(QtCore.QRect(1, 1, 800, 860))
         self.wgProBox.setVisible(True)
@@ -67,6 +112,7 @@ class SkalabStation(SkalabBase):
         self.logger = SkalabLog(parent=self.wg.qw_log, logname=__name__, profile=self.profile)
         self.connected = False
         self.tpm_station = None
+        self.init_report = []
         self.doInit = False
         self.stopThreads = False
         self.processInit = Thread(target=self.do_station_init)
@@ -84,18 +130,28 @@ class SkalabStation(SkalabBase):
 
         self.load_events()
         self.config_file = self.profile['Station']['station_file']
+        self.scan_timeout = 3.0
+        self.scan_ping = False
+        try:
+            self.scan_timeout = float(self.profile['Station']['scan_timeout'])
+            self.scan_ping = self.profile['Station']['scan_ping'].lower() in ["true", "1", "yes"]
+        except:
+            pass
         self.setup_config()
         self.tpm_ips_from_subrack = []
 
         self.maks_tiles = np.arange(1, 17).tolist()
         self.populate_cb_tiles()
         self.pauseAction = False
-        self.station_map = []
+        self.station_maps = StationMapRegistry()
+        self.map_levels = False
+        self.map_level_version = None
+        self.station_map = StationMap()
         if "station_map" in self.profile['Station'].keys():
             self.wg.qline_map_file.setText(self.profile['Station']["station_map"])
             self.station_map = self.loadStationMap(self.profile['Station']["station_map"])
-            ant_id_list = sorted(["%03d" % x['id'] for x in self.station_map])
-            tpm_list = list(dict.fromkeys(["%d" % x['tile'] for x in self.station_map]))
+            ant_id_list = ["%03d" % x for x in np.sort(self.station_map.ids)]
+            tpm_list = list(dict.fromkeys(["%d" % x for x in self.station_map.tiles]))
             input_list = ["%d" % x for x in np.arange(1, 17)]
             self.wg.combo_antenna.addItems(ant_id_list)
             self.wg.combo_tpm.addItems(tpm_list)
@@ -108,6 +164,59 @@ class SkalabStation(SkalabBase):
                                 bbox=dict(boxstyle="round", fc="w"),
                                 arrowprops=dict(arrowstyle="->"))
             self.annot.set_visible(False)
+            self.setupMapLevels()
+
+    def setupMapLevels(self, version=None):
+        """
+        Precompute where the RMS of each antenna is found in the (tiles x 32) ADU RMS array.
+        The preADU version (fibre to ADU input order) is the one of the Station profile unless given.
+        """
+        self.map_levels = True
+        self.map_level_range = [-20., 5.]
+        self.map_level_pol = "mean"
+        try:
+            self.map_levels = self.profile['Station']['map_levels'].lower() in ["true", "1", "yes"]
+            self.map_level_range = [float(self.profile['Station']['map_level_min']),
+                                    float(self.profile['Station']['map_level_max'])]
+            self.map_level_pol = self.profile['Station']['map_level_pol'].lower()
+        except:
+            pass
+        if version is None:
+            version = self.map_level_version
+        if version is None:
+            version = "2.1"
+            if 'preadu_version' in self.profile['Station'].keys():
+                version = self.profile['Station']['preadu_version']
+        self.map_level_version = version
+        # The map input is the fibre of the tile, its receivers (pol X, pol Y) are at 2(n-1) and 2(n-1)+1 of the remap
+        remap = np.array(fibre_remap(version))
+        self.map_level_tile = self.station_map.tiles.astype(int) - 1
+        fibre = self.station_map.inputs.astype(int) - 1
+        connected = (fibre >= 0) & (fibre < len(remap) // 2)
+        self.map_level_chan = np.full((len(fibre), 2), -1)
+        self.map_level_chan[connected, 0] = remap[fibre[connected] * 2]
+        self.map_level_chan[connected, 1] = remap[fibre[connected] * 2 + 1]
+
+    def updateMapLevels(self, rms):
+        """ Colour the antennas of the map by their current ADU power (dBm), colours only """
+        if not (self.map_levels and len(self.station_map)):
+            return
+        rms = np.atleast_2d(rms)
+        valid = (self.map_level_tile >= 0) & (self.map_level_tile < rms.shape[0]) & \
+                (self.map_level_chan.min(axis=1) >= 0) & (self.map_level_chan.max(axis=1) < rms.shape[1])
+        tiles, chans = self.map_level_tile[valid], self.map_level_chan[valid]
+        power = adu_power(rms)
+        power[~np.isfinite(power)] = -60
+        if self.map_level_pol == "x":
+            levels = power[tiles, chans[:, 0]]
+        elif self.map_level_pol == "y":
+            levels = power[tiles, chans[:, 1]]
+        else:
+            levels = (power[tiles, chans[:, 0]] + power[tiles, chans[:, 1]]) / 2
+        values = np.zeros(len(self.station_map)) * np.nan
+        values[valid] = levels
+        self.mapPlot.setValues(values, vmin=self.map_level_range[0], vmax=self.map_level_range[1])
+        self.mapPlot.updatePlot()
 
     def update_annot(self, x, y, text):
         pos = (x, y)
@@ -116,11 +225,11 @@ class SkalabStation(SkalabBase):
         self.annot.get_bbox_patch().set_facecolor('w')
 
     def mouseonbase(self, x, y):
-        for a in self.station_map:
-            if (a['East'] > x - 0.6) and (a['East'] < x + 0.6):
-                if (a['North'] > y - 0.6) and (a['North'] < y + 0.6):
-                    return "Antenna ID: " + str(a['id']) + "\nTILE: " + str(int(a['tile'])) + ", Input: " + str(
-                        int(a['input']))
+        n = self.station_map.locate(x, y)
+        if n >= 0:
+            if self.map_levels and np.isfinite(self.mapPlot.values[n]):
+                return self.station_map.describe(n) + "\nLevel: %3.1f dBm" % self.mapPlot.values[n]
+            return self.station_map.describe(n)
         return ""
 
     def onmotion(self, event):
@@ -187,7 +296,8 @@ class SkalabStation(SkalabBase):
     def locateAntenna(self):
         self.mapPlot.highlightClear()
         if self.wg.cb_locate_enable_antenna.isChecked():
-            antId = [ant['id'] for ant in self.station_map if ant['id'] == int(self.wg.combo_antenna.currentText())]
+            antId = [int(self.station_map.ids[n]) for n in
+                     self.station_map.index_of_id([int(self.wg.combo_antenna.currentText())])]
             if len(antId):
                 self.mapPlot.highlightAntenna(antId=antId, color='yellow')
         if self.wg.cb_locate_enable_antenna_list.isChecked():
@@ -199,9 +309,7 @@ class SkalabStation(SkalabBase):
                         ant_list += np.arange(int(a.split("-")[0]), int(a.split("-")[1])+1).tolist()
                     else:
                         ant_list += [int(a)]
-                antId = []
-                for a in ant_list:
-                    antId += [ant['id'] for ant in self.station_map if ant['id'] == a]
+                antId = [int(self.station_map.ids[n]) for n in self.station_map.index_of_id(ant_list)]
                 self.wg.qlabel_malformed_list.setText("query form ok")
                 self.mapPlot.highlightAntenna(antId=antId, color='#00c800')
             except:
@@ -209,7 +317,8 @@ class SkalabStation(SkalabBase):
         if self.wg.cb_locate_enable_tpm.isChecked():
             tpmId = int(self.wg.combo_tpm.currentText())
             inputId = int(self.wg.combo_input.currentText())
-            antId = [ant['id'] for ant in self.station_map if ((ant['tile'] == tpmId) and (ant['input'] == inputId))]
+            n = self.station_map.index_of_input(tpmId, inputId)
+            antId = [int(self.station_map.ids[n])] if n >= 0 else []
             if len(antId):
                 self.mapPlot.highlightAntenna(antId=antId, color='b')
 
@@ -264,17 +373,9 @@ class SkalabStation(SkalabBase):
         self.wg.qline_configfile.setText(self.config_file)
 
     def loadStationMap(self, map_file):
-        with open(map_file) as f:
-            data = f.readlines()
-        station_map = []
-        for d in data:
-            if (len(d.split()) == 5) and (d[0] != "#"):
-                antenna_map = {'tile': int(d.split()[0]),
-                               'input': int(d.split()[1]),
-                               'id': int(d.split()[2]),
-                               'North': float(d.split()[3]),
-                               'East': float(d.split()[4])}
-                station_map += [antenna_map]
+        station_map = self.station_maps.get(map_file)
+        for problem in self.station_maps.problems[map_file]:
+            self.logger.warning("Station Map %s: %s" % (map_file, problem))
         return station_map
 
     def edit_config(self):
@@ -348,7 +449,7 @@ class SkalabStation(SkalabBase):
                         for i in tpm_ip_list:
                             details += "\n%s" % i
                         details += "\n\nSUBRACK IP LIST OF TPM POWERED ON: (%d): " % len(self.tpm_ips_from_subrack)
-                        for i in tpm_ip_from_subrack_short:
+                        for i in self.tpm_ips_from_subrack:
                             details += "\n%s" % i
                         msgBox.setDetailedText(details)
                         msgBox.exec_()
@@ -370,26 +471,25 @@ class SkalabStation(SkalabBase):
                             msgBox.exec_()
                             station.configuration['tiles'] = list(self.tpm_ips_from_subrack)
                             # self.wgLive.setupNewTilesIPs(list(self.tpm_ips_from_subrack))
-                for tpm_ip in station.configuration['tiles']:
-                    try:
-                        tpm = TPMGeneric()
-                        tpm_version = tpm.get_tpm_version(socket.gethostbyname(tpm_ip), 10000)
-                    except (BoardError, LibraryError):
-                        station_on = False
-                        break
+                # Probe all the boards at once, every unreachable one is reported
+                scan = scan_tpms(station.configuration['tiles'], timeout=self.scan_timeout, ping=self.scan_ping)
+                unreachable = [tpm['ip'] for tpm in scan if not tpm['reachable']]
+                station_on = not unreachable
                 if station_on:
                     self.doInit = True
                 else:
                     msgBox = QtWidgets.QMessageBox()
-                    msgBox.setText("STATION\nOne or more TPMs forming the station is unreachable\n"
-                                   "Please check the power or the connection!")
+                    msgBox.setText("STATION\n%d of %d TPMs forming the station are unreachable:\n%s\n"
+                                   "Please check the power or the connection!" %
+                                   (len(unreachable), len(scan), "\n".join(unreachable)))
                     msgBox.setWindowTitle("ERROR: TPM UNREACHABLE")
                     msgBox.setIcon(QtWidgets.QMessageBox.Critical)
-                    details = "STATION IP LIST FROM CONFIG FILE (%d): " % len(tpm_ip_list)
+                    details = scan_report(scan)
+                    details += "\n\nSTATION IP LIST FROM CONFIG FILE (%d): " % len(tpm_ip_list)
                     for i in tpm_ip_list:
                         details += "\n%s" % i
                     details += "\n\nSUBRACK IP LIST OF TPM POWERED ON: (%d): " % len(self.tpm_ips_from_subrack)
-                    for i in tpm_ip_from_subrack:
+                    for i in self.tpm_ips_from_subrack:
                         details += "\n%s" % i
                     msgBox.setDetailedText(details)
                     msgBox.exec_()
@@ -404,55 +504,56 @@ class SkalabStation(SkalabBase):
         while True:
             if self.doInit:
                 if True:
-                    swpath = os.getenv("AAVS_HOME")[:-1]
-                    swstation = "/aavs-system/python/pyaavs/station.py "
-                    swopt = " -I"
-                    if self.wg.checkProgram.isChecked():
-                        swopt += " -P"
-                    sp = subprocess.Popen(
-                        "python " + swpath + swstation + " --config='" + self.config_file + "'" + swopt, shell=True,
-                        stdout=subprocess.PIPE)
-                    while True:
-                        msg = sp.stdout.readline()
-                        if (len(msg) == 0) and (sp.poll() is not None):
-                            break
-                        if "ERROR" in msg.decode()[:-1]:
-                            self.logger.error(msg.decode()[:-1])
-                        elif "WARNING" in msg.decode()[:-1]:
-                            self.logger.warning(msg.decode()[:-1])
-                        else:
-                            self.logger.info(msg.decode()[:-1])
-                        # print(msg.decode()[:-1])
-                        time.sleep(0.01)
-
-                    self.tpm_station = station.Station(station.configuration)
+                    tstart = time.time()
+                    # In process bring-up: program (optional) and initialise the station
+                    station.configuration['station']['initialise'] = True
+                    station.configuration['station']['program'] = self.wg.checkProgram.isChecked()
                     self.wg.qbutton_station_init.setEnabled(False)
+                    self.logger.info("Station Initialization started...")
+                    try:
+                        # pyaavs logs the programming and initialisation progress on its own loggers
+                        with self.logger.forwardLogger():
+                            self.tpm_station = station.Station(station.configuration)
+                            self.tpm_station.connect()
+                        station_ok = self.tpm_station.properly_formed_station
+                    except Exception as e:
+                        self.logger.error("Station Initialization failed: %s" % str(e))
+                        station_ok = False
                     station.configuration['station']['initialise'] = False
                     station.configuration['station']['program'] = False
-                    self.logger.info("Station Initialization completed, verifying if properly formed...")
-                    self.tpm_station.connect()
-                    if self.tpm_station.properly_formed_station:
+                    self.logger.info("Station Initialization completed in %3.1f s, verifying if properly formed..." %
+                                     (time.time() - tstart))
+                    if station_ok:
                         self.logger.info("The Station is properly formed!")
                         self.logger.info("Switching On TPM PreADUs...")
                         self.wg.qbutton_station_init.setStyleSheet("background-color: rgb(78, 154, 6);")
-                        # Switch On the PreADUs
-                        for tile in self.tpm_station.tiles:
-                            tile["board.regfile.enable.fe"] = 1
-                            time.sleep(0.1)
-                        self.logger.info("TPM PreADUs Powered ON")
-                        time.sleep(1)
+                        # Per tile steps, all the tiles at once
+                        steps = [("PreADU power on", lambda tile: tile.__setitem__("board.regfile.enable.fe", 1)),
+                                 ("PreADU settling", lambda tile: time.sleep(1))]
                         if "default_preadu_attenuation" in station.configuration['station'].keys():
-                            for tile in self.tpm_station.tiles:
-                                tile.set_preadu_attenuation(int(station.configuration['station']["default_preadu_attenuation"]))
+                            attenuation = int(station.configuration['station']["default_preadu_attenuation"])
+                            steps += [("PreADU attenuation", lambda tile: tile.set_preadu_attenuation(attenuation))]
                         if "equalize_preadu" in station.configuration['station'].keys():
-                            for tile in self.tpm_station.tiles:
-                                tile.equalize_preadu_gain(int(station.configuration['station']["equalize_preadu"]))
-                            self.logger.info("Equalization of Levels done")
+                            equalize = int(station.configuration['station']["equalize_preadu"])
+                            steps += [("PreADU equalization", lambda tile: tile.equalize_preadu_gain(equalize))]
+                        tsteps = time.time()
+                        self.init_report = tile_pipeline(self.tpm_station.tiles, steps, logger=self.logger)
+                        for step, (tmin, tmax) in pipeline_timing(self.init_report).items():
+                            self.logger.info("Step '%s': %3.2f s (fastest tile %3.2f s)" % (step, tmax, tmin))
+                        failed = [r['name'] for r in self.init_report if not r['ok']]
+                        if failed:
+                            self.logger.error("Tile steps failed on: " + ", ".join(failed))
+                            self.wg.qbutton_station_init.setStyleSheet("background-color: rgb(237, 212, 0);")
+                        self.logger.info("Tile steps completed in %3.1f s, Station ready in %3.1f s" %
+                                         (time.time() - tsteps, time.time() - tstart))
                     else:
                         self.wg.qbutton_station_init.setStyleSheet("background-color: rgb(204, 0, 0);")
                     self.wg.qbutton_station_init.setEnabled(True)
-                    del self.tpm_station
+                    if self.tpm_station is not None:
+                        del self.tpm_station
                     gc.collect()
+                    # The TPMs have been initialised again, their registers are not the ones cached by others
+                    self.signalInitDone.emit()
                 else:
                     self.wg.qbutton_station_init.setEnabled(True)
                 self.tpm_station = None
@@ -0,0 +1,202 @@
+import os
+import zlib
+import numpy as np
+from pathlib import Path
+
+# One record per antenna, same fields of the station map text files
+ANTENNA_DTYPE = np.dtype([('tile', np.int16), ('input', np.int16), ('id', np.int32),
+                          ('North', np.float64), ('East', np.float64)])
+
+# Half size of the box around an antenna used for the hit test (m)
+HIT_TOLERANCE = 0.6
+
+# Where the binary copies of the station map files are kept
+MAP_CACHE_DIR = str(Path.home()) + "/.skalab/cache/"
+NOF_INPUTS = 16
+
+
+class StationMap:
+    """
+    Antenna layout of a station held in a numpy structured array (tile, input, id, North, East).
+
+    Positions are indexed in a uniform grid of square cells so that finding the antenna under a point
+    only looks at the neighbouring cells, while ids and (tile, input) pairs are hashed to the array index.
+    Iterating the map gives the antenna records, which can be read like the old dictionaries (a['id']).
+    """
+    def __init__(self, data=None, cell=1.0, name=""):
+        if data is None:
+            data = np.zeros(0, dtype=ANTENNA_DTYPE)
+        self.data = np.asarray(data, dtype=ANTENNA_DTYPE)
+        self.name = name
+        self.cell = float(cell)
+        self.buildIndex()
+
+    @classmethod
+    def from_file(cls, map_file, cell=1.0):
+        """ Read a station map text file: tile, input, id, North, East on each line, '#' for comments """
+        records = []
+        with open(map_file) as f:
+            for d in f:
+                fields = d.split()
+                if (len(fields) == 5) and (d[0] != "#"):
+                    records += [(int(fields[0]), int(fields[1]), int(fields[2]), float(fields[3]), float(fields[4]))]
+        return cls(np.array(records, dtype=ANTENNA_DTYPE), cell=cell, name=map_file)
+
+    def buildIndex(self):
+        self.tiles = self.data['tile']
+        self.inputs = self.data['input']
+        self.ids = self.data['id']
+        self.north = self.data['North']
+        self.east = self.data['East']
+        self.by_id = {}
+        self.by_input = {}
+        for n, (tile, rf_input, ant_id) in enumerate(zip(self.tiles.tolist(), self.inputs.tolist(),
+                                                          self.ids.tolist())):
+            self.by_id[ant_id] = n
+            self.by_input[(tile, rf_input)] = n
+        self.grid = {}
+        cx = np.floor(self.east / self.cell).astype(int).tolist()
+        cy = np.floor(self.north / self.cell).astype(int).tolist()
+        for n, key in enumerate(zip(cx, cy)):
+            self.grid.setdefault(key, []).append(n)
+
+    def __len__(self):
+        return len(self.data)
+
+    def __iter__(self):
+        return iter(self.data)
+
+    def __getitem__(self, item):
+        return self.data[item]
+
+    def locate(self, x, y, tolerance=HIT_TOLERANCE):
+        """ Index of the antenna closest to (East=x, North=y) within the tolerance box, -1 if none """
+        reach = int(np.ceil(tolerance / self.cell))
+        cx, cy = int(np.floor(x / self.cell)), int(np.floor(y / self.cell))
+        candidates = []
+        for i in range(cx - reach, cx + reach + 1):
+            for j in range(cy - reach, cy + reach + 1):
+                candidates += self.grid.get((i, j), [])
+        best, best_dist = -1, np.inf
+        for n in candidates:
+            dx, dy = abs(self.east[n] - x), abs(self.north[n] - y)
+            if (dx < tolerance) and (dy < tolerance) and (dx * dx + dy * dy < best_dist):
+                best, best_dist = n, dx * dx + dy * dy
+        return best
+
+    def index_of_id(self, ant_ids):
+        """ Map indexes of the given antenna ids, unknown ids are skipped """
+        return [self.by_id[a] for a in ant_ids if a in self.by_id]
+
+    def index_of_input(self, tile, rf_input):
+        """ Map index of the antenna connected to the input of the tile, -1 if not connected """
+        return self.by_input.get((int(tile), int(rf_input)), -1)
+
+    def describe(self, n):
+        """ Tooltip text of the antenna at map index n """
+        return "Antenna ID: " + str(int(self.ids[n])) + "\nTILE: " + str(int(self.tiles[n])) + \
+               ", Input: " + str(int(self.inputs[n]))
+
+    def validate(self):
+        """ Return the list of the problems found in the map (empty if it is fine) """
+        problems = []
+        ids, counts = np.unique(self.ids, return_counts=True)
+        if (counts > 1).any():
+            problems += ["duplicated antenna ids: " + ", ".join(["%d" % x for x in ids[counts > 1]])]
+        pairs, counts = np.unique(self.tiles.astype(np.int64) * 1000 + self.inputs, return_counts=True)
+        if (counts > 1).any():
+            problems += ["duplicated tile inputs: " + ", ".join(["TPM %d input %d" % (p // 1000, p % 1000)
+                                                               for p in pairs[counts > 1]])]
+        wrong = (self.inputs < 1) | (self.inputs > NOF_INPUTS) | (self.tiles < 1)
+        if wrong.any():
+            problems += ["wrong tile/input for antenna ids: " + ", ".join(["%d" % x for x in self.ids[wrong]])]
+        if not np.isfinite(self.north).all() or not np.isfinite(self.east).all():
+            problems += ["antenna positions are not finite numbers"]
+        return problems
+
+    def antennas_per_tile(self):
+        """ Number of antennas connected to each tile, indexed by tile number (index 0 unused) """
+        if not len(self):
+            return np.zeros(1, dtype=int)
+        return np.bincount(self.tiles, minlength=int(self.tiles.max()) + 1)
+
+    def tile_centroids(self):
+        """ Tile numbers and the North, East centroids of their antennas """
+        tiles, inverse = np.unique(self.tiles, return_inverse=True)
+        counts = np.bincount(inverse)
+        north = np.bincount(inverse, weights=self.north) / counts
+        east = np.bincount(inverse, weights=self.east) / counts
+        return tiles, north, east
+
+    def distances(self, north=None, east=None):
+        """ Distances (m) of all antennas from a point, or the full antenna to antenna matrix if no point """
+        if north is None or east is None:
+            return np.hypot(self.north[:, None] - self.north[None, :], self.east[:, None] - self.east[None, :])
+        return np.hypot(self.north - north, self.east - east)
+
+
+class StationMapRegistry:
+    """
+    The station maps loaded so far, by file name.
+
+    Each text map is parsed once and stored as a .npy structured array in the cache directory, the cached
+    copy carries the modification time of its source in the name so it is used only while the source is unchanged.
+    Cached maps are memory mapped, so loading many stations costs little more than opening the files.
+    A map already loaded is loaded again if its file is modified.
+    """
+    def __init__(self, cache_dir=MAP_CACHE_DIR):
+        self.cache_dir = cache_dir
+        self.maps = {}
+        self.mtimes = {}
+        self.problems = {}
+
+    def cacheName(self, map_file):
+        src = os.path.abspath(os.path.expanduser(map_file))
+        tag = "%s_%x_%d" % (os.path.basename(src).replace(".", "_"), zlib.crc32(src.encode()),
+                            os.stat(src).st_mtime_ns)
+        return os.path.join(self.cache_dir, tag + ".npy")
+
+    def read(self, map_file):
+        """ Station map from its cached copy if still valid, otherwise from the text file (refreshing the cache) """
+        cache = self.cacheName(map_file)
+        if os.path.exists(cache):
+            try:
+                return StationMap(np.load(cache, mmap_mode='r'), name=map_file)
+            except Exception:
+                pass
+        station_map = StationMap.from_file(os.path.expanduser(map_file))
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            # Copies made for older versions of the same file are dropped
+            prefix = os.path.basename(cache).rsplit("_", 1)[0] + "_"
+            for f in os.listdir(self.cache_dir):
+                if f.startswith(prefix) and f.endswith(".npy"):
+                    os.remove(os.path.join(self.cache_dir, f))
+            np.save(cache, station_map.data)
+        except OSError:
+            # A read only home is not a reason to fail, the map is just parsed again next time
+            pass
+        return station_map
+
+    def load(self, map_files):
+        """ Load one or more station maps, return them in the same order. Problems found are kept in self.problems """
+        if type(map_files) is str:
+            map_files = [map_files]
+        loaded = []
+        for map_file in map_files:
+            mtime = os.stat(os.path.expanduser(map_file)).st_mtime_ns
+            station_map = self.read(map_file)
+            self.maps[map_file] = station_map
+            self.mtimes[map_file] = mtime
+            self.problems[map_file] = station_map.validate()
+            loaded += [station_map]
+        return loaded
+
+    def get(self, map_file):
+        if map_file not in self.maps or \
+                not self.mtimes[map_file] == os.stat(os.path.expanduser(map_file)).st_mtime_ns:
+            self.load(map_file)
+        return self.maps[map_file]
+
+    def names(self):
+        return list(self.maps.keys())
@@ -1,7 +1,7 @@
 #!/usr/bin/env python
 import time
 
-from skalab_base import SkalabBase
+from skalab_base import SkalabBase, load_ui
 from skalab_log import SkalabLog
 import gc
 import os.path
@@ -12,7 +12,7 @@ import numpy as np
 import configparser
 from PyQt5 import QtWidgets, uic, QtCore, QtGui
 from hardware_client import WebHardwareClient
-from skalab_utils import BarPlot, ChartPlots, colors, dt_to_timestamp
+from skalab_utils import BarPlot, ChartPlots, colors, dt_to_timestamp, chart_history_from_profile
 from skalab_utils import ts_to_datestring, parse_profile, COLORI, getTextFromFile
 from threading import Thread
 from time import sleep
@@ -131,7 +131,7 @@ class Subrack(SkalabBase):
         self.query_deny = []
         # self.query_tiles = []
         # Load window file
-        self.wg = uic.loadUi(uiFile)
+        self.wg = load_ui(uiFile)
         self.wgProBox = QtWidgets.QWidget(self.wg.qtab_conf)
         self.wgProBox.setGeometry(QtCore.QRect(1, 1, 800, 860))
         self.wgProBox.setVisible(True)
@@ -315,16 +315,18 @@ class Subrack(SkalabBase):
         self.drawCharts()
 
     def drawCharts(self):
-        self.plotChartMgn.set_xlabel("time sample")
-        self.plotChartTpm.set_xlabel("time sample")
+        self.plotChartMgn.set_xlabel("time samples (0 = latest)")
+        self.plotChartTpm.set_xlabel("time samples (0 = latest)")
         # Draw selected chart
         if self.wg.qcombo_chart.currentIndex() == 0:
             # Chart: Subrack Temperatures
             self.plotChartMgn.set_ylim([0, 60])
             if MgnTraces[0] in self.data_charts.keys():
                 for n, k in enumerate(MgnTraces):
-                    self.plotChartMgn.plotCurve(data=self.data_charts[k][0::2], trace=(0 + n * 2), color=COLORI[(0 + n * 2)])
-                    self.plotChartMgn.plotCurve(data=self.data_charts[k][1::2], trace=(1 + n * 2), color=COLORI[(1 + n * 2)])
+                    self.plotChartMgn.plotHistory(history=self.data_charts[k], trace=(0 + n * 2), color=COLORI[(0 + n * 2)],
+                                                  column=0)
+                    self.plotChartMgn.plotHistory(history=self.data_charts[k], trace=(1 + n * 2), color=COLORI[(1 + n * 2)],
+                                                  column=1)
             else:
                 self.plotChartMgn.set_xlabel("Subrack attributes '" + MgnTraces[0] + "' and '" + MgnTraces[1] + "' not available.")
             self.plotChartMgn.updatePlot()
@@ -334,7 +336,7 @@ class Subrack(SkalabBase):
             self.plotChartTpm.set_ylabel("TPM Board Temperatures (deg)")
             if "tpms_temperatures_0" in self.data_charts.keys():
                 for i in range(8):
-                    self.plotChartTpm.plotCurve(data=self.data_charts["tpms_temperatures_0"][i::8], trace=i, color=COLORI[i])
+                    self.plotChartTpm.plotHistory(history=self.data_charts["tpms_temperatures_0"], column=i, trace=i, color=COLORI[i])
             else:
                 self.plotChartTpm.set_xlabel("Subrack attribute 'tpms_temperatures_0' not available.")
             self.plotChartTpm.updatePlot()
@@ -344,7 +346,7 @@ class Subrack(SkalabBase):
             self.plotChartTpm.set_ylabel("TPM FPGA-0 Temperatures (deg)")
             if "tpms_temperatures_1" in self.data_charts.keys():
                 for i in range(8):
-                    self.plotChartTpm.plotCurve(data=self.data_charts["tpms_temperatures_1"][i::8], trace=i, color=COLORI[i])
+                    self.plotChartTpm.plotHistory(history=self.data_charts["tpms_temperatures_1"], column=i, trace=i, color=COLORI[i])
             else:
                 self.plotChartTpm.set_xlabel("Subrack attribute 'tpms_temperatures_1' not available.")
             self.plotChartTpm.updatePlot()
@@ -354,7 +356,7 @@ class Subrack(SkalabBase):
             self.plotChartTpm.set_ylabel("TPM FPGA-1 Temperatures (deg)")
             if "tpms_temperatures_2" in self.data_charts.keys():
                 for i in range(8):
-                    self.plotChartTpm.plotCurve(data=self.data_charts["tpms_temperatures_2"][i::8], trace=i, color=COLORI[i])
+                    self.plotChartTpm.plotHistory(history=self.data_charts["tpms_temperatures_2"], column=i, trace=i, color=COLORI[i])
             else:
                 self.plotChartTpm.set_xlabel("Subrack attribute 'tpms_temperatures_2' not available.")
             self.plotChartTpm.updatePlot()
@@ -364,7 +366,7 @@ class Subrack(SkalabBase):
             self.plotChartTpm.set_ylabel("TPM Powers (W)")
             if "tpm_powers" in self.data_charts.keys():
                 for i in range(8):
-                    self.plotChartTpm.plotCurve(data=self.data_charts["tpm_powers"][i::8], trace=i, color=COLORI[i])
+                    self.plotChartTpm.plotHistory(history=self.data_charts["tpm_powers"], column=i, trace=i, color=COLORI[i])
             else:
                 self.plotChartTpm.set_xlabel("Subrack attribute 'tpm_powers' not available.")
             self.plotChartTpm.updatePlot()
@@ -374,7 +376,7 @@ class Subrack(SkalabBase):
             self.plotChartTpm.set_ylabel("TPM Currents (A)")
             if "tpm_currents" in self.data_charts.keys():
                 for i in range(8):
-                    self.plotChartTpm.plotCurve(data=self.data_charts["tpm_currents"][i::8], trace=i, color=COLORI[i])
+                    self.plotChartTpm.plotHistory(history=self.data_charts["tpm_currents"], column=i, trace=i, color=COLORI[i])
             else:
                 self.plotChartTpm.set_xlabel("Subrack attribute 'tpm_currents' yet available.")
             self.plotChartTpm.updatePlot()
@@ -384,7 +386,7 @@ class Subrack(SkalabBase):
             self.plotChartTpm.set_ylabel("TPM Voltages (V)")
             if "tpm_voltages" in self.data_charts.keys():
                 for i in range(8):
-                    self.plotChartTpm.plotCurve(data=self.data_charts["tpm_voltages"][i::8], trace=i, color=COLORI[i])
+                    self.plotChartTpm.plotHistory(history=self.data_charts["tpm_voltages"], column=i, trace=i, color=COLORI[i])
             else:
                 self.plotChartTpm.set_xlabel("Subrack attribute 'tpm_voltages' not available.")
             self.plotChartTpm.updatePlot()
@@ -394,7 +396,7 @@ class Subrack(SkalabBase):
             self.plotChartTpm.set_ylabel("Power Supply Fan Speed")
             if "power_supply_fan_speeds" in self.data_charts.keys():
                 for i in range(2):
-                    self.plotChartTpm.plotCurve(data=self.data_charts["power_supply_fan_speeds"][i::2], trace=i,
+                    self.plotChartTpm.plotHistory(history=self.data_charts["power_supply_fan_speeds"], column=i, trace=i,
                                                 color=COLORI[i])
             else:
                 self.plotChartTpm.set_xlabel("Subrack attribute 'power_supply_fan_speeds' not available.")
@@ -405,7 +407,7 @@ class Subrack(SkalabBase):
             self.plotChartTpm.set_ylabel("Power Supply Powers")
             if "power_supply_powers" in self.data_charts.keys():
                 for i in range(2):
-                    self.plotChartTpm.plotCurve(data=self.data_charts["power_supply_powers"][i::2], trace=i,
+                    self.plotChartTpm.plotHistory(history=self.data_charts["power_supply_powers"], column=i, trace=i,
                                                 color=COLORI[i])
             else:
                 self.plotChartTpm.set_xlabel("Subrack attribute 'power_supply_powers' not available.")
@@ -416,7 +418,7 @@ class Subrack(SkalabBase):
             self.plotChartTpm.set_ylabel("Power Supply Currents")
             if "power_supply_currents" in self.data_charts.keys():
                 for i in range(2):
-                    self.plotChartTpm.plotCurve(data=self.data_charts["power_supply_currents"][i::2], trace=i,
+                    self.plotChartTpm.plotHistory(history=self.data_charts["power_supply_currents"], column=i, trace=i,
                                                 color=COLORI[i])
             else:
                 self.plotChartTpm.set_xlabel("Subrack attribute 'power_supply_currents' not available.")
@@ -427,7 +429,7 @@ class Subrack(SkalabBase):
             self.plotChartTpm.set_ylabel("Power Supply Voltages")
             if "power_supply_voltages" in self.data_charts.keys():
                 for i in range(2):
-                    self.plotChartTpm.plotCurve(data=self.data_charts["power_supply_voltages"][i::2], trace=i,
+                    self.plotChartTpm.plotHistory(history=self.data_charts["power_supply_voltages"], column=i, trace=i,
                                                 color=COLORI[i])
             else:
                 self.plotChartTpm.set_xlabel("Subrack attribute 'power_supply_voltages' not available.")
@@ -584,59 +586,30 @@ class Subrack(SkalabBase):
             else:
                 self.logger.logger.warning("The Subrack is running with a very old API version!")
 
-
-    def getTelemetry(self):
-        tkey = ""
-        telemetry = {}
-        try:
-            for tlmk in self.tlm_keys:
-                tkey = tlmk
-                if not tlmk in self.query_deny:
-                    if self.connected:
-                        data = self.client.get_attribute(tlmk)
-                        if data["status"] == "OK":
-                            telemetry[tlmk] = data["value"]
-                if self.query_once_armed and (tlmk in self.query_once):
-                    if self.connected:
-                        data = self.client.get_attribute(tlmk)
-                        if data["status"] == "OK":
-                            telemetry[tlmk] = data["value"]
-                        else:
-                            telemetry[tlmk] = data["info"]
-        except:
-            self.logger.logger.error("Error reading Telemetry [attribute: %s], skipping..." % tkey)
-            return
-        self.telemetry = dict(telemetry)
+    def updateChartData(self, telemetry):
         for tlmk in telemetry.keys():
             if tlmk not in self.query_deny:
                 if type(telemetry[tlmk]) is list:
                     if type(telemetry[tlmk][0]) is list:
                         for k in range(len(telemetry[tlmk])):
-                            nested_att = ("%s_%d" % (tlmk, k))
-                            if nested_att not in self.data_charts.keys():
-                                self.data_charts[nested_att] = np.zeros(len(telemetry[tlmk][k]) * 201) * np.nan
-                            self.data_charts[nested_att] = \
-                                np.append(self.data_charts[nested_att][len(telemetry[tlmk][k]):],
-                                          telemetry[tlmk][k])
-                            self.telemetry["%s_%d" % (tlmk, k)] = list(telemetry[tlmk][k])
-                        del self.telemetry[tlmk]
+                            self.appendChartData(("%s_%d" % (tlmk, k)), telemetry[tlmk][k])
                     else:
-                        if tlmk not in self.data_charts.keys():
-                            self.data_charts[tlmk] = np.zeros(len(telemetry[tlmk]) * 201) * np.nan
-                        self.data_charts[tlmk] = np.append(self.data_charts[tlmk][len(telemetry[tlmk]):], telemetry[tlmk])
+                        self.appendChartData(tlmk, telemetry[tlmk])
                 elif telemetry[tlmk] is not None:
-                    if tlmk not in self.data_charts.keys():
-                        self.data_charts[tlmk] = np.zeros(201) * np.nan
-                    try:
-                        self.data_charts[tlmk] = self.data_charts[tlmk][1:] + [telemetry[tlmk]]
-                    except:
-                        self.logger.logger.error("ERROR --> key:", tlmk, "\nValue: ", telemetry[tlmk])
-                        pass
+                    self.appendChartData(tlmk, [telemetry[tlmk]])
                 else:
-                    if tlmk not in self.data_charts.keys():
-                        self.data_charts[tlmk] = np.zeros(201) * np.nan
-                    self.data_charts[tlmk] = self.data_charts[tlmk][1:] + [np.nan]
-        self.writeTlm()
+                    self.appendChartData(tlmk, [np.nan])
+
+    def appendChartData(self, key, values):
+        if key in self.data_charts.keys() and not self.data_charts[key].nof_traces == len(values):
+            # The attribute changed its size, restart its history
+            del self.data_charts[key]
+        if key not in self.data_charts.keys():
+            self.data_charts[key] = chart_history_from_profile(self.profile['Subrack'], nof_traces=len(values))
+        try:
+            self.data_charts[key].append(values)
+        except:
+            self.logger.logger.error("Chart data error --> key: %s, Value: %s" % (key, str(values)))
 
     def setup_hdf5(self):
         if not self.profile['Subrack']['data_path'] == "":
@@ -758,7 +731,9 @@ class Subrack(SkalabBase):
         while True:
             if self.connected:
                 try:
-                    self.getTelemetry()
+                    telemetry = self.getTelemetry()
+                    if telemetry is not None:
+                        self.updateChartData(telemetry)
                     sleep(0.1)
                     self.signalTlm.emit()
                 except:
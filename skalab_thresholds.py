@@ -0,0 +1,137 @@
+import ast
+import numpy as np
+
+# Threshold states, ordered by severity
+STATE_OK = 0
+STATE_WARNING = 1
+STATE_ALARM = 2
+STATE_NAMES = {STATE_OK: "OK", STATE_WARNING: "WARNING", STATE_ALARM: "ALARM"}
+
+
+def parse_limits(limits):
+    """
+    Convert a profile limit string like "[None, 35.0]" into a [low, high] float pair.
+    None means unbounded on that side. The string is parsed as a literal, not evaluated.
+    """
+    if type(limits) is str:
+        limits = ast.literal_eval(limits.strip())
+    low, high = list(limits)[:2]
+    low = -float('inf') if low is None else float(low)
+    high = float('inf') if high is None else float(high)
+    return [low, high]
+
+
+def to_float(value):
+    """ Telemetry values that are not numbers (errors, strings, booleans) are not evaluated """
+    if value is None or type(value) is bool or type(value) is str:
+        return np.nan
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return np.nan
+
+
+class ThresholdEngine:
+    """
+    Warning/Alarm evaluation of a whole telemetry snapshot (rows x attributes) in one pass.
+
+    The bounds of the warning and alarm sections of the profile are compiled once into numpy arrays.
+    A state is raised as soon as a value crosses its band but it is cleared only when the value is back
+    inside the band by a hysteresis margin (a fraction of the warning band width), and any change of state
+    must be seen for 'debounce' consecutive evaluations before it is accepted, so noisy values don't flap.
+    """
+    def __init__(self, warning, alarm, nof_rows=8, hysteresis=0.0, debounce=1):
+        self.attributes = [k for k in warning.keys() if k in alarm.keys()]
+        self.index = {}
+        for n, attr in enumerate(self.attributes):
+            self.index[attr] = n
+        self.nof_rows = int(nof_rows)
+        self.debounce = max(int(debounce), 1)
+        w = np.array([parse_limits(warning[k]) for k in self.attributes], dtype=float).reshape(-1, 2)
+        a = np.array([parse_limits(alarm[k]) for k in self.attributes], dtype=float).reshape(-1, 2)
+        self.warning_lo, self.warning_hi = w[:, 0], w[:, 1]
+        self.alarm_lo, self.alarm_hi = a[:, 0], a[:, 1]
+        width = self.warning_hi - self.warning_lo
+        # Open bands have no width, use the magnitude of the finite bound instead
+        bound = np.where(np.isfinite(self.warning_hi), np.abs(self.warning_hi), np.abs(self.warning_lo))
+        width = np.where(np.isfinite(width), width, bound)
+        self.margin = np.nan_to_num(width * float(hysteresis), nan=0.0, posinf=0.0)
+        self.reset()
+
+    def reset(self):
+        shape = (self.nof_rows, len(self.attributes))
+        self.state = np.zeros(shape, dtype=np.int8)
+        self.pending = np.zeros(shape, dtype=np.int8)
+        self.pending_count = np.zeros(shape, dtype=np.int32)
+
+    def snapshot(self, telemetry, rows=None):
+        """
+        Build the (rows x attributes) value matrix from a list of {attribute: value} dictionaries,
+        or from a single {attribute: [value per row]} dictionary. Missing values are NaN.
+        """
+        values = np.zeros((self.nof_rows, len(self.attributes))) * np.nan
+        if type(telemetry) is dict:
+            for attr, v in telemetry.items():
+                if attr in self.index:
+                    column = [to_float(x) for x in list(v)[:self.nof_rows]]
+                    values[:len(column), self.index[attr]] = column
+        else:
+            if rows is None:
+                rows = range(len(telemetry))
+            for r, tlm in zip(rows, telemetry):
+                for attr, v in tlm.items():
+                    if attr in self.index:
+                        values[r, self.index[attr]] = to_float(v)
+        return values
+
+    def classify(self, values, margin=0):
+        """ Raw state of each value, margin shrinks the bands (used to clear a state) """
+        with np.errstate(invalid='ignore'):
+            warning = (values < self.warning_lo + margin) | (values > self.warning_hi - margin)
+            alarm = (values < self.alarm_lo + margin) | (values > self.alarm_hi - margin)
+        return np.where(alarm, STATE_ALARM, np.where(warning, STATE_WARNING, STATE_OK)).astype(np.int8)
+
+    def evaluate(self, values, rows=None):
+        """
+        Evaluate a snapshot and update the states.
+
+        values has shape (len(rows), attributes), rows defaults to all rows. NaN values keep their state.
+        Return the state matrix of the evaluated rows and the list of accepted transitions as
+        (row, attribute, old_state, new_state, value) tuples.
+        """
+        if rows is None:
+            rows = np.arange(self.nof_rows)
+        rows = np.atleast_1d(rows)
+        values = np.array(values, dtype=float).reshape(len(rows), len(self.attributes))
+        state = self.state[rows]
+        raw = self.classify(values)
+        strict = self.classify(values, self.margin)
+        # Raise with the nominal bands, lower only if the value is inside the band minus the margin
+        candidate = np.where(raw >= state, raw, np.minimum(state, strict))
+        candidate = np.where(np.isnan(values), state, candidate).astype(np.int8)
+
+        pending = self.pending[rows]
+        count = self.pending_count[rows]
+        changing = ~(candidate == state)
+        count = np.where(changing & (candidate == pending), count + 1, np.where(changing, 1, 0))
+        pending = np.where(changing, candidate, state)
+        accepted = changing & (count >= self.debounce)
+        new_state = np.where(accepted, candidate, state).astype(np.int8)
+        count[accepted] = 0
+
+        self.state[rows] = new_state
+        self.pending[rows] = pending
+        self.pending_count[rows] = count
+        events = []
+        for r, c in zip(*np.nonzero(accepted)):
+            events += [(int(rows[r]), self.attributes[c], int(state[r, c]), int(new_state[r, c]), float(values[r, c]))]
+        return new_state, events
+
+    def evaluate_row(self, row, telemetry):
+        """ Evaluate the {attribute: value} telemetry of a single row, return its states and the transitions """
+        values = np.array([[to_float(telemetry.get(attr, None)) for attr in self.attributes]])
+        states, events = self.evaluate(values, rows=[row])
+        return states[0], events
+
+    def get_state(self, row, attribute):
+        return int(self.state[row, self.index[attribute]])
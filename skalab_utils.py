@@ -1,35 +1,47 @@
+import os
+import re
 import glob
+import bisect
+import fnmatch
 import datetime
 import subprocess
+import math
 import calendar
 import time
+import socket
+import warnings
+from concurrent.futures import ThreadPoolExecutor, wait
 
 import h5py
 import numpy as np
 import configparser
+import matplotlib
 from matplotlib.figure import Figure
+from matplotlib.patches import Circle
+from matplotlib.markers import MarkerStyle
+from matplotlib.textpath import TextPath
 from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg as FigureCanvas
 from PyQt5 import QtCore, QtGui, QtWidgets, uic
 from PyQt5.QtWidgets import QWidget, QStyleOption
 from PyQt5.QtGui import QPainter
 import sys
 sys.path.append("../../pyaavs/tests/")
-from pydaq.persisters import *
-from get_nic import getnic
+from skalab_base import parse_profile, getTextFromFile
 from colorsys import rgb_to_hls, hls_to_rgb
 from PyQt5.QtWidgets import QWidget, QStyleOption
 from PyQt5.QtGui import QPainter
 from PyQt5.QtCore import pyqtSignal, QSize, QByteArray, QRectF, pyqtProperty
-from PyQt5.QtSvg import QSvgRenderer
 from PyQt5.QtWidgets import QWidget
 
 COLORI = ["b", "g", "k", "r", "orange", "magenta", "darkgrey", "turquoise"] * 4
 
 
-def parse_profile(config=""):
-    confparser = configparser.ConfigParser()
-    confparser.read(config)
-    return confparser
+def get_cmap(name):
+    """ Colormap by name on both the old and the new matplotlib API """
+    try:
+        return matplotlib.colormaps[name]
+    except AttributeError:
+        return matplotlib.cm.get_cmap(name)
 
 
 def dt_to_timestamp(d):
@@ -65,13 +77,6 @@ def colors(name):
         return ""
 
 
-def getTextFromFile(fname):
-    if os.path.exists(fname):
-        with open(fname) as f:
-            text = f.read()
-        return text
-
-
 
 class Led(QWidget):
     
@@ -140,6 +145,7 @@ class Led(QWidget):
         self.m_shape=Led.Circle
 
         QWidget.__init__(self, parent, **kwargs)
+        from PyQt5.QtSvg import QSvgRenderer
         self.renderer=QSvgRenderer()
 
     def Colour(self): return self.m_Colour
@@ -302,6 +308,23 @@ class MiniPlots(QtWidgets.QWidget):
         self.canvas.ax[ant].yaxis.set_label_text("MHz", fontsize=9)
         self.canvas.ax[ant].set_title(title, fontsize=10)
 
+    def plotWaterfall(self, image, ant, extent, clim=(0, 40), title="", xLabel="MHz", yLabel="integrations"):
+        """ Show an image (time x frequency), it is created once and then only its data is replaced """
+        if 'waterfall' in self.plots[int(ant)].keys():
+            self.plots[int(ant)]['waterfall'].set_data(image)
+            self.plots[int(ant)]['waterfall'].set_extent(extent)
+            self.plots[int(ant)]['waterfall'].set_clim(clim)
+            # The same image shows another tile or input when the view changes
+            self.canvas.ax[ant].set_title(title, fontsize=self.titlesize)
+        else:
+            self.canvas.ax[ant].cla()
+            self.plots[int(ant)]['waterfall'] = self.canvas.ax[ant].imshow(image, extent=extent, origin='lower',
+                                                                           interpolation='none', aspect='auto',
+                                                                           cmap='jet', clim=clim)
+            self.canvas.ax[ant].set_title(title, fontsize=self.titlesize)
+            self.canvas.ax[ant].set_xlabel(xLabel, fontsize=self.titlesize)
+            self.canvas.ax[ant].set_ylabel(yLabel, fontsize=self.titlesize)
+
     def plotPower(self, assex, data, ant, xAxisRange=None, yAxisRange=None, colore="b", xLabel="", yLabel="", title="",
                   titlesize=10, grid=False, show_line=True, lw=1, xdatetime=False):
         """ Plot the data as a curve"""
@@ -427,6 +450,8 @@ class MiniPlots(QtWidgets.QWidget):
         # Reset the plot landscape
         for i in range(self.nplot):
             self.canvas.ax[i].clear()
+        # The lines and images removed can't be reused anymore
+        self.plots = [self.canvas_elements.copy() for _ in range(self.nplot)]
         #self.updatePlot()
 
 
@@ -493,18 +518,362 @@ def calcolaspettro(dati, nsamples=32768, log=True):
     return mediato, power_rf, adu_rms
 
 
+class BandPower(object):
+    """
+    Power in many frequency bands of many signals at once.
+
+    Segment length, window, frequency axis and the bins of each band are computed once for a resolution,
+    the spectra of a batch of signals (signals x samples) are computed together as calcolaspettro does
+    one by one, and the power of all the bands comes from a single cumulative sum of the spectra.
+    """
+    def __init__(self, resolution=1000, bands=None):
+        self.resolutions = 2 ** np.array(range(16)) * (800000.0 / 2 ** 15)
+        self.rbw = int(np.argmin(np.abs(self.resolutions - float(resolution))))
+        self.avg = 2 ** self.rbw
+        self.nsamples = int(2 ** 15 / self.avg)
+        self.RBW = (self.avg * (400000.0 / 16384.0))
+        self.asse_x = np.arange(self.nsamples / 2 + 1) * self.RBW * 0.001
+        self.window = np.hanning(self.nsamples)
+        self.set_bands([] if bands is None else bands)
+
+    def set_bands(self, bands):
+        """ bands is a list of (start, stop) frequencies (MHz), the stop bin is excluded as in the slices """
+        self.bands = [(float(a), float(b)) for a, b in bands]
+        edges = np.array(self.bands, dtype=float).reshape(-1, 2)
+        self.lo = np.abs(self.asse_x[None, :] - edges[:, 0:1]).argmin(axis=1)
+        # A zero width band (e.g. 160-160) is the bin of that frequency
+        self.hi = np.maximum(np.abs(self.asse_x[None, :] - edges[:, 1:2]).argmin(axis=1), self.lo + 1)
+
+    def spectra(self, raw):
+        """ Linear spectra (signals x bins) of raw data (signals x samples) """
+        raw = np.asarray(raw)
+        nseg = raw.shape[-1] // self.nsamples
+        segments = raw[:, :nseg * self.nsamples].reshape(len(raw), nseg, self.nsamples)
+        spettri = np.abs(np.fft.rfft(segments * self.window, axis=-1))
+        spettri = (2 * spettri / spettri.shape[-1]).sum(axis=1) / (2 ** 15 / self.nsamples)
+        return np.power(spettri / 127.0, 2)
+
+    def power(self, spettri):
+        """ Linear power (signals x bands) of linear spectra """
+        cumulative = np.zeros((len(spettri), spettri.shape[-1] + 1))
+        np.cumsum(spettri, axis=1, out=cumulative[:, 1:])
+        return cumulative[:, self.hi] - cumulative[:, self.lo]
+
+    def power_db(self, raw):
+        """ Power (dB, signals x bands) of raw data (signals x samples) """
+        with np.errstate(divide='ignore'):
+            return 10 * np.log10(self.power(self.spectra(raw)))
+
+
+# raw_burst_<tile>_<YYYYMMDD>_<seconds of the day>_<partition>.hdf5
+RAW_BURST_RE = re.compile(r"^raw_burst_(\d+)_(\d{8})_(\d+)_(\d+)\.hdf5$")
+CHANNEL_INTEG_RE = re.compile(r"^channel_integ_(\d+)_(\d{8})_(\d+)_(\d+)\.hdf5$")
+
+
+def format_size(nbytes):
+    """ Bytes as "du -h" would print them (e.g. 12G) """
+    for unit in ["B", "K", "M", "G", "T"]:
+        if nbytes < 1024 or unit == "T":
+            return "%d%s" % (nbytes, unit)
+        nbytes = nbytes / 1024.
+
+
+class RawDataCatalogue(object):
+    """
+    Index of the raw burst files of a directory (or of the files matching another DAQ name pattern):
+    tile, timestamp, partition and size of each file.
+
+    The directory is read with a single os.scandir, and read again only when its modification time changes
+    (a file added or removed), only the new names are parsed and only the removed ones are dropped.
+    The newest file of each tile, the one the DAQ may still be writing, is stat'ed again at every refresh.
+    Per tile the files are kept sorted by time and the counts, volumes and time ranges are kept up to date,
+    so the queries don't touch the disk.
+    """
+    def __init__(self, directory="", pattern=RAW_BURST_RE):
+        self.directory = ""
+        self.pattern = pattern
+        self.open(directory)
+
+    def open(self, directory):
+        if not os.path.abspath(os.path.expanduser(directory)) == self.directory:
+            self.directory = os.path.abspath(os.path.expanduser(directory)) if directory else ""
+            self.mtime = None
+            self.known = {}
+            self.by_tile = {}
+            self.sizes = {}
+            self.days = {}
+        return self.refresh()
+
+    def tstamp(self, day, seconds):
+        # fname_to_tstamp without parsing the same day again
+        if day not in self.days:
+            self.days[day] = fname_to_tstamp(day + "_0")
+        return self.days[day] + int(seconds)
+
+    def refresh(self):
+        """ Update the index, return the names of the new files (sorted) """
+        if not self.directory or not os.path.isdir(self.directory):
+            return []
+        mtime = os.stat(self.directory).st_mtime_ns
+        if mtime == self.mtime:
+            self.restat_newest()
+            return []
+        self.mtime = mtime
+        found = {}
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                if entry.name in self.known:
+                    found[entry.name] = self.known[entry.name]
+                    continue
+                m = self.pattern.match(entry.name)
+                if m is not None and entry.is_file():
+                    tile = int(m.group(1))
+                    found[entry.name] = (tile, self.tstamp(m.group(2), m.group(3)), int(m.group(4)),
+                                         entry.stat().st_size)
+        added = sorted([n for n in found if n not in self.known])
+        removed = [n for n in self.known if n not in found]
+        for name in removed:
+            tile, tstamp, partition, size = self.known.pop(name)
+            self.by_tile[tile].remove((tstamp, partition, name))
+            self.sizes[tile] -= size
+            if not self.by_tile[tile]:
+                del self.by_tile[tile]
+                del self.sizes[tile]
+        for name in added:
+            tile, tstamp, partition, size = found[name]
+            self.known[name] = found[name]
+            bisect.insort(self.by_tile.setdefault(tile, []), (tstamp, partition, name))
+            self.sizes[tile] = self.sizes.get(tile, 0) + size
+        self.restat_newest()
+        return added
+
+    def restat_newest(self):
+        """ Update the size of the newest file of each tile, the only one expected to grow """
+        for tile, files in self.by_tile.items():
+            name = files[-1][2]
+            try:
+                size = os.stat(os.path.join(self.directory, name)).st_size
+            except OSError:
+                # Removed meanwhile, the next scan drops it
+                continue
+            t, tstamp, partition, old_size = self.known[name]
+            if not size == old_size:
+                self.known[name] = (t, tstamp, partition, size)
+                self.sizes[tile] += size - old_size
+
+    def tiles(self):
+        return sorted(self.by_tile.keys())
+
+    def count(self, tile):
+        return len(self.by_tile.get(int(tile), []))
+
+    def volume(self, tile=None):
+        """ Bytes of the files of a tile, or of all the tiles """
+        if tile is None:
+            return sum(self.sizes.values())
+        return self.sizes.get(int(tile), 0)
+
+    def time_range(self, tile):
+        """ First and last timestamp of a tile, (0, 0) if no files """
+        files = self.by_tile.get(int(tile), [])
+        if not files:
+            return 0, 0
+        return files[0][0], files[-1][0]
+
+    def files(self, tile):
+        """ Full paths of the files of a tile in time order """
+        return [os.path.join(self.directory, f[2]) for f in self.by_tile.get(int(tile), [])]
+
+    def timestamps(self, tile):
+        return [f[0] for f in self.by_tile.get(int(tile), [])]
+
+    def newer(self, tile, tstamp):
+        """ (timestamp, full path) of the files of a tile acquired after tstamp, one per timestamp """
+        files = self.by_tile.get(int(tile), [])
+        result = []
+        for t, partition, name in files[bisect.bisect_right(files, (tstamp, float('inf'), "")):]:
+            if not result or not result[-1][0] == t:
+                result += [(t, os.path.join(self.directory, name))]
+        return result
+
+
+class IntegratedSpectraReader(object):
+    """
+    Reader of the integrated channel spectra of a tile written by the DAQ.
+
+    The newest channel_integ file of the tile is kept open (in SWMR mode if the file allows it) and only the
+    samples written after the last read are returned. When the DAQ starts a new file the samples left in the
+    old one are read first, then the reader moves to the new file. The first read (or the first after a tile
+    change) returns only the last 'backlog' samples already in the file.
+    The readers of many tiles can share one catalogue of the directory, its owner then refreshes it once
+    before reading them.
+    """
+    def __init__(self, directory="", tile=0, nof_antennas=16, nof_pols=2, backlog=1, catalogue=None):
+        self.shared_catalogue = catalogue is not None
+        if catalogue is None:
+            catalogue = RawDataCatalogue(directory, pattern=CHANNEL_INTEG_RE)
+        self.catalogue = catalogue
+        self.backlog = backlog
+        self.nof_antennas = nof_antennas
+        self.nof_pols = nof_pols
+        self.hfile = None
+        self.fname = ""
+        self.swmr = False
+        self.tile = int(tile)
+        self.next_sample = 0
+
+    def set_tile(self, tile):
+        if not int(tile) == self.tile:
+            self.close()
+            self.tile = int(tile)
+
+    def close(self):
+        if self.hfile is not None:
+            try:
+                self.hfile.close()
+            except:
+                pass
+        self.hfile = None
+        self.fname = ""
+        self.next_sample = 0
+
+    def open(self, fname):
+        try:
+            self.hfile = h5py.File(fname, "r", libver="latest", swmr=True)
+            self.swmr = True
+        except (OSError, ValueError):
+            # Not written in SWMR mode, it is opened again at every read to see the new samples
+            self.hfile = h5py.File(fname, "r")
+            self.swmr = False
+        self.fname = fname
+
+    def read_file(self):
+        """ Samples of the open file not read yet, as (samples x channels x antennas x pols) and timestamps """
+        if not self.swmr:
+            self.hfile.close()
+            self.hfile = h5py.File(self.fname, "r")
+        dset = self.hfile["chan_"]["data"]
+        tstamps = self.hfile["sample_timestamps"]["data"]
+        if self.swmr:
+            dset.refresh()
+            tstamps.refresh()
+        stop = min(dset.shape[0], tstamps.shape[0])
+        if stop <= self.next_sample:
+            return None, None
+        data = dset[self.next_sample:stop]
+        t = np.array(tstamps[self.next_sample:stop]).reshape(-1)
+        self.next_sample = stop
+        return data.reshape(len(data), -1, self.nof_antennas, self.nof_pols), t
+
+    def read(self):
+        """ New samples since the last call (None, None if nothing new) """
+        if not self.shared_catalogue:
+            self.catalogue.refresh()
+        files = self.catalogue.files(self.tile)
+        if not files:
+            return None, None
+        chunks, tchunks = [], []
+        if not self.fname == files[-1]:
+            first = self.hfile is None
+            if not first:
+                # Rollover: what is left in the old file comes first
+                data, t = self.read_file()
+                if data is not None:
+                    chunks += [data]
+                    tchunks += [t]
+            self.close()
+            self.open(files[-1])
+            if first:
+                self.next_sample = max(len(self.hfile["sample_timestamps"]["data"]) - self.backlog, 0)
+        data, t = self.read_file()
+        if data is not None:
+            chunks += [data]
+            tchunks += [t]
+        if not chunks:
+            return None, None
+        return np.concatenate(chunks), np.concatenate(tchunks)
+
+
+def spectra_db(data, mapping=None):
+    """ Integrated spectra (... x channels x antennas x pols) to dB, antennas reordered as the TPM inputs """
+    if mapping is None:
+        mapping = antenna_mapping
+    with np.errstate(divide='ignore'):
+        return 10 * np.log10(np.asarray(data, dtype=np.float64)[..., mapping, :])
+
+
+class SpectraWaterfall(object):
+    """
+    The last 'depth' integrated spectra of one or more tiles, in dB.
+
+    Everything lives in a float32 ring allocated once (tiles x depth x inputs x pols x channels, NaN where
+    nothing was received yet), so the memory used doesn't grow with the observation: 256 integrations of
+    one tile take 16 MB. Waterfall images and channel time series are views of the ring in time order.
+    """
+    def __init__(self, depth=256, nof_tiles=1, nof_channels=512, nof_inputs=16, nof_pols=2):
+        self.depth = int(depth)
+        self.data = np.full((nof_tiles, self.depth, nof_inputs, nof_pols, nof_channels), np.nan, dtype=np.float32)
+        self.tstamp = np.zeros((nof_tiles, self.depth))
+        self.count = np.zeros(nof_tiles, dtype=int)
+
+    def clear(self, tile):
+        self.data[tile] = np.nan
+        self.tstamp[tile] = 0
+        self.count[tile] = 0
+
+    def add(self, tile, tstamps, spettri):
+        """ Store the spectra of a tile (samples x channels x inputs x pols, as spectra_db) """
+        spettri = np.asarray(spettri)[-self.depth:]
+        tstamps = np.asarray(tstamps).reshape(-1)[-self.depth:]
+        slots = (self.count[tile] + np.arange(len(spettri))) % self.depth
+        self.data[tile, slots] = spettri.transpose(0, 2, 3, 1)
+        self.tstamp[tile, slots] = tstamps
+        self.count[tile] += len(spettri)
+
+    def order(self, tile):
+        """ Ring slots of a tile from the oldest to the newest integration """
+        n = min(self.count[tile], self.depth)
+        return (self.count[tile] - n + np.arange(n)) % self.depth
+
+    def latest(self, tile):
+        """ Timestamp and spectra (inputs x pols x channels) of the newest integration, None if empty """
+        if not self.count[tile]:
+            return None, None
+        n = (self.count[tile] - 1) % self.depth
+        return self.tstamp[tile, n], self.data[tile, n]
+
+    def image(self, tile, rf_input, pol):
+        """ Waterfall of an input (integrations x channels) and its timestamps """
+        slots = self.order(tile)
+        return self.data[tile, slots, rf_input, pol], self.tstamp[tile, slots]
+
+    def series(self, tile, channel):
+        """ Time series of a channel for all the inputs (integrations x inputs x pols) and its timestamps """
+        slots = self.order(tile)
+        return self.data[tile, slots, :, :, channel], self.tstamp[tile, slots]
+
+
+# Catalogues of the directories looked at so far
+CATALOGUES = {}
+
+
+def catalogue(directory=""):
+    """ The shared, refreshed catalogue of a directory """
+    key = os.path.abspath(os.path.expanduser(directory))
+    if key not in CATALOGUES:
+        CATALOGUES[key] = RawDataCatalogue(directory)
+    else:
+        CATALOGUES[key].refresh()
+    return CATALOGUES[key]
+
+
 def dircheck(directory="", tile=1):
     # Check directory
-    lista = sorted(glob.glob(directory + "/raw_burst_%d_*hdf5" % int(tile)))
-    return len(lista)
+    return catalogue(directory).count(tile)
 
 
 def findtiles(directory=""):
-    tiles = []
-    for i in range(16):
-        if len(sorted(glob.glob(directory + "/raw_burst_%d_*hdf5" % i))):
-            tiles += [i]
-    return tiles
+    return [t for t in catalogue(directory).tiles() if t < 16]
 
 
 def playback(directory="", tile=1, res_bw=100):
@@ -517,18 +886,19 @@ def playback(directory="", tile=1, res_bw=100):
     print("Frequency resolution set %3.1f KHz" % resolutions[rbw])
 
 
-def read_data(fmanager=None, hdf5_file="", tile=1, nof_tiles=16):
-    dic = fmanager.get_metadata(timestamp=fname_to_tstamp(hdf5_file[-21:-7]), tile_id=(int(tile)))
-    if fmanager.file_partitions(timestamp=fname_to_tstamp(hdf5_file[-21:-7]), tile_id=(int(tile))) == 0:
+def read_data(fmanager=None, hdf5_file="", tile=1, nof_tiles=16, tstamp=None):
+    if tstamp is None:
+        tstamp = fname_to_tstamp(hdf5_file[-21:-7])
+    dic = fmanager.get_metadata(timestamp=tstamp, tile_id=(int(tile)))
+    partitions = fmanager.file_partitions(timestamp=tstamp, tile_id=(int(tile)))
+    if partitions == 0:
         total_samples = fmanager.n_samples * fmanager.n_blocks
     else:
-        total_samples = fmanager.n_samples * fmanager.n_blocks * \
-                        (fmanager.file_partitions(timestamp=fname_to_tstamp(hdf5_file[-21:-7]), tile_id=(int(tile))))
+        total_samples = fmanager.n_samples * fmanager.n_blocks * partitions
     nof_blocks = total_samples
     nof_antennas = fmanager.n_antennas * nof_tiles
 
-    d, t = fmanager.read_data(timestamp=fname_to_tstamp(hdf5_file[-21:-7]),
-                              n_samples=total_samples, tile_id=(int(tile)))
+    d, t = fmanager.read_data(timestamp=tstamp, n_samples=total_samples, tile_id=(int(tile)))
     t = int(dic['timestamp'])
     #dtimestamp = ts_to_datestring(t, formato="%Y-%m-%d %H:%M:%S")
     d = d[antenna_mapping, :, :].transpose((0, 1, 2))
@@ -536,23 +906,18 @@ def read_data(fmanager=None, hdf5_file="", tile=1, nof_tiles=16):
 
 
 def calc_disk_usage(directory=".", pattern="*.hdf5"):
-    cmd = "find " + directory + " -type f -name '" + pattern + "' -exec du -ch {} + | grep total"
+    """ Volume of the files matching the pattern in the directory tree, as "du -ch" total """
+    total = 0
+    folders = [directory]
     try:
-        #print(cmd)
-        l = subprocess.check_output(cmd, shell=True).decode("utf-8").split()
-        # print(l)
-        # total = 0
-        # unit = 'MB'
-        # for r in l:
-        #     if not 'total' in r:
-        #         val = float(r.replace(",", ".")[:-1])
-        #         if 'G' in r:
-        #             val = val * 1024
-        #         total = total + val
-        # if len(str(total)) > 3:
-        #     total = total / 1000.
-        #     unit = 'GB'
-        return "%d%s" % (float(l[0].replace(",", ".")[:-1]), l[0][-1])
+        while folders:
+            with os.scandir(folders.pop()) as it:
+                for entry in it:
+                    if entry.is_dir(follow_symlinks=False):
+                        folders += [entry.path]
+                    elif fnmatch.fnmatch(entry.name, pattern) and entry.is_file():
+                        total += entry.stat().st_size
+        return format_size(total)
     except:
         return "0 MB"
 
@@ -709,6 +1074,17 @@ def decodeChannelList(stringa="1-16"):
     return new_list
 
 
+def decodeBandList(stringa=""):
+    """ "FM:87.5-108, ORBCOMM:137-138" into a list of (name, start, stop), unnamed bands are called BAND-n """
+    bands = []
+    for n, i in enumerate([b.strip() for b in stringa.split(",") if b.strip()]):
+        name = "BAND-%d" % (n + 1)
+        if ":" in i:
+            name, i = [x.strip() for x in i.split(":", 1)]
+        bands += [(name, float(i.split("-")[0]), float(i.split("-")[1]))]
+    return bands
+
+
 # def calcolaspettro(dati, nsamples=32768):
 #     n = int(nsamples)  # split and average number, from 128k to 16 of 8k # aavs1 federico
 #     sp = [dati[x:x + n] for x in range(0, len(dati), n)]
@@ -730,6 +1106,7 @@ def decodeChannelList(stringa="1-16"):
 
 def get_if_name(lmc_ip):
     #print("Scan for TPM Network interface...")
+    from get_nic import getnic
     tpm_nic = ""
     interfaces = os.listdir('/sys/class/net/') # getnic.interfaces() replaced!
     for i in interfaces:
@@ -740,6 +1117,62 @@ def get_if_name(lmc_ip):
     return tpm_nic
 
 
+def probe_tpm(tpm_ip, ping=False, timeout=1):
+    """ Read the TPM version over UCP (and optionally ping it first), return the status of the board """
+    status = {'ip': tpm_ip, 'reachable': False, 'version': None, 'ping': None, 'latency': None, 'error': ""}
+    tstart = time.time()
+    try:
+        ip = socket.gethostbyname(tpm_ip)
+        if ping:
+            status['ping'] = subprocess.call(["ping", "-c", "1", "-W", str(int(max(timeout, 1))), ip],
+                                             stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL) == 0
+            if not status['ping']:
+                status['error'] = "no answer to ping"
+                return status
+        from pyfabil import TPMGeneric
+        status['version'] = TPMGeneric().get_tpm_version(ip, 10000)
+        status['reachable'] = True
+    except Exception as e:
+        status['error'] = str(e) if str(e) else type(e).__name__
+    finally:
+        status['latency'] = time.time() - tstart
+    return status
+
+
+def scan_tpms(tpm_ips, timeout=3.0, ping=False):
+    """
+    Probe all the TPMs at once. Every board has at most 'timeout' seconds to answer,
+    the ones that don't make it are reported unreachable. Return the status list in the order of tpm_ips.
+    """
+    tpm_ips = list(tpm_ips)
+    if not tpm_ips:
+        return []
+    table = []
+    pool = ThreadPoolExecutor(max_workers=len(tpm_ips), thread_name_prefix="TPM scan")
+    jobs = [pool.submit(probe_tpm, ip, ping, timeout) for ip in tpm_ips]
+    wait(jobs, timeout=timeout)
+    for ip, job in zip(tpm_ips, jobs):
+        if job.done():
+            table += [job.result()]
+        else:
+            table += [{'ip': ip, 'reachable': False, 'version': None, 'ping': None, 'latency': None,
+                       'error': "no answer within %3.1f s" % timeout}]
+    # Probes stuck on a dead board are left to expire on their own
+    pool.shutdown(wait=False)
+    return table
+
+
+def scan_report(table):
+    """ Text table of a TPM scan, one board per line """
+    report = "%-4s %-16s %-12s %-9s %s" % ("#", "IP", "STATUS", "LATENCY", "DETAILS")
+    for n, tpm in enumerate(table):
+        latency = "-" if tpm['latency'] is None else "%3.2f s" % tpm['latency']
+        details = tpm['version'] if tpm['reachable'] else tpm['error']
+        report += "\n%-4d %-16s %-12s %-9s %s" % (n + 1, tpm['ip'], "OK" if tpm['reachable'] else "UNREACHABLE",
+                                                  latency, details)
+    return report
+
+
 class MyDaq:
     def __init__(self, mydaq, eth_nic, station, n_of_tiles, directory="/storage/daq/tmp/"):
         self.daq = mydaq
@@ -788,6 +1221,7 @@ class MyDaq:
         return self.data
 
     def get_data(self):
+        from pydaq.persisters import FileDAQModes, RawFormatFileManager
         self.data = []
         for i in range(self.nof_tiles):
             raw_file = RawFormatFileManager(root_path=self.daq_config['directory'], daq_mode=FileDAQModes.Burst)
@@ -982,10 +1416,19 @@ class ChartPlots(QtWidgets.QWidget):
     #         self.canvas.ax[i].set_visible(visu)
     #     self.canvas.draw()
     #
-    def plotCurve(self, data, trace, color):
-        self.canvas.lines[trace].set_ydata(data)
+    def plotCurve(self, data, trace, color, xdata=None):
+        if xdata is None:
+            self.canvas.lines[trace].set_ydata(data)
+        else:
+            self.canvas.lines[trace].set_data(xdata, data)
         self.canvas.lines[trace].set_color(color)
 
+    def plotHistory(self, history, trace, color, column=0, field="mean"):
+        """ Plot one column of a ChartHistory against its 'samples ago' axis """
+        x, y = history.series(field=field)
+        self.plotCurve(data=y[:, column], trace=trace, color=color, xdata=x)
+        self.set_xlim([min(-max(history.depth - 1, 1), x[0] if len(x) else 0), 0])
+
     def showGrid(self, show_grid=True):
         self.canvas.ax.grid(show_grid)
         self.canvas.draw()
@@ -999,6 +1442,9 @@ class ChartPlots(QtWidgets.QWidget):
     def set_ylim(self, ylim):
         self.canvas.ax.set_ylim(ylim)
 
+    def set_xlim(self, xlim):
+        self.canvas.ax.set_xlim(xlim)
+
     # def set_x_limits(self, xAxisRange):
     #     for i in range(self.nplot):
     #         self.canvas.ax[i].set_xlim(xAxisRange)
@@ -1041,6 +1487,135 @@ class ChartPlots(QtWidgets.QWidget):
         self.canvas.ax.clear()
 
 
+class ChartHistory:
+    """
+    Fixed memory trend buffer for the charts.
+
+    The most recent 'depth' samples are kept at full resolution (tier 0), every sample
+    falling out of a tier is accumulated and each group of 'decimation' samples is pushed
+    into the next coarser tier as a single min/mean/max sample. The last tier just drops
+    its oldest samples, so the memory footprint never exceeds tiers * depth samples.
+    With depth=200, tiers=3, decimation=10 it spans 22200 samples (about 6 hours at 1 s).
+    """
+    def __init__(self, nof_traces=1, depth=200, tiers=3, decimation=10):
+        self.nof_traces = int(nof_traces)
+        self.depth = max(int(depth), 1)
+        self.nof_tiers = max(int(tiers), 1)
+        self.decimation = max(int(decimation), 2)
+        # Each tier is a ring of [min, mean, max] samples
+        self.tiers = [np.zeros((3, self.depth, self.nof_traces)) * np.nan for _ in range(self.nof_tiers)]
+        self.head = [0] * self.nof_tiers
+        self.count = [0] * self.nof_tiers
+        # Samples waiting to be aggregated into tier n (index 0 is unused)
+        self.pending = [np.zeros((3, self.decimation, self.nof_traces)) * np.nan for _ in range(self.nof_tiers)]
+        self.pending_count = [0] * self.nof_tiers
+
+    def __len__(self):
+        return sum(self.count) + sum(self.pending_count)
+
+    def span(self):
+        """ Number of full resolution samples covered by the history """
+        span = 0
+        for t in range(self.nof_tiers):
+            span += self.count[t] * (self.decimation ** t)
+            if t:
+                span += self.pending_count[t] * (self.decimation ** (t - 1))
+        return span
+
+    def append(self, values):
+        sample = np.array(values, dtype=float).reshape(-1)
+        if not len(sample) == self.nof_traces:
+            raise ValueError("ChartHistory expects %d values, got %d" % (self.nof_traces, len(sample)))
+        self._push(0, sample, sample, sample)
+
+    def _push(self, tier, vmin, vmean, vmax):
+        pos = self.head[tier]
+        if self.count[tier] == self.depth and tier + 1 < self.nof_tiers:
+            # The oldest sample is going to be overwritten, hand it to the coarser tier
+            self._accumulate(tier + 1, self.tiers[tier][:, pos].copy())
+        self.tiers[tier][0, pos] = vmin
+        self.tiers[tier][1, pos] = vmean
+        self.tiers[tier][2, pos] = vmax
+        self.head[tier] = (pos + 1) % self.depth
+        self.count[tier] = min(self.count[tier] + 1, self.depth)
+
+    def _accumulate(self, tier, sample):
+        k = self.pending_count[tier]
+        self.pending[tier][:, k] = sample
+        k = k + 1
+        if k == self.decimation:
+            acc = self.pending[tier]
+            with warnings.catch_warnings():
+                # Gaps (all NaN columns) are expected while a link is down
+                warnings.simplefilter("ignore", category=RuntimeWarning)
+                self._push(tier, np.nanmin(acc[0], axis=0), np.nanmean(acc[1], axis=0), np.nanmax(acc[2], axis=0))
+            acc[:] = np.nan
+            k = 0
+        self.pending_count[tier] = k
+
+    def _ordered(self, tier):
+        """ Tier content from the oldest to the newest sample, shape (3, count, nof_traces) """
+        data = self.tiers[tier]
+        if self.count[tier] < self.depth:
+            return data[:, :self.count[tier]]
+        return np.concatenate((data[:, self.head[tier]:], data[:, :self.head[tier]]), axis=1)
+
+    def series(self, field="mean"):
+        """
+        Return the whole history as (x, y) from the oldest to the newest sample.
+
+        x is the age of each sample in full resolution samples (0 is the latest, negative going back in time,
+        coarse samples are placed at the centre of the interval they aggregate), y has shape (N, nof_traces).
+        field selects the "min", "mean" or "max" aggregate, full resolution samples are the same for all.
+        """
+        f = ["min", "mean", "max"].index(field)
+        xs, ys = [], []
+        age = 0
+        for t in range(self.nof_tiers):
+            res = self.decimation ** t
+            data = self._ordered(t)[f]
+            n = len(data)
+            if n:
+                xs += [-(age + (n - 1 - np.arange(n)) * res + (res - 1) / 2.)]
+                ys += [data]
+            age += n * res
+            if t + 1 < self.nof_tiers:
+                k = self.pending_count[t + 1]
+                if k:
+                    # Samples waiting for aggregation still have the resolution of this tier
+                    xs += [-(age + (k - 1 - np.arange(k)) * res + (res - 1) / 2.)]
+                    ys += [self.pending[t + 1][f, :k]]
+                age += k * res
+        if not xs:
+            return np.zeros(0), np.zeros((0, self.nof_traces))
+        return np.concatenate(xs[::-1]), np.concatenate(ys[::-1])
+
+    def clear(self):
+        for t in range(self.nof_tiers):
+            self.tiers[t][:] = np.nan
+            self.pending[t][:] = np.nan
+        self.head = [0] * self.nof_tiers
+        self.count = [0] * self.nof_tiers
+        self.pending_count = [0] * self.nof_tiers
+
+
+def chart_history_from_profile(section, nof_traces=1):
+    """ Create a ChartHistory using the chart_* keys of a profile section (defaults if missing) """
+    try:
+        depth = int(section['chart_depth'])
+    except (KeyError, ValueError, TypeError):
+        depth = 200
+    try:
+        tiers = int(section['chart_tiers'])
+    except (KeyError, ValueError, TypeError):
+        tiers = 3
+    try:
+        decimation = int(section['chart_decimation'])
+    except (KeyError, ValueError, TypeError):
+        decimation = 10
+    return ChartHistory(nof_traces=nof_traces, depth=depth, tiers=tiers, decimation=decimation)
+
+
 class Archive:
     def __init__(self, hfile, mode='a'):
         self.hfile = h5py.File(hfile, mode)
@@ -1096,9 +1671,9 @@ class MapCanvas(FigureCanvas):
         self.ax.axis([-20, 20, -20, 20])
         self.ax.set_xlabel("West-East (m)", fontsize=14)
         self.ax.set_ylabel("South-North (m)", fontsize=14)
-        self.circle1 = plt.Circle((0, 0), 38.5/2, color='tan', linewidth=1.5)  # , fill=False)
+        self.circle1 = Circle((0, 0), 38.5/2, color='tan', linewidth=1.5)  # , fill=False)
         self.ax.add_artist(self.circle1)
-        # self.circle1 = plt.Circle((0, 0), 38.1/2, color='w', linewidth=1.5)  # , fill=False)
+        # self.circle1 = Circle((0, 0), 38.1/2, color='w', linewidth=1.5)  # , fill=False)
         # self.ax.add_artist(self.circle1)
         # self.ax.grid()
 
@@ -1108,7 +1683,12 @@ class MapCanvas(FigureCanvas):
 
 
 class MapPlot(QtWidgets.QWidget):
+    """
+    Station map drawn with one scatter collection for the antennas and one for their ids.
 
+    Tile masks, highlights and colour mapped antenna values only update the colour arrays of the
+    collections, so a refresh never creates or removes artists.
+    """
     def __init__(self, parent=None, ant=None, mask=None):
         QtWidgets.QWidget.__init__(self, parent)
         if mask is None:
@@ -1121,82 +1701,128 @@ class MapPlot(QtWidgets.QWidget):
         self.vbl.addWidget(self.canvas)
         self.setLayout(self.vbl)
         self.show()
-        self.tiles = [int(a['tile']) for a in ant]
-        self.x = [float(str(a['East']).replace(",", ".")) for a in ant]
-        self.y = [float(str(a['North']).replace(",", ".")) for a in ant]
+        self.tiles = np.array([int(a['tile']) for a in ant], dtype=int)
+        self.x = np.array([float(str(a['East']).replace(",", ".")) for a in ant])
+        self.y = np.array([float(str(a['North']).replace(",", ".")) for a in ant])
         self.ids = [int(str(a['id'])) for a in ant]
+        self.index = {}
+        for n, ant_id in enumerate(self.ids):
+            self.index[ant_id] = n
         self.mask = mask
-        self.circle = []
-        self.cross = []
-        self.names = []
-        self.locate = []
-        self.located = []
+        self.circle = False
+        self.cross = False
+        self.names_visible = False
+        self.points = None
+        self.names = None
+        self.located = {}
+        self.values = np.zeros(len(self.ids)) * np.nan
+        self.cmap = get_cmap("jet")
+        self.norm = matplotlib.colors.Normalize()
+        marker = MarkerStyle('o')
+        self.circle_path = marker.get_path().transformed(marker.get_transform())
+        marker = MarkerStyle('+')
+        self.cross_path = marker.get_path().transformed(marker.get_transform())
 
     def plotMap(self):
         if len(self.x):
-            for i, ant in enumerate(self.ids):
-                circle = [self.canvas.ax.plot(self.x[i], self.y[i], marker='o', markersize=22,
-                                                     linestyle='None', color='k')[0],
-                                 self.canvas.ax.plot(self.x[i], self.y[i], marker='o', markersize=20,
-                                                     linestyle='None', color='wheat')[0],
-                                 self.canvas.ax.plot(self.x[i], self.y[i], marker='o', markersize=20,
-                                                     linestyle='None', color='w')[0]]
-                locate = self.canvas.ax.plot(self.x[i], self.y[i], marker='o', markersize=20,
-                                                     linestyle='None', color='y')[0]
-                for c in circle:
-                    c.set(visible=False)
-                self.circle += [circle]
-                self.cross += [
-                    self.canvas.ax.plot(self.x[i], self.y[i], marker='+', markersize=24, mew=2, linestyle='None',
-                                        color='#636363')[0]]
-                self.cross[-1].set(visible=False)
-                self.locate += [locate]
-                self.locate[-1].set(visible=False)
-                self.names += [self.canvas.ax.text(self.x[i] + 0.1, self.y[i] + 0.3, ("%d" % ant), fontsize=10)]
-                self.names[-1].set(visible=False)
+            self.points = self.canvas.ax.scatter(self.x, self.y, s=400, marker='o', zorder=3)
+            # Ids: one text path per antenna, offset by a few points from its centre
+            self.names = self.canvas.ax.scatter(self.x, self.y, s=1, marker='o', zorder=4)
+            self.names.set_paths([TextPath((4, 8), "%d" % ant, size=10) for ant in self.ids])
+            self.refresh()
             self.updatePlot()
 
+    def refresh(self):
+        """ Recompute shape, colours and visibility of the antennas from the current state """
+        if self.points is None:
+            return
+        n = len(self.ids)
+        visible = np.isin(self.tiles, self.mask)
+        face = np.tile(matplotlib.colors.to_rgba('w'), (n, 1))
+        mapped = np.isfinite(self.values)
+        if mapped.any():
+            face[mapped] = self.cmap(self.norm(self.values[mapped]))
+        if self.cross and not self.circle:
+            self.points.set_paths([self.cross_path])
+            self.points.set_sizes([576])
+            self.points.set_linewidths(2)
+            edge = np.tile(matplotlib.colors.to_rgba('#636363'), (n, 1))
+            edge[mapped] = face[mapped]
+            for i, color in self.located.items():
+                edge[i] = matplotlib.colors.to_rgba(color)
+            face[:, 3] = 0
+        else:
+            self.points.set_paths([self.circle_path])
+            self.points.set_sizes([400])
+            self.points.set_linewidths(1)
+            edge = np.tile(matplotlib.colors.to_rgba('k'), (n, 1))
+            for i, color in self.located.items():
+                face[i] = matplotlib.colors.to_rgba(color)
+        shown = visible & (self.circle | self.cross)
+        located = np.zeros(n, dtype=bool)
+        located[list(self.located.keys())] = True
+        # Highlighted antennas are always shown
+        face[~(shown | located), 3] = 0
+        edge[~(shown | located), 3] = 0
+        self.points.set_facecolors(face)
+        self.points.set_edgecolors(edge)
+        names = np.tile(matplotlib.colors.to_rgba('k'), (n, 1))
+        names[~(visible & self.names_visible), 3] = 0
+        self.names.set_facecolors(names)
+        self.names.set_edgecolors('none')
+
     def showCross(self, flag=True):
-        for i, cross in enumerate(self.cross):
-            if self.tiles[i] in self.mask:
-                cross.set(visible=flag)
-            else:
-                cross.set(visible=False)
+        self.cross = flag
+        self.refresh()
 
     def showCircle(self, flag=True):
-        for i, circle in enumerate(self.circle):
-            if self.tiles[i] in self.mask:
-                for c in circle:
-                    c.set(visible=flag)
-            else:
-                for c in circle:
-                    c.set(visible=False)
+        self.circle = flag
+        self.refresh()
 
     def highlightClear(self):
         if len(self.located):
-            for l in self.located:
-                self.locate[l].set(visible=False)
-            self.located = []
+            self.located = {}
+            self.refresh()
             self.updatePlot()
 
     def highlightAntenna(self, antId=None, color='b'):
         if len(antId):
             for a in antId:
-                mapId = self.ids.index(a)
-                self.locate[mapId].set(visible=True)
-                self.locate[mapId].set(color=color)
-                self.located += [mapId]
+                if a in self.index:
+                    self.located[self.index[a]] = color
+            self.refresh()
             self.updatePlot()
 
     def printId(self, flag=True):
-        for i, ant_id in enumerate(self.names):
-            if self.tiles[i] in self.mask:
-                ant_id.set(visible=flag)
-            else:
-                ant_id.set(visible=False)
+        self.names_visible = flag
+        self.refresh()
+
+    def setValues(self, values, index=None, vmin=None, vmax=None, cmap=None):
+        """
+        Colour the antennas by value (e.g. RMS or temperature), NaN means not coloured.
+        index selects the map positions of the values (all the antennas if None).
+        """
+        if index is None:
+            self.values[:] = values
+        else:
+            self.values[index] = values
+        if cmap is not None:
+            self.cmap = get_cmap(cmap)
+        self.norm.vmin = vmin
+        self.norm.vmax = vmax
+        if vmin is None or vmax is None:
+            mapped = self.values[np.isfinite(self.values)]
+            if len(mapped):
+                self.norm.vmin = mapped.min() if vmin is None else vmin
+                self.norm.vmax = mapped.max() if vmax is None else vmax
+        self.refresh()
+
+    def clearValues(self):
+        self.values[:] = np.nan
+        self.refresh()
 
     def updatePlot(self):
-        self.canvas.draw()
+        self.canvas.draw_idle()
         self.show()
 
     def oPlot(self, x, y, marker='8', markersize=8, color='b'):
@@ -1210,7 +1836,9 @@ class MapPlot(QtWidgets.QWidget):
         self.canvas.ax.set_xlabel("West-East (m)", fontsize=14)
         self.canvas.ax.set_ylabel("South-North (m)", fontsize=14)
         self.canvas.ax.axis([-20, 20, -20, 20])
-        circle1 = plt.Circle((0, 0), 38.5/2, color='tan', linewidth=1.5)  # , fill=False)
+        circle1 = Circle((0, 0), 38.5/2, color='tan', linewidth=1.5)  # , fill=False)
         self.canvas.ax.add_artist(circle1)
+        self.points = None
+        self.names = None
         self.updatePlot()
 